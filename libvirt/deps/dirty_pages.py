@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Dirty guest memory at a controlled rate, to load a guest during migration.
+
+The script keeps a working set in memory and rewrites its pages with the
+chosen content and access pattern, at most --rate MiB per second. Every
+--report seconds a line of JSON is appended to --stats-file, such as:
+{"time": 1502112226.4, "pages": 25600, "total_pages": 256000,
+ "mib_per_second": 100.0}
+
+It runs with python 2.6+ and python 3 without extra modules.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import struct
+import optparse
+
+PAGE_SIZE = 4096
+MIB = 1024 * 1024
+# Pages written between two rate checks
+BATCH_PAGES = 64
+# Count of different random pages to pick from
+RANDOM_POOL_PAGES = 1024
+
+
+def get_page_factory(content):
+    """
+    Get a function returning the content of the n-th written page.
+
+    zero: Pages full of zero, detected by the zero page handling.
+    duplicate: The same page with an 8 bytes counter, the delta against
+               the last copy is tiny, so XBZRLE compresses it well.
+    random: Random pages with an 8 bytes counter, nothing to compress.
+    """
+    if content == "zero":
+        zero_page = b"\0" * PAGE_SIZE
+
+        def _zero(count):
+            return zero_page
+        return _zero
+    if content == "duplicate":
+        template = (b"migration" * PAGE_SIZE)[:PAGE_SIZE - 8]
+
+        def _duplicate(count):
+            return struct.pack("=Q", count) + template
+        return _duplicate
+    if content == "random":
+        pool = [os.urandom(PAGE_SIZE - 8) for _ in range(RANDOM_POOL_PAGES)]
+
+        def _random(count):
+            return struct.pack("=Q", count) + random.choice(pool)
+        return _random
+    raise ValueError("Unknown content: %s" % content)
+
+
+def get_index_factory(pattern, pages, hot_ratio):
+    """
+    Get a function returning the index of the n-th written page.
+
+    sequential: Walk through the working set and wrap around.
+    random: Any page of the working set with the same probability.
+    hotspot: 90% of the writes go to the first hot_ratio of the pages.
+    """
+    if pattern == "sequential":
+        return lambda count: count % pages
+    if pattern == "random":
+        return lambda count: random.randrange(pages)
+    if pattern == "hotspot":
+        hot_pages = max(1, int(pages * hot_ratio))
+
+        def _hotspot(count):
+            if random.random() < 0.9:
+                return random.randrange(hot_pages)
+            return random.randrange(pages)
+        return _hotspot
+    raise ValueError("Unknown pattern: %s" % pattern)
+
+
+def write_stats(stats_file, stats):
+    stats_fd = open(stats_file, "a")
+    try:
+        stats_fd.write(json.dumps(stats) + "\n")
+    finally:
+        stats_fd.close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--size", type="int", default=256,
+                      help="Working set size in MiB")
+    parser.add_option("--rate", type="float", default=0,
+                      help="Dirty rate in MiB/s, 0 means as fast as possible")
+    parser.add_option("--content", default="random",
+                      choices=["zero", "duplicate", "random"],
+                      help="Content of written pages")
+    parser.add_option("--pattern", default="sequential",
+                      choices=["sequential", "random", "hotspot"],
+                      help="Access pattern of written pages")
+    parser.add_option("--hot-ratio", type="float", default=0.1,
+                      help="Ratio of hot pages of hotspot pattern")
+    parser.add_option("--duration", type="float", default=0,
+                      help="Seconds to run, 0 means until killed")
+    parser.add_option("--report", type="float", default=1,
+                      help="Seconds between two stats lines")
+    parser.add_option("--stats-file", default="/tmp/dirty_pages.stats",
+                      help="File to append stats to")
+    options = parser.parse_args()[0]
+
+    pages = options.size * MIB // PAGE_SIZE
+    memory = bytearray(pages * PAGE_SIZE)
+    get_page = get_page_factory(options.content)
+    get_index = get_index_factory(options.pattern, pages, options.hot_ratio)
+
+    # Fault in the whole working set before dirtying at the given rate
+    for index in range(pages):
+        offset = index * PAGE_SIZE
+        memory[offset:offset + PAGE_SIZE] = get_page(index)
+
+    if os.path.exists(options.stats_file):
+        os.remove(options.stats_file)
+    start_time = time.time()
+    report_time = start_time + options.report
+    count = 0
+    report_count = 0
+    while not options.duration or time.time() - start_time < options.duration:
+        for _ in range(BATCH_PAGES):
+            offset = get_index(count) * PAGE_SIZE
+            memory[offset:offset + PAGE_SIZE] = get_page(count)
+            count += 1
+        now = time.time()
+        if options.rate:
+            # Sleep until the pages written so far match the rate
+            expected_time = (start_time +
+                             count * PAGE_SIZE / (options.rate * MIB))
+            if expected_time > now:
+                time.sleep(expected_time - now)
+                now = time.time()
+        if now >= report_time:
+            interval = now - report_time + options.report
+            write_stats(options.stats_file,
+                        {"time": now,
+                         "pages": count - report_count,
+                         "total_pages": count,
+                         "mib_per_second": ((count - report_count) *
+                                            PAGE_SIZE / interval / MIB)})
+            report_count = count
+            report_time = now + options.report
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Measure the latency of guest memory accesses, to catch the page faults
+a guest takes while its memory is pulled by post-copy migration.
+
+The script faults in a working set, then keeps touching one byte of a
+random page of it and times each access. Every --report seconds a line
+of JSON is appended to --stats-file, such as:
+{"time": 1502112226.4, "count": 812345, "mean_us": 0.31,
+ "p50_us": 0.24, "p99_us": 0.95, "max_us": 2345.6}
+
+It runs with python 2.6+ and python 3 without extra modules.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import optparse
+
+PAGE_SIZE = 4096
+MIB = 1024 * 1024
+
+
+def get_percentile(sorted_values, percent):
+    """
+    Get the percentile of a sorted list by the nearest rank.
+    """
+    if not sorted_values:
+        return 0
+    index = int(len(sorted_values) * percent / 100.0 + 0.5) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+def write_stats(stats_file, stats):
+    stats_fd = open(stats_file, "a")
+    try:
+        stats_fd.write(json.dumps(stats) + "\n")
+    finally:
+        stats_fd.close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--size", type="int", default=256,
+                      help="Working set size in MiB")
+    parser.add_option("--write", action="store_true", default=False,
+                      help="Write the touched byte instead of reading it")
+    parser.add_option("--duration", type="float", default=0,
+                      help="Seconds to run, 0 means until killed")
+    parser.add_option("--report", type="float", default=0.5,
+                      help="Seconds between two stats lines")
+    parser.add_option("--stats-file", default="/tmp/memory_latency.stats",
+                      help="File to append stats to")
+    options = parser.parse_args()[0]
+
+    pages = options.size * MIB // PAGE_SIZE
+    memory = bytearray(pages * PAGE_SIZE)
+    # Fault in the whole working set, so that only migration makes the
+    # later accesses fault
+    for index in range(pages):
+        memory[index * PAGE_SIZE] = 1
+
+    if os.path.exists(options.stats_file):
+        os.remove(options.stats_file)
+    start_time = time.time()
+    report_time = start_time + options.report
+    latencies = []
+    value = 0
+    while not options.duration or time.time() - start_time < options.duration:
+        offset = random.randrange(pages) * PAGE_SIZE
+        before = time.time()
+        if options.write:
+            memory[offset] = (memory[offset] + 1) & 0xff
+        else:
+            value ^= memory[offset]
+        after = time.time()
+        latencies.append((after - before) * 1000000)
+        if after >= report_time:
+            latencies.sort()
+            write_stats(options.stats_file,
+                        {"time": after,
+                         "count": len(latencies),
+                         "mean_us": sum(latencies) / len(latencies),
+                         "p50_us": get_percentile(latencies, 50),
+                         "p99_us": get_percentile(latencies, 99),
+                         "max_us": latencies[-1]})
+            latencies = []
+            report_time = after + options.report
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,7 @@
+import os
+import json
+import logging
+
 from autotest.client.shared import error
 
 from virttest import utils_test
@@ -8,54 +12,87 @@ def run(test, params, env):
     Test steps:
 
     1) Get the params from params.
-    2) Divide vms into two groups and run sub test for each group.
-    3) clean up.
+    2) Divide vms into LB_group_count groups, or groups of LB_group_size
+       vms, and run sub test for each group concurrently.
+    3) Collect the result of every group and clean up.
     """
     # Get VMs.
     vms = env.get_all_vms()
     if len(vms) < 2:
         raise error.TestNAError("We need at least 2 vms for this test.")
     timeout = params.get("LB_domstate_switch_loop_time", 600)
-    # Divide vms into two groups.
-    odd_group_vms = []
-    even_group_vms = []
-    for index in range(len(vms)):
-        if (index % 2):
-            even_group_vms.append(vms[index])
-        else:
-            odd_group_vms.append(vms[index])
-
-    # Run sub test for odd_group_vms.
-    odd_env = env.copy()
-    # Unregister vm which belong to even_group from odd_env.
-    for vm in even_group_vms:
-        odd_env.unregister_vm(vm.name)
-    odd_bt = utils_test.BackgroundTest(utils_test.run_virt_sub_test,
-                                       params=[test, params, odd_env,
+    group_size = int(params.get("LB_group_size", "0"))
+    if group_size > 0:
+        group_count = (len(vms) + group_size - 1) // group_size
+    else:
+        group_count = int(params.get("LB_group_count", "2"))
+    if group_count < 1 or group_count > len(vms):
+        raise error.TestNAError("Can not divide %d vms into %d groups." %
+                                (len(vms), group_count))
+    # Divide vms into groups, vm N belongs to group N % group_count.
+    groups = []
+    for index in range(group_count):
+        groups.append(vms[index::group_count])
+
+    # Run sub test for each group.
+    background_tests = []
+    for index, group_vms in enumerate(groups):
+        group_name = "group%d" % index
+        group_env = env.copy()
+        # Unregister vms which do not belong to this group.
+        group_vm_names = [vm.name for vm in group_vms]
+        for vm in vms:
+            if vm.name not in group_vm_names:
+                group_env.unregister_vm(vm.name)
+        group_params = params.copy()
+        group_params["LB_domstate_switch_result_name"] = (
+            "domstate_switch_latency_%s" % group_name)
+        logging.debug("Run sub test for %s: %s", group_name, group_vm_names)
+        bt = utils_test.BackgroundTest(utils_test.run_virt_sub_test,
+                                       params=[test, group_params, group_env,
                                                "libvirt_bench_domstate_switch_in_loop"])
-    odd_bt.start()
-
-    # Run sub test for even_group_vms.
-    even_env = env.copy()
-    # Unregister vm which belong to odd_group from even_env.
-    for vm in odd_group_vms:
-        even_env.unregister_vm(vm.name)
-    even_bt = utils_test.BackgroundTest(utils_test.run_virt_sub_test,
-                                        params=[test, params, even_env,
-                                                "libvirt_bench_domstate_switch_in_loop"])
-    even_bt.start()
-
-    # Wait for background_tests joining.
+        bt.start()
+        background_tests.append((group_name, group_vm_names, group_params,
+                                 bt))
+
+    # Wait for all background_tests joining and collect the results.
     err_msg = ""
+    results = {}
+    for group_name, group_vm_names, group_params, bt in background_tests:
+        result = {"vms": group_vm_names, "status": "PASS"}
+        try:
+            bt.join(int(timeout) * 2)
+        except Exception, detail:
+            result["status"] = "FAIL"
+            result["error"] = str(detail)
+            err_msg += ("Group %s failed to run sub test.\n"
+                        "Detail: %s.\n" % (group_name, detail))
+        if bt.is_alive():
+            result["status"] = "TIMEOUT"
+            err_msg += ("Group %s did not finish sub test in %ss.\n" %
+                        (group_name, int(timeout) * 2))
+        latency_file = os.path.join(
+            test.resultsdir,
+            "%s.json" % group_params["LB_domstate_switch_result_name"])
+        if os.path.isfile(latency_file):
+            result_fd = open(latency_file)
+            try:
+                result["latency"] = json.load(result_fd)
+            finally:
+                result_fd.close()
+        results[group_name] = result
+        for operation, stats in sorted(result.get("latency", {}).items()):
+            logging.info("%s %s: %d samples, p50 %.3fs p99 %.3fs",
+                         group_name, operation, stats["count"],
+                         stats["p50"], stats["p99"])
+
+    results_path = os.path.join(test.resultsdir, "domstate_switch_groups.json")
+    results_fd = open(results_path, "w")
     try:
-        odd_bt.join(int(timeout) * 2)
-    except error.TestFail, detail:
-        err_msg += ("Group odd_group failed to run sub test.\n"
-                    "Detail: %s." % detail)
-    try:
-        even_bt.join(int(timeout) * 2)
-    except error.TestFail, detail:
-        err_msg += ("Group even_group failed to run sub test.\n"
-                    "Detail: %s." % detail)
+        json.dump(results, results_fd, indent=4, sort_keys=True)
+    finally:
+        results_fd.close()
+    logging.info("Results of %d groups saved to %s", group_count,
+                 results_path)
     if err_msg:
         raise error.TestFail(err_msg)
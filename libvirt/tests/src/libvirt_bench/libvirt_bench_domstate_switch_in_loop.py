@@ -1,9 +1,13 @@
 import time
+import Queue
 import logging
+import threading
 
 from autotest.client.shared import error
 
-from virttest import virsh
+from provider import bench_timer
+from provider import domain_events
+from provider import virsh_backend
 
 
 def run(test, params, env):
@@ -18,34 +22,129 @@ def run(test, params, env):
             suspend
             resume
             destroy
-    3) clean up.
+       Each operation is run on LB_domstate_switch_concurrency guests
+       at the same time.
+    3) Report latency and throughput of each operation and clean up.
     """
-    def for_each_vm(vms, virsh_func, state_list=None):
+    def run_in_pool(vms, func):
         """
-        Execute the virsh_func with each vm in vms.
+        Execute func(vm) for each vm in vms with a bounded worker pool.
+
+        At most `concurrency` workers run at the same time, and no new vm
+        is picked up once one of them failed.
 
         :Param vms: List of vm.
-        :Param virsh_func: Function in virsh module.
-        :Param state_list: States to verify the result of virsh_func.
-                           None means do not check the state.
+        :Param func: Function accepting a vm, raising an exception on error.
         """
-        vm_names = []
+        vm_queue = Queue.Queue()
         for vm in vms:
-            vm_names.append(vm.name)
-        for vm_name in vm_names:
-            cmd_result = virsh_func(vm_name)
+            vm_queue.put(vm)
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            while not errors:
+                try:
+                    vm = vm_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    func(vm)
+                except Exception, detail:
+                    lock.acquire()
+                    try:
+                        errors.append("%s: %s" % (vm.name, detail))
+                    finally:
+                        lock.release()
+
+        workers = []
+        for _ in range(max(1, min(concurrency, len(vms)))):
+            worker_thread = threading.Thread(target=worker)
+            worker_thread.start()
+            workers.append(worker_thread)
+        for worker_thread in workers:
+            worker_thread.join()
+        if errors:
+            raise error.TestFail("\n".join(errors))
+
+    def for_each_vm(vms, operation, state_list=None, wait_func=None,
+                    wait_msg=""):
+        """
+        Execute the virsh operation with each vm in vms.
+
+        :Param vms: List of vm.
+        :Param operation: Virsh command to run by the virsh backend.
+        :Param state_list: States to verify the result of operation.
+                           None means do not check the state. In event
+                           wait mode the lifecycle event of operation is
+                           waited for instead.
+        :Param wait_func: Method of vm to wait for each vm after all the
+                          operations finished. None means no wait.
+        :Param wait_msg: Error message if wait_func returns False.
+        """
+        virsh_func = getattr(backend, operation)
+
+        def _run_virsh_func(vm):
+            start_time = time.time()
+            cmd_result = recorder.timed(operation, virsh_func, vm.name)
             if cmd_result.exit_status:
                 raise error.TestFail(cmd_result)
+            if watcher is not None:
+                event = domain_events.EXPECTED_EVENTS[operation]
+                event_time = watcher.wait_for_event(vm.name, event,
+                                                    since=start_time,
+                                                    timeout=event_timeout)
+                if event_time is None:
+                    raise error.TestFail("Command %s succeed, but no %s "
+                                         "event in %ss." %
+                                         (operation, event, event_timeout))
+                recorder.record("%s_to_%s" % (operation, event.lower()),
+                                event_time - start_time)
+                return
             if state_list is None:
-                continue
-            actual_state = virsh.domstate(vm_name).stdout.strip()
+                return
+            actual_state = recorder.timed("domstate", backend.domstate,
+                                          vm.name).stdout.strip()
             if actual_state not in state_list:
                 raise error.TestFail("Command %s succeed, but the state is %s,"
                                      "but not %s." %
-                                     (virsh_func.__name__, actual_state,
+                                     (operation, actual_state,
                                       str(state_list)))
+
+        def _wait_vm(vm):
+            if not recorder.timed(wait_func.__name__, wait_func, vm):
+                raise error.TestFail(wait_msg)
+
+        phase_start = time.time()
+        try:
+            run_in_pool(vms, _run_virsh_func)
+            if wait_func is not None:
+                run_in_pool(vms, _wait_vm)
+        finally:
+            phase_elapsed[operation] = (phase_elapsed.get(operation, 0.0) +
+                                        time.time() - phase_start)
         logging.debug("Operation %s on %s succeed.",
-                      virsh_func.__name__, vm_names)
+                      operation, [vm.name for vm in vms])
+
+    def report_phase_stats():
+        """
+        Log and save latency and throughput of each operation in the loop.
+        """
+        recorder.log_summary()
+        for operation, elapsed in sorted(phase_elapsed.items()):
+            count = len(recorder.get(operation))
+            if not count or not elapsed:
+                continue
+            logging.info("Operation %s: throughput %.2f guests/s "
+                         "with concurrency %d.", operation,
+                         count / elapsed, concurrency)
+        recorder.save(test.resultsdir)
+
+    def wait_for_shutdown(vm):
+        return vm.wait_for_shutdown(count=240)
+
+    def wait_for_login(vm):
+        return vm.wait_for_login()
 
     # Get VMs.
     vms = env.get_all_vms()
@@ -68,6 +167,29 @@ def run(test, params, env):
                                    "running").split(',')
     # Get the loop_time.
     loop_time = int(params.get("LB_domstate_switch_loop_time", "600"))
+    # Number of guests switched at the same time, 1 means one by one.
+    concurrency = int(params.get("LB_domstate_switch_concurrency", "1"))
+    # Run virsh commands by fork, persistent or bindings backend.
+    backend = virsh_backend.get_backend(params)
+    logging.debug("Using virsh backend %s.", backend.name)
+    # Wait for the state by polling domstate or by lifecycle events.
+    wait_mode = params.get("LB_domstate_switch_wait_mode", "poll")
+    event_timeout = int(params.get("LB_domstate_switch_event_timeout",
+                                   "240"))
+    watcher = None
+    if wait_mode == "event":
+        watcher = domain_events.DomainEventWatcher(backend.uri)
+        # Make sure virsh event registered before the first command
+        if not watcher.start(vms[0].name):
+            watcher.stop()
+            backend.close()
+            raise error.TestError("virsh event is not ready to report "
+                                  "events, can not wait for events.")
+    # Latencies and elapsed time of each operation.
+    recorder = bench_timer.LatencyRecorder(
+        params.get("LB_domstate_switch_result_name",
+                   "domstate_switch_latency"))
+    phase_elapsed = {}
     current_time = int(time.time())
     end_time = current_time + loop_time
     # Init a counter for the loop.
@@ -82,23 +204,22 @@ def run(test, params, env):
                 if loop_counter > (len(vms) * 1000 * loop_time):
                     raise error.TestFail("Loop ")
                 if shutdown_in_loop:
-                    for_each_vm(vms, virsh.shutdown, shutdown_post_state)
-                    for vm in vms:
-                        if not vm.wait_for_shutdown(count=240):
-                            raise error.TestFail("Command shutdown succeed, but "
-                                                 "failed to wait for shutdown.")
+                    # The Stopped event already means the vm is shut off.
+                    for_each_vm(vms, "shutdown", shutdown_post_state,
+                                None if watcher else wait_for_shutdown,
+                                "Command shutdown succeed, but "
+                                "failed to wait for shutdown.")
                 if destroy_in_loop:
-                    for_each_vm(vms, virsh.destroy, destroy_post_state)
+                    for_each_vm(vms, "destroy", destroy_post_state)
                 if start_in_loop:
-                    for_each_vm(vms, virsh.start, start_post_state)
-                    for vm in vms:
-                        if not vm.wait_for_login():
-                            raise error.TestFail("Command start succeed, but "
-                                                 "failed to wait for login.")
+                    for_each_vm(vms, "start", start_post_state,
+                                wait_for_login,
+                                "Command start succeed, but "
+                                "failed to wait for login.")
                 if suspend_in_loop:
-                    for_each_vm(vms, virsh.suspend, suspend_post_state)
+                    for_each_vm(vms, "suspend", suspend_post_state)
                 if resume_in_loop:
-                    for_each_vm(vms, virsh.resume, resume_post_state)
+                    for_each_vm(vms, "resume", resume_post_state)
                 logging.debug("Finish %s loop.", loop_counter)
                 # Update the current_time and loop_counter.
                 current_time = int(time.time())
@@ -107,6 +228,10 @@ def run(test, params, env):
             raise error.TestFail("Succeed for %s loop, and got an error.\n"
                                  "Detail: %s." % (loop_counter, detail))
     finally:
+        report_phase_stats()
+        if watcher is not None:
+            watcher.stop()
+        backend.close()
         # Resume vm if vm is paused.
         for vm in vms:
             if vm.is_paused():
@@ -4,12 +4,13 @@ import logging
 
 from autotest.client.shared import error
 
-from virttest import virsh
 from virttest import utils_test
 from virttest import utils_misc
 
+from provider import virsh_backend
 
-def func_in_thread(vm, timeout):
+
+def func_in_thread(vm, timeout, backend):
     """
     Function run in thread to switch domstate.
     """
@@ -24,15 +25,15 @@ def func_in_thread(vm, timeout):
     current_time = time.time()
     end_time = current_time + timeout
     while current_time < end_time:
-        run_virsh_function(func=virsh.dom_list, params="--all")
-        run_virsh_function(func=virsh.dominfo, params=vm.name)
-        run_virsh_function(func=virsh.nodeinfo, params="")
-        run_virsh_function(func=virsh.domuuid, params=vm.name)
-        run_virsh_function(func=virsh.domid, params=vm.name)
-        run_virsh_function(func=virsh.dumpxml, params=vm.name)
-        run_virsh_function(func=virsh.domstate, params=vm.name)
-        run_virsh_function(func=virsh.suspend, params=vm.name)
-        run_virsh_function(func=virsh.resume, params=vm.name)
+        run_virsh_function(func=backend.dom_list, params="--all")
+        run_virsh_function(func=backend.dominfo, params=vm.name)
+        run_virsh_function(func=backend.nodeinfo, params="")
+        run_virsh_function(func=backend.domuuid, params=vm.name)
+        run_virsh_function(func=backend.domid, params=vm.name)
+        run_virsh_function(func=backend.dumpxml, params=vm.name)
+        run_virsh_function(func=backend.domstate, params=vm.name)
+        run_virsh_function(func=backend.suspend, params=vm.name)
+        run_virsh_function(func=backend.resume, params=vm.name)
         # update the current_time.
         current_time = time.time()
 
@@ -69,7 +70,12 @@ def run(test, params, env):
 
         def _is_iozone_running():
             return (not session.cmd_status("ps -ef|grep iozone|grep -v grep"))
-        if not utils_misc.wait_for(_is_iozone_running, timeout=120):
+        try:
+            iozone_running = utils_misc.wait_for(_is_iozone_running,
+                                                 timeout=120)
+        finally:
+            session.close()
+        if not iozone_running:
             raise error.TestNAError("Failed to run iozone in guest.\n"
                                     "Since we need to run a autotest of iozone "
                                     "in guest, so please make sure there are "
@@ -77,11 +83,14 @@ def run(test, params, env):
                                     "such as gcc, tar, bzip2")
     logging.debug("Iozone is already running in VMs.")
 
+    # Run virsh commands by fork, persistent or bindings backend.
+    backend = virsh_backend.get_backend(params)
     try:
         # Create a BackgroundTest for each vm to run test domstate_switch.
         backgroud_tests = []
         for vm in vms:
-            bt = utils_test.BackgroundTest(func_in_thread, [vm, timeout])
+            bt = utils_test.BackgroundTest(func_in_thread,
+                                           [vm, timeout, backend])
             bt.start()
             backgroud_tests.append(bt)
 
@@ -93,4 +102,4 @@ def run(test, params, env):
             vm.reboot()
     finally:
         # Clean up.
-        logging.debug("No cleaning operation for this test.")
+        backend.close()
@@ -6,6 +6,9 @@ from autotest.client.shared import error
 from virttest import utils_test
 from virttest import utils_misc
 
+from provider import guest_dump
+from provider import guest_session_pool
+
 
 def run(test, params, env):
     """
@@ -13,7 +16,8 @@ def run(test, params, env):
 
     1) Get the params from params.
     2) Run unixbench on guest.
-    3) Dump each VM and check result.
+    3) Dump each VM, one by one or all at the same time, measure the
+       dump throughput and check result.
     3) Clean up.
     """
     vms = env.get_all_vms()
@@ -33,8 +37,10 @@ def run(test, params, env):
                                           params, copy_only=True)
         session.cmd("%s &" % command)
 
+    # Reuse guest sessions for polling and checking.
+    session_pool = guest_session_pool.GuestSessionPool()
     for vm in vms:
-        session = vm.wait_for_login()
+        session = session_pool.get_session(vm)
 
         def _is_unixbench_running():
             return (not session.cmd_status("ps -ef|grep perl|grep Run"))
@@ -46,18 +52,22 @@ def run(test, params, env):
 
     logging.debug("Unixbench is already running in VMs.")
 
+    dump_options = guest_dump.get_dump_options(params)
+    dump_parallel = params.get("LB_dump_parallel", "no") == "yes"
     try:
-        dump_path = os.path.join(test.tmpdir, "dump_file")
+        dump_result = guest_dump.dump_vms(vms, test.tmpdir, dump_options,
+                                          dump_parallel)
+        guest_dump.save_result(dump_result, test.resultsdir)
         for vm in vms:
-            vm.dump(dump_path)
-            # Check the status after vm.dump()
+            # Check the status after dump
             if not vm.is_alive():
                 raise error.TestFail("VM is shutoff after dump.")
             if vm.wait_for_shutdown():
                 raise error.TestFail("VM is going to shutdown after dump.")
             # Check VM is running normally.
-            vm.wait_for_login()
+            session_pool.get_session(vm)
     finally:
+        session_pool.close()
         # Destroy VM.
         for vm in vms:
             vm.destroy()
@@ -7,12 +7,14 @@ import shutil
 
 from autotest.client.shared import error
 
-from virttest import virsh
 from virttest import libvirt_vm
 from virttest import utils_test
 from virttest import utils_misc
 from virttest.utils_test import libvirt as utlv
 
+from provider import bench_timer
+from provider import virsh_backend
+
 
 def run(test, params, env):
     """
@@ -40,6 +42,8 @@ def run(test, params, env):
 
     vm = env.get_vm(vm_name)
     session = vm.wait_for_login()
+    # Run virsh commands by fork, persistent or bindings backend.
+    backend = virsh_backend.get_backend(params)
 
     def prepare_channel_xml(to_file, char_type, index=1, id=0):
         params = {}
@@ -80,18 +84,18 @@ def run(test, params, env):
                 char_add_opt += "pty,path=/dev/pts/%s,id=pty%s" % (id, index)
                 dev_add_opt += ("pty%s,name=pty%s,bus=virtio-serial0.0,id=pty%s"
                                 % (index, index, index))
-            virsh.qemu_monitor_command(vm_name, char_add_opt, "--hmp")
-            virsh.qemu_monitor_command(vm_name, dev_add_opt, "--hmp")
+            backend.qemu_monitor_command(vm_name, char_add_opt, "--hmp")
+            backend.qemu_monitor_command(vm_name, dev_add_opt, "--hmp")
         elif hotplug_type == "attach":
             xml_file = "%s/xml_%s%s" % (tmp_dir, char_dev, index)
             if char_dev in ["file", "socket"]:
                 prepare_channel_xml(xml_file, char_dev, index)
             elif char_dev == "pty":
                 prepare_channel_xml(xml_file, char_dev, index, id)
-            virsh.attach_device(vm_name, xml_file, flagstr="--live")
+            backend.attach_device(vm_name, xml_file, flagstr="--live")
 
     def confirm_hotplug_result(char_dev, index=1, id=0):
-        result = virsh.qemu_monitor_command(vm_name, "info qtree", "--hmp")
+        result = backend.qemu_monitor_command(vm_name, "info qtree", "--hmp")
         h_o = result.stdout.strip()
         chardev_c = h_o.count("chardev = %s%s" % (char_dev, index))
         name_c = h_o.count("name = \"%s%s\"" % (char_dev, index))
@@ -134,21 +138,31 @@ def run(test, params, env):
         if hotplug_type == "qmp":
             del_dev_opt = "device_del %s%s" % (char_dev, index)
             del_char_opt = "chardev-remove %s%s" % (char_dev, index)
-            virsh.qemu_monitor_command(vm_name, del_dev_opt, "--hmp")
-            virsh.qemu_monitor_command(vm_name, del_char_opt, "--hmp")
+            backend.qemu_monitor_command(vm_name, del_dev_opt, "--hmp")
+            backend.qemu_monitor_command(vm_name, del_char_opt, "--hmp")
         elif hotplug_type == "attach":
             xml_file = "%s/xml_%s%s" % (tmp_dir, char_dev, index)
-            virsh.detach_device(vm_name, xml_file, flagstr="--live")
+            backend.detach_device(vm_name, xml_file, flagstr="--live")
 
     def confirm_unhotplug_result(char_dev, index=1):
         serial_file = "/dev/virtio-ports/%s%s" % (char_dev, index)
-        result = virsh.qemu_monitor_command(vm_name, "info qtree", "--hmp")
+        result = backend.qemu_monitor_command(vm_name, "info qtree", "--hmp")
         uh_o = result.stdout.strip()
         if uh_o.count("chardev = %s%s" % (char_dev, index)):
             raise error.TestFail("Still can get serial device info: '%s'" % uh_o)
         if not session.cmd_status("test -e %s" % serial_file):
             raise error.TestFail("File '%s' still exists after unhotplug" % serial_file)
 
+    # Record latency of every hotplug operation and guest-side check.
+    recorder = bench_timer.LatencyRecorder("serial_hotplug_latency")
+    hotplug_device = recorder.wrap("hotplug", hotplug_device)
+    confirm_hotplug_result = recorder.wrap("confirm_hotplug",
+                                           confirm_hotplug_result)
+    unhotplug_serial_device = recorder.wrap("unhotplug",
+                                            unhotplug_serial_device)
+    confirm_unhotplug_result = recorder.wrap("confirm_unhotplug",
+                                             confirm_unhotplug_result)
+
     # run test case
     try:
         # increase workload
@@ -205,6 +219,9 @@ def run(test, params, env):
                     confirm_unhotplug_result("socket")
                     confirm_unhotplug_result("pty")
     finally:
+        recorder.log_summary()
+        recorder.save(test.resultsdir)
         session.close()
+        backend.close()
         if os.path.exists(tmp_dir):
             shutil.rmtree(tmp_dir)
@@ -1,5 +1,8 @@
+import os
+import re
 import time
 import logging
+import threading
 
 import aexpect
 
@@ -10,6 +13,30 @@ from virttest import utils_net
 from virttest import remote
 from virttest import utils_misc
 
+from provider import guest_session_pool
+from provider import net_throughput
+
+
+def is_port_listening(port):
+    """
+    Check whether a TCP port is listening on the host by /proc/net/tcp.
+    """
+    for proc_path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        if not os.path.exists(proc_path):
+            continue
+        proc_file = open(proc_path)
+        try:
+            lines = proc_file.readlines()[1:]
+        finally:
+            proc_file.close()
+        for line in lines:
+            fields = line.split()
+            # State 0A is TCP_LISTEN
+            if (fields[3] == "0A" and
+                    int(fields[1].split(":")[-1], 16) == port):
+                return True
+    return False
+
 
 def run(test, params, env):
     """
@@ -17,18 +44,34 @@ def run(test, params, env):
 
     1) Check the environment and get the params from params.
     2) while(loop_time < timeout):
-            ttcp command.
-    3) clean up.
+            ttcp command and record its throughput.
+       In concurrent mode, one ttcp server is started on the host for
+       each guest with its own port, and all the guests send at the same
+       time.
+    3) Save the throughput samples, compare them with the baseline
+       and clean up.
     """
     # Find the ttcp command.
     try:
         os_dep.command("ttcp")
     except ValueError:
         raise error.TestNAError("Not find ttcp command on host.")
+    # Compare the mean throughput with a baseline file, and fail if it
+    # dropped by more than the tolerance(percent).
+    baseline_file = params.get("LB_ttcp_baseline_file", "")
+    tolerance = float(params.get("LB_ttcp_regression_tolerance", "10"))
+    save_baseline = params.get("LB_ttcp_save_baseline", "no") == "yes"
+    if baseline_file and not save_baseline and not os.path.isfile(
+            baseline_file):
+        raise error.TestError("Baseline file %s does not exist, set "
+                              "LB_ttcp_save_baseline = yes to create it."
+                              % baseline_file)
     # Get VM.
     vms = env.get_all_vms()
+    # Reuse guest sessions in the loop.
+    session_pool = guest_session_pool.GuestSessionPool()
     for vm in vms:
-        session = vm.wait_for_login()
+        session = session_pool.get_session(vm)
         status, _ = session.cmd_status_output("which ttcp")
         if status:
             raise error.TestNAError("Not find ttcp command on guest.")
@@ -38,6 +81,110 @@ def run(test, params, env):
                                      "ttcp -s -r -v -D -p5015")
     ttcp_client_command = params.get("LB_ttcp_client_command",
                                      "ttcp -s -t -v -D -p5015 -b65536 -l65536 -n1000 -f K")
+    results = net_throughput.ThroughputResults("ttcp_throughput")
+    iteration = 0
+    # Run ttcp on all the guests at the same time, guest N uses port
+    # LB_ttcp_base_port + N.
+    concurrent = params.get("LB_ttcp_concurrent", "no") == "yes"
+    base_port = int(params.get("LB_ttcp_base_port", "5015"))
+    aggregate_results = net_throughput.ThroughputResults(
+        "ttcp_aggregate_throughput")
+
+    def set_port(command, port):
+        """
+        Replace the -p option of ttcp command with port.
+        """
+        return re.sub(r"-p\s*\d+", "-p%d" % port, command)
+
+    def run_concurrent_round(iteration):
+        """
+        Run ttcp from all the guests to their own host servers at the same
+        time, and record the throughput of each guest and the aggregate
+        throughput.
+
+        The aggregate throughput is over the window from the first client
+        starting its successful transfer to the last one finishing it.
+        """
+        host_ip = utils_net.get_host_ip_address(params)
+        servers = []
+        clients = []
+        samples = {}
+        windows = {}
+        errors = []
+        lock = threading.Lock()
+
+        def _run_client(vm, session, port):
+            cmd = "%s %s" % (set_port(ttcp_client_command, port), host_ip)
+            ttcp_output = []
+
+            def _ttcp_good():
+                start_time = time.time()
+                status, output = session.cmd_status_output(cmd)
+                end_time = time.time()
+                logging.debug(output)
+                if status:
+                    return False
+                ttcp_output.append(output)
+                windows[vm.name] = (start_time, end_time)
+                return True
+
+            sample = None
+            if utils_misc.wait_for(_ttcp_good, timeout=60):
+                sample = net_throughput.parse_ttcp_output(ttcp_output[-1])
+            lock.acquire()
+            try:
+                if not ttcp_output:
+                    errors.append("Failed to run ttcp command on %s."
+                                  % vm.name)
+                elif sample is None:
+                    errors.append("Can not find throughput in ttcp output "
+                                  "of %s." % vm.name)
+                else:
+                    samples[vm.name] = sample
+            finally:
+                lock.release()
+
+        # Log in before the round, so that it does not delay the clients
+        sessions = [session_pool.get_session(vm) for vm in vms]
+        try:
+            for index, vm in enumerate(vms):
+                port = base_port + index
+                servers.append(aexpect.Expect(
+                    set_port(ttcp_server_command, port)))
+                if not utils_misc.wait_for(lambda: is_port_listening(port),
+                                           timeout=30):
+                    raise error.TestError("ttcp server on port %d of the "
+                                          "host is not listening" % port)
+            for index, vm in enumerate(vms):
+                client = threading.Thread(target=_run_client,
+                                          args=(vm, sessions[index],
+                                                base_port + index))
+                client.start()
+                clients.append(client)
+            for client in clients:
+                client.join()
+        finally:
+            for server in servers:
+                server.close()
+        if errors:
+            raise error.TestFail("\n".join(errors))
+        round_seconds = (max([window[1] for window in windows.values()]) -
+                         min([window[0] for window in windows.values()]))
+        total_bytes = 0
+        for vm_name, sample in sorted(samples.items()):
+            results.add(sample["bytes_per_second"], vm=vm_name,
+                        iteration=iteration, bytes=sample["bytes"],
+                        seconds=sample["seconds"])
+            total_bytes += sample["bytes"]
+            logging.debug("ttcp of %s: %.2f MiB/s", vm_name,
+                          sample["bytes_per_second"] / 1048576)
+        aggregate_results.add(total_bytes / round_seconds,
+                              iteration=iteration, guests=len(samples),
+                              bytes=total_bytes, seconds=round_seconds)
+        logging.info("Iteration %d: %d guests sent %d bytes in %.2fs, "
+                     "aggregate %.2f MiB/s", iteration, len(samples),
+                     total_bytes, round_seconds,
+                     total_bytes / round_seconds / 1048576)
 
     host_session = aexpect.ShellSession("sh")
 
@@ -46,27 +193,59 @@ def run(test, params, env):
         end_time = current_time + timeout
         # Start the loop from current_time to end_time.
         while current_time < end_time:
-            for vm in vms:
-                session = vm.wait_for_login()
-                host_session.sendline(ttcp_server_command)
-
-                cmd = ("%s %s" % (ttcp_client_command, utils_net.get_host_ip_address(params)))
-
-                def _ttcp_good():
-                    status, output = session.cmd_status_output(cmd)
-                    logging.debug(output)
-                    if status:
-                        return False
-                    return True
-
-                if not utils_misc.wait_for(_ttcp_good, timeout=60):
-                    status, output = session.cmd_status_output(cmd)
-                    if status:
-                        raise error.TestFail("Failed to run ttcp command on guest.\n"
-                                             "Detail: %s." % output)
-                remote.handle_prompts(host_session, None, None, r"[\#\$]\s*$")
+            if concurrent:
+                run_concurrent_round(iteration)
                 current_time = int(time.time())
+            else:
+                for vm in vms:
+                    session = session_pool.get_session(vm)
+                    host_session.sendline(ttcp_server_command)
+
+                    cmd = ("%s %s" % (ttcp_client_command, utils_net.get_host_ip_address(params)))
+
+                    ttcp_output = []
+
+                    def _ttcp_good():
+                        status, output = session.cmd_status_output(cmd)
+                        logging.debug(output)
+                        if status:
+                            return False
+                        ttcp_output.append(output)
+                        return True
+
+                    if not utils_misc.wait_for(_ttcp_good, timeout=60):
+                        status, output = session.cmd_status_output(cmd)
+                        if status:
+                            raise error.TestFail("Failed to run ttcp command on guest.\n"
+                                                 "Detail: %s." % output)
+                        ttcp_output.append(output)
+                    remote.handle_prompts(host_session, None, None, r"[\#\$]\s*$")
+                    sample = net_throughput.parse_ttcp_output(ttcp_output[-1])
+                    if sample is None:
+                        logging.warning("Can not find throughput in ttcp output "
+                                        "of %s.", vm.name)
+                    else:
+                        results.add(sample["bytes_per_second"], vm=vm.name,
+                                    iteration=iteration, bytes=sample["bytes"],
+                                    seconds=sample["seconds"])
+                    current_time = int(time.time())
+            iteration += 1
+        if save_baseline and baseline_file:
+            if not results.save_baseline(baseline_file):
+                raise error.TestFail("No ttcp throughput to save as "
+                                     "baseline.")
+        elif baseline_file:
+            passed, message = results.compare_baseline(baseline_file,
+                                                       tolerance)
+            logging.info(message)
+            if not passed:
+                raise error.TestFail("Throughput regression of ttcp: %s"
+                                     % message)
     finally:
+        # Keep the samples of the finished iterations even if one failed.
+        results.save(test.resultsdir)
+        if concurrent:
+            aggregate_results.save(test.resultsdir)
         # Clean up.
         host_session.close()
-        session.close()
+        session_pool.close()
@@ -7,13 +7,16 @@ from autotest.client.shared import error
 from avocado.utils import process
 
 from virttest import data_dir
-from virttest import virsh
 from virttest import utils_test
 from virttest import utils_misc
 from virttest.libvirt_xml.vm_xml import VMXML
 from virttest.libvirt_xml.devices.disk import Disk
 from virttest.libvirt_xml.devices.input import Input
 
+from provider import bench_timer
+from provider import guest_session_pool
+from provider import virsh_backend
+
 
 def run(test, params, env):
     """
@@ -40,6 +43,20 @@ def run(test, params, env):
 
     tmp_dir = os.path.join(data_dir.get_tmp_dir(), "usb_hotplug_files")
 
+    # Record latency of every hotplug operation and guest-side check.
+    recorder = bench_timer.LatencyRecorder("usb_hotplug_latency")
+    # Run virsh commands by fork, persistent or bindings backend.
+    backend = virsh_backend.get_backend(params)
+    # Reuse guest sessions for polling.
+    session_pool = guest_session_pool.GuestSessionPool()
+
+    def monitor_command(cmd, options):
+        """
+        Run cmd in qemu monitor and record its latency by the command name.
+        """
+        return recorder.timed(cmd.split()[0], backend.qemu_monitor_command,
+                              vm_name, cmd, options=options)
+
     if control_file is not None:
         params["test_control_file"] = control_file
         params["main_vm"] = vm_name
@@ -53,21 +70,23 @@ def run(test, params, env):
         session.cmd("%s &" % command)
 
         def _is_iozone_running():
-            session_tmp = vm.wait_for_login()
+            session_tmp = session_pool.get_session(vm)
             return (not session_tmp.cmd_status("ps -ef|grep iozone|grep -v grep"))
 
         def _is_stress_running():
-            session_tmp = vm.wait_for_login()
+            session_tmp = session_pool.get_session(vm)
             return (not session_tmp.cmd_status("ps -ef|grep stress|grep -v grep"))
         if bench_type == "stress":
-            if not utils_misc.wait_for(_is_stress_running, timeout=160):
+            if not recorder.timed("guest_bench_check", utils_misc.wait_for,
+                                  _is_stress_running, timeout=160):
                 raise error.TestNAError("Failed to run stress in guest.\n"
                                         "Since we need to run a autotest of iozone "
                                         "in guest, so please make sure there are "
                                         "some necessary packages in guest,"
                                         "such as gcc, tar, bzip2")
         elif bench_type == "iozone":
-            if not utils_misc.wait_for(_is_iozone_running, timeout=160):
+            if not recorder.timed("guest_bench_check", utils_misc.wait_for,
+                                  _is_iozone_running, timeout=160):
                 raise error.TestNAError("Failed to run iozone in guest.\n"
                                         "Since we need to run a autotest of iozone "
                                         "in guest, so please make sure there are "
@@ -91,28 +110,28 @@ def run(test, params, env):
                         attach_cmd = "drive_add"
                         attach_cmd += (" 0 id=drive-usb-disk%s,if=none,file=%s" % (i, path))
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if keyboard:
                         attach_cmd = "device_add"
                         attach_cmd += " usb-kdb,bus=usb1.0,id=kdb"
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if mouse:
                         attach_cmd = "device_add"
                         attach_cmd += " usb-mouse,bus=usb1.0,id=mouse"
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if tablet:
                         attach_cmd = "device_add"
                         attach_cmd += " usb-tablet,bus=usb1.0,id=tablet"
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                 else:
@@ -128,7 +147,8 @@ def run(test, params, env):
                         attributes = {'type_name': "usb", 'bus': "1", 'port': "0"}
                         disk_xml.address = disk_xml.new_disk_address(**{"attrs": attributes})
 
-                        result = virsh.attach_device(vm_name, disk_xml.xml)
+                        result = recorder.timed("attach_device", backend.attach_device,
+                                                vm_name, disk_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if mouse:
@@ -137,7 +157,8 @@ def run(test, params, env):
                         attributes = {'type_name': "usb", 'bus': "1", 'port': "0"}
                         mouse_xml.address = mouse_xml.new_input_address(**{"attrs": attributes})
 
-                        result = virsh.attach_device(vm_name, mouse_xml.xml)
+                        result = recorder.timed("attach_device", backend.attach_device,
+                                                vm_name, mouse_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if tablet:
@@ -146,7 +167,8 @@ def run(test, params, env):
                         attributes = {'type_name': "usb", 'bus': "1", 'port': "0"}
                         tablet_xml.address = tablet_xml.new_input_address(**{"attrs": attributes})
 
-                        result = virsh.attach_device(vm_name, tablet_xml.xml)
+                        result = recorder.timed("attach_device", backend.attach_device,
+                                                vm_name, tablet_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if keyboard:
@@ -155,7 +177,8 @@ def run(test, params, env):
                         attributes = {'type_name': "usb", 'bus': "1", 'port': "0"}
                         kbd_xml.address = kbd_xml.new_input_address(**{"attrs": attributes})
 
-                        result = virsh.attach_device(vm_name, kbd_xml.xml)
+                        result = recorder.timed("attach_device", backend.attach_device,
+                                                vm_name, kbd_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
 
@@ -165,45 +188,49 @@ def run(test, params, env):
                         attach_cmd = "drive_del"
                         attach_cmd += (" drive-usb-disk")
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if mouse:
                         attach_cmd = "device_del"
                         attach_cmd += (" mouse")
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if keyboard:
                         attach_cmd = "device_del"
                         attach_cmd += (" keyboard")
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if tablet:
                         attach_cmd = "device_del"
                         attach_cmd += (" tablet")
 
-                        result = virsh.qemu_monitor_command(vm_name, attach_cmd, options=options)
+                        result = monitor_command(attach_cmd, options)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                 else:
                     if disk:
-                        result = virsh.detach_device(vm_name, disk_xml.xml)
+                        result = recorder.timed("detach_device", backend.detach_device,
+                                                vm_name, disk_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if mouse:
-                        result = virsh.detach_device(vm_name, mouse_xml.xml)
+                        result = recorder.timed("detach_device", backend.detach_device,
+                                                vm_name, mouse_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if keyboard:
-                        result = virsh.detach_device(vm_name, kbd_xml.xml)
+                        result = recorder.timed("detach_device", backend.detach_device,
+                                                vm_name, kbd_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
                     if tablet:
-                        result = virsh.detach_device(vm_name, tablet_xml.xml)
+                        result = recorder.timed("detach_device", backend.detach_device,
+                                                vm_name, tablet_xml.xml)
                         if result.exit_status:
                             raise process.CmdError(result.command, result)
         except process.CmdError, e:
@@ -211,6 +238,10 @@ def run(test, params, env):
                 raise error.TestFail("failed to attach device.\n"
                                      "Detail: %s." % result)
     finally:
+        recorder.log_summary()
+        recorder.save(test.resultsdir)
+        backend.close()
+        session_pool.close()
         if os.path.isdir(tmp_dir):
             shutil.rmtree(tmp_dir)
         vm_xml_backup.sync()
@@ -1,5 +1,10 @@
-import logging
+import os
 import re
+import json
+import time
+import logging
+
+import aexpect
 
 from autotest.client.shared import error
 
@@ -8,6 +13,8 @@ from virttest import libvirt_vm
 from virttest import utils_test
 from virttest.utils_test import libvirt
 
+from provider import bench_timer
+
 
 def run(test, params, env):
     """
@@ -18,6 +25,11 @@ def run(test, params, env):
     2.Perform virsh setvcpus operation.
     3.Recover test environment.
     4.Confirm the test result.
+
+    In sweep mode, vcpus are hot-added from setvcpus_min_count up to
+    setvcpus_sweep_max, by each batch size in setvcpus_sweep_batches,
+    and the time from the virsh call to all the new vcpus online in guest
+    is reported against the vcpu count.
     """
 
     vm_name = params.get("main_vm")
@@ -29,6 +41,13 @@ def run(test, params, env):
     add_by_virsh = ("yes" == params.get("add_by_virsh"))
     del_by_virsh = ("yes" == params.get("del_by_virsh"))
     test_set_max = max_count * 2
+    sweep = ("yes" == params.get("setvcpus_sweep", "no"))
+    sweep_max = int(params.get("setvcpus_sweep_max", "240"))
+    sweep_batches = [int(batch) for batch in
+                     params.get("setvcpus_sweep_batches", "1").split()]
+    online_timeout = int(params.get("setvcpus_online_timeout", "60"))
+    if sweep:
+        test_set_max = sweep_max
 
     # Save original configuration
     orig_config_xml = libvirt_xml.VMXML.new_from_inactive_dumpxml(vm_name)
@@ -52,15 +71,100 @@ def run(test, params, env):
     else:
         utils_test.load_stress("iozone_in_vms", load_vms, params)
 
+    # Record latency of every hotplug operation and guest-side check.
+    recorder = bench_timer.LatencyRecorder("vcpu_hotplug_latency")
     session = vm.wait_for_login()
+
+    def wait_vcpus_online(guest_session, first, last):
+        """
+        Wait in guest until vcpu first to last are all online.
+
+        :return: True if all of them are online before timeout
+        """
+        wait_cmd = ("for i in $(seq %d %d); do "
+                    "f=/sys/devices/system/cpu/cpu$i/online; "
+                    "until [ \"$(cat $f 2>/dev/null)\" = 1 ]; do "
+                    "sleep 0.01; done; done" % (first, last))
+        try:
+            status = guest_session.cmd_status(wait_cmd,
+                                              timeout=online_timeout)
+        except aexpect.ShellTimeoutError:
+            return False
+        return status == 0
+
+    def run_sweep():
+        """
+        Hot-add vcpus by each batch size up to sweep_max and record the
+        latency against the vcpu count.
+        """
+        sweep_results = []
+        sweep_session = vm.wait_for_login()
+        for batch in sweep_batches:
+            current = min_count
+            while current < sweep_max:
+                target = min(current + batch, sweep_max)
+                start_time = time.time()
+                add_result = libvirt.hotplug_domain_vcpu(vm_name, target,
+                                                         add_by_virsh)
+                virsh_latency = time.time() - start_time
+                if add_result.exit_status:
+                    if add_result.stderr.count("support"):
+                        raise error.TestNAError("No need to test any more:"
+                                                "\n %s" %
+                                                add_result.stderr.strip())
+                    raise error.TestFail("Failed to hotplug vcpus to %d:\n %s"
+                                         % (target,
+                                            add_result.stderr.strip()))
+                if not wait_vcpus_online(sweep_session, current, target - 1):
+                    raise error.TestFail("CPU%d-%d are not online %ss after "
+                                         "hotplug" % (current, target - 1,
+                                                      online_timeout))
+                online_latency = time.time() - start_time
+                recorder.record("vcpu_add_batch%d" % batch, virsh_latency)
+                recorder.record("vcpu_online_batch%d" % batch,
+                                online_latency)
+                sweep_results.append({"batch": batch,
+                                      "vcpus": target,
+                                      "virsh_latency": virsh_latency,
+                                      "online_latency": online_latency})
+                logging.debug("Hotplug %d vcpus to %d: virsh %.3fs, "
+                              "online %.3fs", target - current, target,
+                              virsh_latency, online_latency)
+                current = target
+            # Go back to min_count for the next batch size, restart the
+            # guest if vcpus can not be unplugged.
+            del_result = libvirt.hotplug_domain_vcpu(vm_name, min_count,
+                                                     del_by_virsh,
+                                                     hotplug=False)
+            if del_result.exit_status:
+                logging.debug("Unplug vcpus failed, restart guest: %s",
+                              del_result.stderr.strip())
+                sweep_session.close()
+                vm.destroy()
+                vm.start()
+                sweep_session = vm.wait_for_login()
+        sweep_session.close()
+        result_path = os.path.join(test.resultsdir, "vcpu_hotplug_sweep.json")
+        result_file = open(result_path, "w")
+        try:
+            json.dump(sweep_results, result_file, indent=4)
+        finally:
+            result_file.close()
+        for item in sweep_results:
+            logging.info("batch %3d vcpus %3d: virsh %.3fs online %.3fs",
+                         item["batch"], item["vcpus"],
+                         item["virsh_latency"], item["online_latency"])
     try:
         # Clear dmesg before set vcpu
         session.cmd("dmesg -c")
+        if sweep:
+            run_sweep()
+            return
         for i in range(test_times):
             # 1. Add vcpu
-            add_result = libvirt.hotplug_domain_vcpu(vm_name,
-                                                     max_count,
-                                                     add_by_virsh)
+            add_result = recorder.timed("vcpu_add",
+                                        libvirt.hotplug_domain_vcpu,
+                                        vm_name, max_count, add_by_virsh)
             add_status = add_result.exit_status
             # 1.1 check add status
             if add_status:
@@ -70,7 +174,8 @@ def run(test, params, env):
                 raise error.TestFail("Test failed for:\n %s"
                                      % add_result.stderr.strip())
             # 1.2 check dmesg
-            domain_add_dmesg = session.cmd_output("dmesg -c")
+            domain_add_dmesg = recorder.timed("guest_dmesg",
+                                              session.cmd_output, "dmesg -c")
             dmesg1 = "CPU%d has been hot-added" % (max_count - 1)
             dmesg2 = "CPU %d got hotplugged" % (max_count - 1)
             if (not domain_add_dmesg.count(dmesg1) and
@@ -80,7 +185,8 @@ def run(test, params, env):
             # 1.3 check cpu related file
             online_cmd = "cat /sys/devices/system/cpu/cpu%d/online" \
                          % (max_count - 1)
-            st, ot = session.cmd_status_output(online_cmd)
+            st, ot = recorder.timed("guest_online_check",
+                                    session.cmd_status_output, online_cmd)
             if st:
                 raise error.TestFail("Cannot find CPU%d after hotplug"
                                      % (max_count - 1))
@@ -95,9 +201,11 @@ def run(test, params, env):
                                      "/proc/interrupts when it's online:%s"
                                      % ((int(max_count) - 1), inter_on_output))
             # 1.6 offline vcpu
-            off_st = session.cmd_status("echo 0 > "
-                                        "/sys/devices/system/cpu/cpu%d/online"
-                                        % (max_count - 1))
+            off_st = recorder.timed("guest_offline",
+                                    session.cmd_status,
+                                    "echo 0 > "
+                                    "/sys/devices/system/cpu/cpu%d/online"
+                                    % (max_count - 1))
             if off_st:
                 raise error.TestFail("Set cpu%d offline failed!"
                                      % (max_count - 1))
@@ -108,10 +216,10 @@ def run(test, params, env):
                                      " when it's offline"
                                      % (int(max_count) - 1))
             # 2. Del vcpu
-            del_result = libvirt.hotplug_domain_vcpu(vm_name,
-                                                     min_count,
-                                                     del_by_virsh,
-                                                     hotplug=False)
+            del_result = recorder.timed("vcpu_del",
+                                        libvirt.hotplug_domain_vcpu,
+                                        vm_name, min_count, del_by_virsh,
+                                        hotplug=False)
             del_status = del_result.exit_status
             if del_status:
                 logging.info("del_result: %s" % del_result.stderr.strip())
@@ -135,7 +243,8 @@ def run(test, params, env):
                 # besides above, regard it failed
                 raise error.TestFail("Test fail for:\n %s"
                                      % del_result.stderr.strip())
-            domain_del_dmesg = session.cmd_output("dmesg -c")
+            domain_del_dmesg = recorder.timed("guest_dmesg",
+                                              session.cmd_output, "dmesg -c")
             if not domain_del_dmesg.count("CPU %d is now offline"
                                           % (max_count - 1)):
                 raise error.TestFail("Cannot find hot-unplug info in dmesg: %s"
@@ -143,8 +252,13 @@ def run(test, params, env):
     except error.TestNAError:
         # So far, QEMU doesn't support unplug vcpu,
         # unplug operation will encounter kind of errors.
-        pass
+        # The sweep restarts the guest instead of unplugging, so an
+        # unsupported hotplug there really skips the test.
+        if sweep:
+            raise
     finally:
+        recorder.log_summary()
+        recorder.save(test.resultsdir)
         session.close()
         # Cleanup
         orig_config_xml.sync()
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import re
@@ -36,6 +37,12 @@ from virttest.utils_net import block_specific_ip_by_time
 from virttest.utils_net import check_listening_port_remote_by_service
 from virttest.utils_test import libvirt
 
+from provider import guest_dirty_pages
+from provider import migration_progress
+from provider import migration_results
+from provider import net_throughput
+from provider import remote_pool
+
 MIGRATE_RET = False
 
 
@@ -75,10 +82,9 @@ def create_destroy_pool_on_remote(action, params):
         pool_type = params.get("target_pool_type", "dir")
         pool_target = params.get("pool_target")
         cmd = "mkdir -p %s" % pool_target
-        session = remote.wait_for_login("ssh", remote_ip, 22,
-                                        remote_user, remote_pwd, prompt)
-        status, output = session.cmd_status_output(cmd, timeout)
-        session.close()
+        status, output = remote_pool.run_remote_cmd(cmd, remote_ip,
+                                                    remote_user, remote_pwd,
+                                                    timeout, prompt=prompt)
         if status:
             new_session.close_session()
             raise exceptions.TestFail("Run command '%s' on remote host '%s'"
@@ -154,9 +160,12 @@ def check_output(output_msg, params):
                                                (key, value, output_msg))
 
 
-def migrate_vm(params):
+def migrate_vm(params, result_dir=None):
     """
     Connect libvirt daemon
+
+    :param params: Test params
+    :param result_dir: Directory to save the migration progress samples
     """
     vm_name = params.get("vm_name_to_migrate")
     if vm_name is None:
@@ -178,12 +187,39 @@ def migrate_vm(params):
 
     logging.info("Prepare migrate %s", vm_name)
     global MIGRATE_RET
-    MIGRATE_RET, mig_output = libvirt.do_migration(vm_name, uri, extra,
-                                                   auth_pwd, auth_user,
-                                                   options,
-                                                   virsh_patterns,
-                                                   su_user, timeout,
-                                                   extra_opt)
+    # Do not take the result of the last migration for this one
+    MIGRATE_RET = False
+    # URI of the host the vm is on, None means the local host
+    source_uri = params.get("migration_progress_uri")
+    guest_size = migration_results.get_guest_size(vm_name, source_uri)
+    samplers = migration_progress.create_samplers([vm_name], params,
+                                                  source_uri)
+    start_time = time.time()
+    try:
+        MIGRATE_RET, mig_output = libvirt.do_migration(vm_name, uri, extra,
+                                                       auth_pwd, auth_user,
+                                                       options,
+                                                       virsh_patterns,
+                                                       su_user, timeout,
+                                                       extra_opt)
+    finally:
+        # Failed migrations are recorded too
+        migration_results.record_migration(params, "migrate_vm", vm_name,
+                                           MIGRATE_RET,
+                                           time.time() - start_time,
+                                           "%s %s" % (options, extra),
+                                           source_uri, guest_size,
+                                           dest_uri=uri)
+        not_converged = migration_progress.report_samplers(samplers,
+                                                           MIGRATE_RET,
+                                                           params,
+                                                           result_dir)
+
+    if (not_converged and status_error == "no" and
+            params.get("migration_fail_not_converged", "no") == "yes"):
+        raise exceptions.TestFail("Migration of %s did not converge: %s"
+                                  % (vm_name,
+                                     "; ".join(not_converged[0]["reasons"])))
 
     if status_error == "no":
         if MIGRATE_RET:
@@ -667,19 +703,24 @@ def check_virsh_command_and_option(command, option=None):
 
 def run_remote_cmd(command, server_ip, server_user, server_pwd,
                    ret_status_output=True, ret_session_status_output=False,
-                   timeout=60, client="ssh", port="22", prompt=r"[\#\$]\s*$"):
+                   timeout=60, client="ssh", port="22", prompt=r"[\#\$]\s*$",
+                   background=False):
     """
     Run command on remote host
+
+    The command runs by a pooled session of the host, unless the session
+    is returned, then the caller owns and closes it. With background, the
+    session is closed after the command instead of reused.
     """
     logging.info("Execute '%s' on %s", command, server_ip)
-    session = remote.wait_for_login(client, server_ip, port,
-                                    server_user, server_pwd,
-                                    prompt)
-    status, output = session.cmd_status_output(command, timeout)
-
     if ret_status_output:
-        session.close()
-        return (status, output)
+        return remote_pool.run_remote_cmd(command, server_ip, server_user,
+                                          server_pwd, timeout, client, port,
+                                          prompt, background)
+
+    session = remote_pool.get_session(server_ip, server_user, server_pwd,
+                                      client, port, prompt)
+    status, output = session.cmd_status_output(command, timeout)
 
     if ret_session_status_output:
         return (session, status, output)
@@ -752,6 +793,100 @@ def setup_netsever_and_launch_netperf(params):
         return (False, n_client, n_server)
 
 
+def start_netperf_interim(n_client, params):
+    """
+    Run one more netperf on the client which prints interim results to a
+    file, to follow the throughput during migration.
+
+    :param n_client: NetperfClient got by setup_netsever_and_launch_netperf
+    :param params: Test params
+    :return: Tuple of (pid, result file) of the netperf on the client
+    """
+    server_ip = params.get("server_ip")
+    client_ip = params.get("client_ip")
+    client_user = params.get("client_user")
+    client_pwd = params.get("client_pwd")
+    interval = params.get("netperf_interim_interval", "1")
+    duration = params.get("netperf_test_duration", "60")
+    test_protocol = params.get("test_protocols", "TCP_STREAM")
+    result_file = params.get("netperf_interim_file",
+                             "/var/tmp/netperf_interim.log")
+
+    # netperf must be built with --enable-demo to support -D
+    cmd = ("nohup %s -H %s -D %s -l %s -t %s > %s 2>&1 & echo $!"
+           % (n_client.netperf_path, server_ip, interval, duration,
+              test_protocol, result_file))
+    status, output = run_remote_cmd(cmd, client_ip, client_user, client_pwd,
+                                    background=True)
+    if status:
+        raise exceptions.TestError("Failed to run '%s' on %s: %s"
+                                   % (cmd, client_ip, output))
+    return output.strip().splitlines()[-1], result_file
+
+
+def collect_netperf_interim(netperf_interim, params, start_time, end_time,
+                            result_dir=None):
+    """
+    Stop the netperf started by start_netperf_interim, report the
+    throughput dip caused by migration and the recovery time.
+
+    :param netperf_interim: Tuple got by start_netperf_interim
+    :param params: Test params
+    :param start_time: Time the migration started
+    :param end_time: Time the migration finished
+    :param result_dir: Directory to save the results
+    :return: Dict got by net_throughput.get_migration_impact
+    """
+    client_ip = params.get("client_ip")
+    client_user = params.get("client_user")
+    client_pwd = params.get("client_pwd")
+    recovery_wait = int(params.get("netperf_interim_recovery_wait", 30))
+    recovery_ratio = float(params.get("netperf_recovery_ratio", 0.9))
+    pid, result_file = netperf_interim
+
+    # Give the throughput time to recover after migration
+    logging.info("Sleep %ss to follow the throughput after migration",
+                 recovery_wait)
+    time.sleep(recovery_wait)
+    cmd = "kill %s 2>/dev/null; cat %s" % (pid, result_file)
+    status, output = run_remote_cmd(cmd, client_ip, client_user, client_pwd)
+    if status:
+        raise exceptions.TestError("Failed to get netperf interim results "
+                                   "from %s: %s" % (client_ip, output))
+    samples = net_throughput.parse_netperf_interim(output)
+    impact = net_throughput.get_migration_impact(samples, start_time,
+                                                 end_time, recovery_ratio)
+    if impact["dip"] is None:
+        logging.warning("Not enough netperf interim results around the "
+                        "migration: %s", output)
+    else:
+        unit = samples[0]["unit"]
+        logging.info("Netperf throughput %.2f %s before migration, dipped "
+                     "to %.2f %s (%.2f%%) %.2fs after migration started",
+                     impact["baseline"], unit, impact["dip"], unit,
+                     impact["dip_percent"], impact["dip_time"])
+        if impact["recovery_time"] is None:
+            logging.warning("Netperf throughput did not recover to %s%% "
+                            "of the baseline", recovery_ratio * 100)
+        else:
+            logging.info("Netperf throughput recovered %.2fs after "
+                         "migration started, migration took %.2fs",
+                         impact["recovery_time"], impact["migration_time"])
+    if result_dir:
+        results = net_throughput.ThroughputResults("netperf_migration")
+        for sample in samples:
+            results.add(sample["throughput"], time=sample["time"],
+                        unit=sample["unit"])
+        results.save(result_dir)
+        result_path = os.path.join(result_dir, "netperf_migration_impact.json")
+        result_file = open(result_path, "w")
+        try:
+            json.dump(impact, result_file, indent=4, sort_keys=True)
+        finally:
+            result_file.close()
+    return impact
+
+
 def cleanup(objs_list):
     """
     Clean up test environment
@@ -1090,6 +1225,8 @@ def run(test, params, env):
     n_client_c = None
     n_server_s = None
     n_client_s = None
+    netperf_interim = None
+    dirty_pages_workloads = {}
     need_mkswap = False
     LOCAL_SELINUX_ENFORCING = True
     REMOTE_SELINUX_ENFORCING = True
@@ -1705,7 +1842,7 @@ def run(test, params, env):
         if remote_port:
             cmd = "nc -l -p %s &" % remote_port
             status, output = run_remote_cmd(cmd, server_ip, server_user,
-                                            server_pwd)
+                                            server_pwd, background=True)
             if status:
                 raise exceptions.TestFail("Failed to run '%s' on remote: %s"
                                           % (cmd, output))
@@ -1759,7 +1896,10 @@ def run(test, params, env):
                                           % (run_cmd_in_vm, output))
             logging.debug(output)
 
-        if stress_args:
+        if stress_type == "dirty_pages_in_vms":
+            dirty_pages_workloads = guest_dirty_pages.start_workloads(
+                [vm], test_dict)
+        elif stress_args:
             s_list = stress_type.split("_")
 
             if s_list and s_list[-1] == "vms":
@@ -1819,6 +1959,12 @@ def run(test, params, env):
                 raise exceptions.TestError("Can not start netperf on %s"
                                            % client_ip)
 
+            if test_dict.get("netperf_interim_results", "no") == "yes":
+                netperf_interim = start_netperf_interim(n_client_c, test_dict)
+                # Get the baseline throughput before migration
+                time.sleep(int(test_dict.get("netperf_interim_baseline_time",
+                                             10)))
+
         speed = test_dict.get("set_migration_speed")
         if speed:
             cmd = "migrate-setspeed"
@@ -2123,7 +2269,12 @@ def run(test, params, env):
             test_dict["vm_name_to_migrate"] = target_vm_name
 
         if run_migr_front:
-            migrate_vm(test_dict)
+            migration_start = time.time()
+            migrate_vm(test_dict, test.resultsdir)
+            if netperf_interim:
+                collect_netperf_interim(netperf_interim, test_dict,
+                                        migration_start, time.time(),
+                                        test.resultsdir)
 
         if target_vm_name:
             # Check the libvirtd service is running on both hosts.
@@ -2138,9 +2289,8 @@ def run(test, params, env):
             try:
                 logging.debug("Remote libvirtd service should still be running."
                               "Check it...")
-                session = remote.wait_for_login('ssh', server_ip, '22',
-                                                server_user, server_pwd,
-                                                r"[\#\$]\s*$")
+                session = remote_pool.get_session(server_ip, server_user,
+                                                  server_pwd)
                 libvirtd = utils_libvirtd.Libvirtd(session=session)
                 if not libvirtd.is_running():
                     raise exceptions.TestFail("Remote libvirtd service is"
@@ -2170,8 +2320,10 @@ def run(test, params, env):
             except (process.CmdError, remote.SCPError), detail:
                 raise exceptions.TestError(detail)
             finally:
-                session.close()
-                remote_session.close_session()
+                if session:
+                    remote_pool.release_session(session)
+                if remote_session:
+                    remote_session.close_session()
 
         set_tgt_pm_suspend_tgt = test_dict.get("set_tgt_pm_suspend_target")
         set_tgt_pm_wakeup = "yes" == test_dict.get("set_tgt_pm_wakeup", "no")
@@ -2213,21 +2365,19 @@ def run(test, params, env):
             # Check the image size on target host after migration
             local_disk_image = test_dict.get("local_disk_image")
             remote_image_list.append(local_disk_image)
-            remote_runner = remote.RemoteRunner(host=server_ip,
-                                                username=server_user,
-                                                password=server_pwd)
-            cmdResult = remote_runner.run(cmd, ignore_status=True)
-            if cmdResult.exit_status:
+            status, output = run_remote_cmd(cmd, server_ip, server_user,
+                                            server_pwd)
+            if status:
                 raise exceptions.TestError("Failed to run '%s' on remote: %s"
-                                           % (cmd, cmdResult))
+                                           % (cmd, output))
             local_disk_size = test_dict.get("local_disk_size")
-            if cmdResult.stdout.strip() != local_disk_size:
+            if output.strip() != local_disk_size:
                 raise exceptions.TestFail("Image location: %s \n"
                                           "The image sizes are not equal.\n"
                                           "Remote size is %s\n"
                                           "Local size is %s"
                                           % (local_disk_image,
-                                             cmdResult.stdout.strip(),
+                                             output.strip(),
                                              local_disk_size))
 
         if cmd and check_image_size and not support_precreation:
@@ -2480,6 +2630,7 @@ def run(test, params, env):
         if stress_type == "stress_on_host":
             logging.info("Unload stress from host")
             utils_test.unload_stress(stress_type, [vm])
+        guest_dirty_pages.stop_workloads([vm], dirty_pages_workloads)
 
         if HUGETLBFS_MOUNT:
             cmds = ["umount -l %s" % remote_hugetlbfs_path,
@@ -2520,3 +2671,4 @@ def run(test, params, env):
             n_client_s.package.env_cleanup(True)
 
         cleanup(objs_list)
+        remote_pool.cleanup()
@@ -6,7 +6,6 @@ import commands
 from autotest.client.shared import error
 from autotest.client.shared import utils
 
-from virttest import remote
 from virttest.utils_sasl import SASL
 from virttest.utils_conn import SSHConnection
 from virttest.utils_conn import TCPConnection
@@ -18,6 +17,7 @@ from virttest.utils_test.libvirt import remotely_control_libvirtd
 from virttest.utils_test.libvirt import connect_libvirtd
 
 from provider import libvirt_version
+from provider import remote_pool
 
 
 def remote_access(params):
@@ -98,9 +98,12 @@ def compare_virt_version(server_ip, server_user, server_pwd):
     if status:
         raise error.TestError(output_local)
     # query libvirt version on remote host
-    session = remote.wait_for_login(client, server_ip, port,
-                                    server_user, server_pwd, prompt)
-    status, output_remote = session.cmd_status_output(query_cmd)
+    status, output_remote = remote_pool.run_remote_cmd(query_cmd, server_ip,
+                                                       server_user,
+                                                       server_pwd,
+                                                       client=client,
+                                                       port=port,
+                                                       prompt=prompt)
     if status:
         raise error.TestError(output_remote)
     # compare libvirt version between local and remote host
@@ -254,16 +257,12 @@ def run(test, params, env):
     logging.debug("The final test dict:\n<%s>", test_dict)
 
     if virsh_cmd == "start" and transport != "unix":
-        session = remote.wait_for_login("ssh", server_ip, "22", "root",
-                                        server_pwd, "#")
         cmd = "virsh domstate %s" % vm_name
-        status, output = session.cmd_status_output(cmd)
+        status, output = remote_pool.run_remote_cmd(cmd, server_ip, "root",
+                                                    server_pwd, prompt="#")
         if status:
-            session.close()
             raise error.TestNAError(output)
 
-        session.close()
-
     try:
         # setup IPv6
         if config_ipv6 == "yes":
@@ -399,3 +398,4 @@ def run(test, params, env):
             os.unlink(polkit_pkla)
 
         cleanup(objs_list)
+        remote_pool.cleanup()
@@ -1,6 +1,8 @@
 import os
+import json
 import time
 import logging
+import threading
 
 import aexpect
 
@@ -12,13 +14,347 @@ from virttest import virsh
 from virttest import remote
 from virttest import utils_libvirtd
 from virttest.libvirt_xml import vm_xml
+from virttest.libvirt_xml.devices.controller import Controller
 from virttest.utils_test import libvirt
 from virttest.staging.service import Factory
 from virttest.staging import lv_utils
 
+from provider import disk_generator
 from provider import libvirt_version
 
 
+def get_target_name(prefix, index):
+    """
+    Get the target dev name of a disk index, like vdb for 1 and vdaa for 26.
+    """
+    name = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        name = chr(ord("a") + rem) + name
+    return prefix + name
+
+
+def get_free_targets(vm_name, count, prefix="sd"):
+    """
+    Get target dev names of a bus not used by the disks of a vm.
+    """
+    used = [disk.target["dev"] for disk in
+            vm_xml.VMXML.new_from_dumpxml(vm_name).get_devices("disk")]
+    targets = []
+    index = 0
+    while len(targets) < count:
+        target = get_target_name(prefix, index)
+        if target not in used:
+            targets.append(target)
+        index += 1
+    return targets
+
+
+def set_scsi_controller(vmxml):
+    """
+    Make sure the vm has a virtio-scsi controller of index 0 to hotplug
+    the disks on, so they do not need a PCI slot each.
+
+    :param vmxml: VMXML of the shut off vm, synced if changed
+    :raise: TestNAError if controller 0 is another scsi model
+    """
+    for controller in vmxml.get_devices(device_type="controller"):
+        if controller.type == "scsi" and controller.index == "0":
+            if controller.model != "virtio-scsi":
+                raise error.TestNAError("scsi controller 0 is %s, "
+                                        "virtio-scsi is needed" %
+                                        controller.model)
+            return
+    scsi_controller = Controller("controller")
+    scsi_controller.type = "scsi"
+    scsi_controller.index = "0"
+    scsi_controller.model = "virtio-scsi"
+    vmxml.add_device(scsi_controller)
+    vmxml.sync()
+
+
+def get_guest_serials(session):
+    """
+    Get the serials of the block devices in guest.
+
+    Serials of scsi disks are in the unit serial number VPD page, whose
+    binary header is dropped.
+
+    :return: Dict of {serial: device name}
+    """
+    cmd = ("for dev in /sys/block/*; do echo ${dev##*/} "
+           "$(tr -dc '[:alnum:]' 2>/dev/null < $dev/device/vpd_pg80 || "
+           "cat $dev/serial 2>/dev/null); done")
+    serials = {}
+    for line in session.cmd_output(cmd).splitlines():
+        items = line.split()
+        if len(items) == 2:
+            serials[items[1]] = items[0]
+    return serials
+
+
+def run_tasks(func, tasks, concurrent):
+    """
+    Run func on each task, all at once by threads or one after another.
+    """
+    if not concurrent:
+        for task in tasks:
+            func(task)
+        return
+    threads = [threading.Thread(target=func, args=(task,)) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def wait_guest_devices(sessions, tasks, key, present, timeout, step=0.1):
+    """
+    Poll the block devices in guests until the disks of tasks appear or
+    disappear, and save the seconds since their command started.
+
+    :param sessions: Dict of {vm_name: session}
+    :param tasks: List of task dicts of vm_name, serial and <key>_start
+    :param key: Key to save the seconds to, like "appear"
+    :param present: Wait for the disks to appear or disappear
+    :param timeout: Seconds to wait
+    """
+    pending = [task for task in tasks if task.get("%s_start" % key)]
+    end_time = time.time() + timeout
+    while pending and time.time() < end_time:
+        for vm_name, session in sessions.items():
+            serials = get_guest_serials(session)
+            now = time.time()
+            for task in [task for task in pending
+                         if task["vm_name"] == vm_name]:
+                if (task["serial"] in serials) == present:
+                    task[key] = now - task["%s_start" % key]
+                    pending.remove(task)
+        if pending:
+            time.sleep(step)
+    for task in pending:
+        task[key] = None
+
+
+def get_latency_stats(values):
+    """
+    Get count, mean, p50, p99 and max of a list of seconds.
+    """
+    values = sorted([value for value in values if value is not None])
+    if not values:
+        return {"count": 0}
+    return {"count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": values[int(0.5 * (len(values) - 1))],
+            "p99": values[int(0.99 * (len(values) - 1))],
+            "max": values[-1]}
+
+
+def check_hotplug_leaks(vm, images, serials, disk_count):
+    """
+    Check whether anything of the detached disks is left.
+
+    :param vm: VM object
+    :param images: Paths of the images of the vm's disks
+    :param serials: Serials of the vm's disks
+    :param disk_count: Count of disks in the live xml before attaching
+    :return: List of leaks found
+    """
+    leaks = []
+    count = vm_xml.VMXML.get_disk_count(vm.name)
+    if count != disk_count:
+        leaks.append("%d disks in live xml, expect %d" % (count, disk_count))
+    result = virsh.qemu_monitor_command(vm.name, "info block", "--hmp",
+                                        ignore_status=True)
+    for image in images:
+        if image in result.stdout:
+            leaks.append("qemu drive of %s" % image)
+    fd_dir = "/proc/%s/fd" % vm.get_pid()
+    opened = []
+    for fd in os.listdir(fd_dir):
+        try:
+            opened.append(os.readlink(os.path.join(fd_dir, fd)))
+        except OSError:
+            # The fd was closed meanwhile
+            continue
+    for image in images:
+        if image in opened:
+            leaks.append("qemu fd of %s" % image)
+    session = vm.wait_for_login()
+    try:
+        guest_serials = get_guest_serials(session)
+    finally:
+        session.close()
+    for serial in serials:
+        if serial in guest_serials:
+            leaks.append("guest device %s of %s" % (guest_serials[serial],
+                                                    serial))
+    return leaks
+
+
+def hotplug_stress(test, params, env):
+    """
+    Hotplug and unplug many disks on one or more vms, concurrently or in
+    rapid succession. The disks are scsi ones on one virtio-scsi
+    controller, since a typical guest has not enough free PCI slots for
+    dozens of virtio-blk disks.
+
+    1) Start the vms, create stress_disk_count images for each of them.
+    2) In each round, attach all disks by virsh attach-disk, take the
+       command latency and the time until the guest sees the disk in
+       /sys/block.
+    3) Detach all disks by virsh detach-disk, take the command latency
+       and the time until the disk is gone in guest.
+    4) Check no disk, qemu drive, qemu fd or guest device is left after
+       each round.
+    5) Save the latencies, fail if a hotplug failed, something leaked or
+       a p99 latency is over its limit.
+    """
+    if params.get("stress_all_vms", "no") == "yes":
+        vm_names = params.get("vms").split()
+    else:
+        vm_names = [params.get("main_vm")]
+    disk_count = int(params.get("stress_disk_count", 24))
+    rounds = int(params.get("stress_rounds", 3))
+    concurrent = params.get("stress_mode", "concurrent") == "concurrent"
+    disk_size = params.get("stress_disk_size", "16M")
+    at_options = params.get("at_dt_disk_at_options", "")
+    dt_options = params.get("at_dt_disk_dt_options", "")
+    device_timeout = float(params.get("stress_device_timeout", 60))
+    max_latencies = {"attach": params.get("stress_max_attach_latency"),
+                     "appear": params.get("stress_max_appear_latency"),
+                     "detach": params.get("stress_max_detach_latency")}
+
+    vms = [env.get_vm(vm_name) for vm_name in vm_names]
+    backup_xmls = {}
+    sessions = {}
+    tasks = []
+    try:
+        for vm in vms:
+            if vm.is_alive():
+                vm.destroy(gracefully=False)
+            backup_xmls[vm.name] = vm_xml.VMXML.new_from_inactive_dumpxml(
+                vm.name)
+            set_scsi_controller(backup_xmls[vm.name].copy())
+            vm.start()
+            sessions[vm.name] = vm.wait_for_login()
+            targets = get_free_targets(vm.name, disk_count)
+            for index, target in enumerate(targets):
+                image = os.path.join(test.tmpdir, "stress_%s_%d.img" %
+                                     (vm.name, index))
+                disk_generator.create_disk(image, disk_size, "raw")
+                tasks.append({"vm_name": vm.name,
+                              "image": image,
+                              "target": target,
+                              "serial": "stress%d" % index})
+        disk_counts = dict([(vm.name, vm_xml.VMXML.get_disk_count(vm.name))
+                            for vm in vms])
+
+        def attach(task):
+            task["attach_start"] = time.time()
+            result = virsh.attach_disk(task["vm_name"], task["image"],
+                                       task["target"],
+                                       "%s --targetbus scsi --serial %s" %
+                                       (at_options, task["serial"]),
+                                       ignore_status=True, debug=True)
+            task["attach"] = time.time() - task["attach_start"]
+            if result.exit_status:
+                task["attach_start"] = None
+                task["error"] = result.stderr.strip()
+
+        def detach(task):
+            task["detach_start"] = time.time()
+            result = virsh.detach_disk(task["vm_name"], task["target"],
+                                       dt_options, ignore_status=True,
+                                       debug=True)
+            task["detach"] = time.time() - task["detach_start"]
+            if result.exit_status:
+                task["detach_start"] = None
+                task["error"] = result.stderr.strip()
+
+        results = []
+        leaks = []
+        for round_index in range(rounds):
+            round_tasks = [dict(task) for task in tasks]
+            run_tasks(attach, round_tasks, concurrent)
+            wait_guest_devices(sessions, round_tasks, "appear", True,
+                               device_timeout)
+            run_tasks(detach, [task for task in round_tasks
+                               if task.get("attach_start")], concurrent)
+            wait_guest_devices(sessions, round_tasks, "disappear", False,
+                               device_timeout)
+            for vm in vms:
+                vm_tasks = [task for task in round_tasks
+                            if task["vm_name"] == vm.name]
+                for leak in check_hotplug_leaks(
+                        vm, [task["image"] for task in vm_tasks],
+                        [task["serial"] for task in vm_tasks],
+                        disk_counts[vm.name]):
+                    leaks.append("round %d %s: %s" % (round_index, vm.name,
+                                                      leak))
+            for task in round_tasks:
+                task["round"] = round_index
+            results.extend(round_tasks)
+            logging.info("Round %d: attach %s, appear %s, detach %s",
+                         round_index,
+                         get_latency_stats([task.get("attach")
+                                            for task in round_tasks]),
+                         get_latency_stats([task.get("appear")
+                                            for task in round_tasks]),
+                         get_latency_stats([task.get("detach")
+                                            for task in round_tasks]))
+            if leaks:
+                # Later rounds would fail on the leftovers
+                break
+    finally:
+        for session in sessions.values():
+            session.close()
+        for vm in vms:
+            if vm.is_alive():
+                vm.destroy(gracefully=False)
+            if vm.name in backup_xmls:
+                backup_xmls[vm.name].sync()
+        for task in tasks:
+            if os.path.exists(task["image"]):
+                os.remove(task["image"])
+
+    summary = {"vms": vm_names,
+               "disks": disk_count,
+               "rounds": rounds,
+               "concurrent": concurrent,
+               "leaks": leaks}
+    for key in ("attach", "appear", "detach", "disappear"):
+        summary[key] = get_latency_stats([task.get(key) for task in results])
+        logging.info("%s latency: %s", key, summary[key])
+    result_path = os.path.join(test.resultsdir, "hotplug_stress.json")
+    result_file = open(result_path, "w")
+    try:
+        json.dump({"summary": summary, "results": results}, result_file,
+                  indent=4, sort_keys=True)
+    finally:
+        result_file.close()
+    logging.info("Hotplug stress results saved to %s", result_path)
+
+    errors = ["%s %s: %s" % (task["vm_name"], task["target"], task["error"])
+              for task in results if "error" in task]
+    missing = ["%s %s" % (task["vm_name"], task["target"]) for task in results
+               if task.get("attach_start") and task["appear"] is None]
+    if errors:
+        raise error.TestFail("%d hotplugs failed: %s" % (len(errors),
+                                                         errors))
+    if missing:
+        raise error.TestFail("Disks not seen in guest in %ss: %s" %
+                             (device_timeout, missing))
+    if leaks:
+        raise error.TestFail("Found leaks after detach: %s" % leaks)
+    for key, max_latency in max_latencies.items():
+        if (max_latency and summary[key]["count"] and
+                summary[key]["p99"] > float(max_latency)):
+            raise error.TestFail("p99 %s latency %.3fs is over %ss" %
+                                 (key, summary[key]["p99"], max_latency))
+
+
 def run(test, params, env):
     """
     Test virsh {at|de}tach-disk command.
@@ -102,6 +438,10 @@ def run(test, params, env):
             logging.error(str(e))
             return False
 
+    if params.get("at_dt_disk_stress", "no") == "yes":
+        hotplug_stress(test, params, env)
+        return
+
     vm_ref = params.get("at_dt_disk_vm_ref", "name")
     at_options = params.get("at_dt_disk_at_options", "")
     dt_options = params.get("at_dt_disk_dt_options", "")
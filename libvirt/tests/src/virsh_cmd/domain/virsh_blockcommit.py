@@ -12,6 +12,7 @@ from virttest import utils_libvirtd
 from virttest.libvirt_xml import vm_xml
 from virttest.utils_test import libvirt
 
+from provider import blockjob_monitor
 from provider import libvirt_version
 
 
@@ -116,6 +117,9 @@ def run(test, params, env):
     snap_in_mirror_err = "yes" == params.get("snap_in_mirror_err", "no")
     with_active_commit = "yes" == params.get("with_active_commit", "no")
     multiple_chain = "yes" == params.get("multiple_chain", "no")
+    bandwidth = params.get("blockcommit_bandwidth", "")
+    blockjob_pivot = "yes" == params.get("blockjob_pivot", "no")
+    blockjob_timeout = int(params.get("blockjob_timeout", 600))
     virsh_dargs = {'debug': True}
 
     # Process domain disk device parameters
@@ -143,6 +147,7 @@ def run(test, params, env):
 
     snapshot_external_disks = []
     cmd_session = None
+    monitor = write_load = None
     try:
         if disk_src_protocol == 'iscsi' and disk_type == 'network':
             if not libvirt_version.version_compare(1, 0, 4):
@@ -258,6 +263,13 @@ def run(test, params, env):
             if pivot_opt:
                 blockcommit_options += " --pivot"
 
+        if bandwidth:
+            blockcommit_options += " --bandwidth %s" % bandwidth
+        if (params.get("blockjob_monitor", "no") == "yes" and
+                not with_timeout):
+            # Never block forever on a job that can not get ready
+            blockcommit_options += " --timeout %s" % blockjob_timeout
+
         if vm_state == "shut off":
             vm.destroy(gracefully=True)
 
@@ -267,6 +279,11 @@ def run(test, params, env):
                                                                 blk_target)
             cmd_session = aexpect.ShellSession(cmd)
 
+        # Follow the progress of the job from its start
+        if vm_state != "shut off":
+            monitor, write_load = blockjob_monitor.create_monitor(
+                vm, blk_target, params, blockjob_monitor.get_limit(bandwidth))
+
         # Run test case
         # Active commit does not support on rbd based disk with bug 1200726
         result = virsh.blockcommit(vm_name, blk_target,
@@ -385,6 +402,16 @@ def run(test, params, env):
                 else:
                     break
 
+        if monitor:
+            # Let the monitor catch up with the end of --wait
+            monitor.wait_ready(10)
+            pivot_time = None
+            if blockjob_pivot and not top_inactive and not pivot_opt:
+                pivot_time = monitor.pivot()
+            blockjob_monitor.report_monitor(
+                monitor, write_load, params, test.resultsdir,
+                blockjob_monitor.get_limit(bandwidth), pivot_time)
+
         # Check flag files
         if not vm_state == "shut off" and not multiple_chain:
             for flag in snapshot_flag_files:
@@ -403,6 +430,13 @@ def run(test, params, env):
                                                   debug=True)
             libvirt.check_exit_status(cmd_result, snap_in_mirror_err)
     finally:
+        if monitor:
+            monitor.stop()
+        if write_load:
+            try:
+                write_load.stop()
+            except Exception, detail:
+                logging.error(detail)
         if vm.is_alive():
             vm.destroy(gracefully=False)
         # Recover xml of vm.
@@ -19,6 +19,7 @@ from virttest.libvirt_xml import vm_xml
 from virttest.libvirt_xml import snapshot_xml
 from virttest.utils_test import libvirt as utl
 
+from provider import blockjob_monitor
 from provider import libvirt_version
 
 
@@ -150,14 +151,23 @@ def check_xml(vm_name, target, dest_path, blk_options):
             return False
 
 
-def finish_job(vm_name, target, timeout):
+def finish_job(vm_name, target, timeout, monitor=None):
     """
     Make sure the block copy job finish.
 
     :param vm_name: Domain name
     :param target: Domain disk target dev
     :param timeout: Timeout value of this function
+    :param monitor: BlockJobMonitor of the job, if given, wait by its
+                    samples instead of polling every 2 seconds
     """
+    if monitor:
+        if monitor.wait_ready(timeout):
+            logging.debug("Block job ready after %.2fs", monitor.ready_time)
+            return
+        if monitor.end_time is not None:
+            raise exceptions.TestFail("No blockjob find for '%s'" % target)
+        raise JobTimeout(timeout)
     job_time = 0
     while job_time < timeout:
         # As BZ#1359679, blockjob may disappear during the process,
@@ -220,6 +230,8 @@ def run(test, params, env):
     options = params.get("blockcopy_options", "")
     bandwidth = params.get("blockcopy_bandwidth", "")
     bandwidth_byte = "yes" == params.get("bandwidth_byte", "no")
+    bandwidth_limit = blockjob_monitor.get_limit(bandwidth, bandwidth_byte)
+    blockjob_pivot = "yes" == params.get("blockjob_pivot", "no")
     reuse_external = "yes" == params.get("reuse_external", "no")
     persistent_vm = params.get("persistent_vm", "no")
     status_error = "yes" == params.get("status_error", "no")
@@ -431,6 +443,7 @@ def run(test, params, env):
     save_path = ''
     emulated_iscsi = []
     nfs_cleanup = False
+    monitor = write_load = None
     try:
         # Prepare dest_path
         tmp_file = time.strftime("%Y-%m-%d-%H.%M.%S.img")
@@ -488,6 +501,9 @@ def run(test, params, env):
             elif not os.path.exists(dest_path):
                 raise exceptions.TestFail("Cannot find the created copy")
 
+        # Follow the progress of the job from its start
+        monitor, write_load = blockjob_monitor.create_monitor(
+            vm, target, params, bandwidth_limit)
         # Run the real testing command
         cmd_result = virsh.blockcopy(vm_name, target, dest_path,
                                      options, **extra_dict)
@@ -519,10 +535,18 @@ def run(test, params, env):
                 val += options.count('--bytes')
                 if val == 0:
                     try:
-                        finish_job(vm_name, target, timeout)
+                        finish_job(vm_name, target, timeout, monitor)
                     except JobTimeout, excpt:
                         raise exceptions.TestFail("Run command failed: %s" %
                                                   excpt)
+                if monitor:
+                    pivot_time = None
+                    if blockjob_pivot and val == 0:
+                        pivot_time = monitor.pivot()
+                    blockjob_monitor.report_monitor(monitor, write_load,
+                                                    params, test.resultsdir,
+                                                    bandwidth_limit,
+                                                    pivot_time)
                 if options.count("--raw") and not with_blockdev:
                     check_format(dest_path, dest_extension, dest_format)
                 if active_snap:
@@ -574,6 +598,13 @@ def run(test, params, env):
                     raise exceptions.TestFail("Expect fail, but run "
                                               "successfully: %s" % bug_url)
     finally:
+        if monitor:
+            monitor.stop()
+        if write_load:
+            try:
+                write_load.stop()
+            except Exception, e:
+                logging.error(e)
         # Recover VM may fail unexpectedly, we need using try/except to
         # proceed the following cleanup steps
         try:
@@ -11,6 +11,7 @@ from virttest.utils_test import libvirt
 from virttest.libvirt_xml import vm_xml
 from virttest.libvirt_xml import snapshot_xml
 
+from provider import blockjob_monitor
 from provider import libvirt_version
 
 
@@ -169,6 +170,7 @@ def run(test, params, env):
     status_error = ("yes" == params.get("status_error", "no"))
     base_option = params.get("base_option", None)
     keep_relative = "yes" == params.get("keep_relative", 'no')
+    blockjob_timeout = int(params.get("blockjob_timeout", 600))
     virsh_dargs = {'debug': True}
 
     # Process domain disk device parameters
@@ -191,6 +193,7 @@ def run(test, params, env):
         raise error.TestFail("There are snapshots created for %s already" % vm_name)
 
     snapshot_external_disks = []
+    monitor = write_load = None
     try:
         if disk_src_protocol == 'iscsi' and disk_type == 'network':
             if not libvirt_version.version_compare(1, 0, 4):
@@ -277,11 +280,25 @@ def run(test, params, env):
         if keep_relative:
             blockpull_options += " --keep-relative"
 
+        # Follow the progress of the job from its start
+        monitor, write_load = blockjob_monitor.create_monitor(
+            vm, blk_target, params, blockjob_monitor.get_limit(bandwidth))
+
         # Run test case
         result = virsh.blockpull(vm_name, blk_target,
                                  blockpull_options, **virsh_dargs)
         status = result.exit_status
 
+        if monitor and not status:
+            # Wait for the end of an async job, or let the monitor catch
+            # up with the end of --wait
+            if not monitor.wait_ready(blockjob_timeout):
+                raise error.TestFail("Block pull is not done in %ss" %
+                                     blockjob_timeout)
+            blockjob_monitor.report_monitor(
+                monitor, write_load, params, test.resultsdir,
+                blockjob_monitor.get_limit(bandwidth))
+
         # If pull job aborted as timeout, the exit status is different
         # on RHEL6(0) and RHEL7(1)
         if with_timeout and 'Pull aborted' in result.stdout:
@@ -348,6 +365,13 @@ def run(test, params, env):
                 raise error.TestFail("blockpull failed: %s" % output)
 
     finally:
+        if monitor:
+            monitor.stop()
+        if write_load:
+            try:
+                write_load.stop()
+            except Exception, detail:
+                logging.error(detail)
         if vm.is_alive():
             vm.destroy(gracefully=False)
         # Recover xml of vm.
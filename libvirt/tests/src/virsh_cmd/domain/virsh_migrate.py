@@ -1,6 +1,7 @@
 import logging
 import os
 import re
+import json
 import time
 
 from avocado.utils import process
@@ -25,6 +26,9 @@ from virttest import test_setup
 from virttest.staging import utils_memory
 
 from provider import libvirt_version
+from provider import migration_results
+from provider import migration_progress
+from provider import guest_memory_latency
 from autotest.client.shared import error
 
 
@@ -83,8 +87,14 @@ def run(test, params, env):
         logging.info("Sleeping %d seconds before migration" % delay)
         time.sleep(delay)
         # Migrate the guest.
+        guest_size = migration_results.get_guest_size(vm.name, src_uri)
         migration_res = vm.migrate(dest_uri, options, extra, True, True)
         logging.info("Migration exit status: %d", migration_res.exit_status)
+        migration_results.record_migration(
+            params, "virsh_migrate", vm.name,
+            migration_res.exit_status == 0, migration_res.duration,
+            "%s %s" % (options, extra), src_uri, guest_size,
+            dest_uri=dest_uri)
         check_migration_result(migration_res)
         if int(migration_res.exit_status) != 0:
             logging.error("Migration failed for %s." % vm_name)
@@ -371,6 +381,155 @@ def run(test, params, env):
                                       timeout, vm_state)
         new_session.close_session()
 
+    def switch_to_postcopy(params):
+        """
+        Switch the migration to post-copy.
+        As the migration thread begins to execute, this function is executed
+        at same time almostly. It waits until pre-copy reaches
+        postcopy_switchover_iteration iterations, or for
+        postcopy_switchover_delay seconds if the iteration is 0, then runs
+        virsh migrate-postcopy and waits for the VM running on target host.
+        If pre-copy converged before the switchover, no switch is done and
+        the time it finished is saved as "converged".
+        The times of each step are saved in params["postcopy_times"].
+
+        :param params: The parameters used
+
+        :raise: exceptions.TestFail if the VM does not run on target host
+        """
+        vm_name = params.get("migrate_main_vm")
+        switch_delay = float(params.get("postcopy_switchover_delay", 5))
+        switch_iteration = int(params.get("postcopy_switchover_iteration", 0))
+        times = params["postcopy_times"]
+        times["start"] = time.time()
+
+        job_seen = []
+
+        def _get_jobinfo():
+            result = virsh.domjobinfo(vm_name, ignore_status=True)
+            info = migration_progress.parse_jobinfo(result.stdout)
+            if info.get("job_type", "None") != "None":
+                job_seen.append(True)
+            return info
+
+        def _reach_iteration():
+            info = _get_jobinfo()
+            # Stop waiting once the job finished without enough iterations
+            if info.get("job_type", "None") == "None":
+                return bool(job_seen)
+            return info.get("iteration", 0) >= switch_iteration
+
+        def _run_on_dest():
+            result = virsh.domstate(vm_name, "--reason", uri=dest_uri,
+                                    ignore_status=True)
+            return result.stdout.strip().startswith("running")
+
+        def _converged():
+            """
+            Check whether pre-copy finished the migration by itself.
+            """
+            if _get_jobinfo().get("job_type", "None") != "None":
+                return False
+            if not _run_on_dest():
+                raise exceptions.TestFail("Migration job of %s is not "
+                                          "active, can not switch it to "
+                                          "post-copy" % vm_name)
+            times["converged"] = time.time()
+            logging.warning("Pre-copy of %s converged before switchover "
+                            "after %.2fs, not switched to post-copy",
+                            vm_name, times["converged"] - times["start"])
+            return True
+
+        if switch_iteration:
+            utils_misc.wait_for(_reach_iteration, postcopy_timeout, step=0.2,
+                                text="Wait for %d pre-copy iterations" %
+                                switch_iteration)
+        else:
+            time.sleep(switch_delay)
+        if _converged():
+            return
+        times["switch"] = time.time()
+        result = process.run("virsh %s %s" % (postcopy_cmd, vm_name),
+                             shell=True, ignore_status=True)
+        if result.exit_status:
+            # Pre-copy may converge right before the switch
+            if _converged():
+                del times["switch"]
+                return
+            raise exceptions.TestFail("Failed to switch %s to post-copy: %s"
+                                      % (vm_name, result.stderr.strip()))
+        if not utils_misc.wait_for(_run_on_dest, postcopy_timeout, step=0.1):
+            raise exceptions.TestFail("%s is not running on target host "
+                                      "after switching to post-copy" %
+                                      vm_name)
+        times["switched"] = time.time()
+        logging.info("Switched to post-copy after %.2fs, %s ran on target "
+                     "host %.3fs later", times["switch"] - times["start"],
+                     vm_name, times["switched"] - times["switch"])
+
+    def report_postcopy(vm, latency_probe, guest_size, migrate_options):
+        """
+        Save the times of the post-copy migration and the guest memory
+        latency in each phase of it to postcopy_benchmark.json.
+
+        :param vm: The migrated VM
+        :param latency_probe: MemoryLatencyProbe running in the VM
+        :param guest_size: Tuple of (memory, vcpus) got before migration
+        :param migrate_options: Options of the migration
+
+        :raise: exceptions.TestFail if the worst access latency of the
+                post-copy phase is over postcopy_max_latency_ms
+        """
+        times = params["postcopy_times"]
+        session = vm.wait_for_login()
+        try:
+            stats = latency_probe.get_stats(session)
+            latency_probe.stop(session)
+        finally:
+            session.close()
+        if "converged" in times:
+            raise exceptions.TestFail("Pre-copy converged before switchover "
+                                      "after %.2fs, there is no post-copy "
+                                      "phase to measure" %
+                                      (times["converged"] - times["start"]))
+        switched = times.get("switched", times["end"])
+        phases = [("before_migration", 0, times["start"]),
+                  ("precopy", times["start"], times["switch"]),
+                  ("switchover", times["switch"], switched),
+                  ("postcopy", switched, times["end"])]
+        latency = guest_memory_latency.get_phase_latency(stats, phases)
+        result = {"total_time": times["end"] - times["start"],
+                  "time_to_switchover": times["switch"] - times["start"],
+                  "switchover_time": switched - times["switch"],
+                  "postcopy_time": times["end"] - switched,
+                  "latency": latency,
+                  "latency_stats": stats}
+        for phase in phases:
+            logging.info("Memory access latency %s: %s", phase[0],
+                         latency[phase[0]])
+        result_path = os.path.join(test.resultsdir, "postcopy_benchmark.json")
+        result_file = open(result_path, "w")
+        try:
+            json.dump(result, result_file, indent=4, sort_keys=True)
+        finally:
+            result_file.close()
+        logging.info("Post-copy migration took %.2fs, switched after %.2fs, "
+                     "saved to %s", result["total_time"],
+                     result["time_to_switchover"], result_path)
+        migration_results.record_migration(
+            params, "virsh_migrate", vm.name, True, result["total_time"],
+            migrate_options, src_uri, guest_size, dest_uri=dest_uri,
+            time_to_switchover=result["time_to_switchover"],
+            postcopy_time=result["postcopy_time"],
+            postcopy_max_latency_us=latency["postcopy"]["max_us"])
+
+        max_latency = params.get("postcopy_max_latency_ms")
+        postcopy_max_us = latency["postcopy"]["max_us"]
+        if max_latency and postcopy_max_us > float(max_latency) * 1000:
+            raise exceptions.TestFail("Worst memory access latency during "
+                                      "post-copy is %.2f ms, over %s ms" %
+                                      (postcopy_max_us / 1000, max_latency))
+
     for v in params.itervalues():
         if isinstance(v, str) and v.count("EXAMPLE"):
             raise exceptions.TestSkipError("Please set real value for %s" % v)
@@ -490,6 +649,8 @@ def run(test, params, env):
     enable_HP_pin = "yes" == params.get("virsh_migrate_with_HP_pin", "no")
     postcopy_cmd = params.get("virsh_postcopy_cmd", "")
     postcopy_timeout = int(params.get("postcopy_migration_timeout", "180"))
+    # Measure switchover times and guest memory latency of post-copy
+    postcopy_benchmark = "yes" == params.get("postcopy_benchmark", "no")
     mem_hotplug = "yes" == params.get("virsh_migrate_mem_hotplug", "no")
     # min memory that can be hotplugged 256 MiB - 256 * 1024 = 262144
     mem_hotplug_size = int(params.get("virsh_migrate_hotplug_mem", "262144"))
@@ -857,23 +1018,36 @@ def run(test, params, env):
             vms.append(vm)
             obj_migration = libvirt.MigrationTest()
             migrate_options = "%s %s" % (options, extra)
-            cmd = "sleep 5 && virsh %s %s" % (postcopy_cmd, vm_name)
+            params["postcopy_times"] = {}
+            if postcopy_benchmark:
+                guest_size = migration_results.get_guest_size(vm.name,
+                                                              src_uri)
+                latency_probe = guest_memory_latency.MemoryLatencyProbe(
+                    vm, params)
+                session = vm.wait_for_login()
+                try:
+                    latency_probe.start(session)
+                finally:
+                    session.close()
             logging.info("Starting migration in thread")
             try:
                 obj_migration.do_migration(vms, src_uri, dest_uri, "orderly",
                                            options=migrate_options,
                                            thread_timeout=postcopy_timeout,
                                            ignore_status=False,
-                                           func=process.run,
-                                           func_params=cmd,
-                                           shell=True)
+                                           func=switch_to_postcopy,
+                                           func_params=params)
             except Exception, info:
                 raise exceptions.TestFail(info)
+            params["postcopy_times"]["end"] = time.time()
             if obj_migration.RET_MIGRATION:
                 utils_test.check_dest_vm_network(vm, vm.get_address(),
                                                  server_ip, server_user,
                                                  server_pwd)
                 ret_migrate = True
+                if postcopy_benchmark:
+                    report_postcopy(vm, latency_probe, guest_size,
+                                    migrate_options)
             else:
                 ret_migrate = False
         if not asynch_migration:
@@ -1,5 +1,6 @@
 import logging
 import subprocess
+import threading
 import time
 
 from autotest.client.shared import error
@@ -11,6 +12,8 @@ from avocado.utils import path as utils_path
 from virttest import virsh
 from virttest.utils_test import libvirt as utlv
 
+from provider import migration_progress
+
 
 def get_page_size():
     """
@@ -96,8 +99,10 @@ def run(test, params, env):
     remote_host = params.get("migrate_dest_host")
     remote_user = params.get("migrate_dest_user", "root")
     remote_pwd = params.get("migrate_dest_pwd")
+    migration_timeout = int(params.get("compcache_migration_timeout", 600))
     check_job_compcache = False
     compressed_size = None
+    not_converged = []
     if not remote_host.count("EXAMPLE") and size is not None and expect_succeed:
         # Config ssh autologin for remote host
         ssh_key.setup_ssh_key(remote_host, remote_user,
@@ -113,6 +118,7 @@ def run(test, params, env):
         logging.debug("Start migrating: %s", command)
         p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE)
+        samplers = migration_progress.create_samplers([vm_name], params)
 
         # Give enough time for starting job
         t = 0
@@ -135,6 +141,26 @@ def run(test, params, env):
                 logging.debug("Job started: %s", jobtype)
                 break
 
+        if samplers:
+            def abort_migration():
+                """
+                Abort the migration job, so virsh migrate returns.
+                """
+                logging.error("Migration did not finish in %ss, abort it",
+                              migration_timeout)
+                virsh.domjobabort(vm_ref, ignore_status=True, debug=True)
+
+            # Follow the job until the migration finishes
+            watchdog = threading.Timer(migration_timeout, abort_migration)
+            watchdog.start()
+            try:
+                stdout, stderr = p.communicate()
+            finally:
+                watchdog.cancel()
+            logging.debug("Migration finished: %s%s", stdout, stderr)
+            not_converged = migration_progress.report_samplers(
+                samplers, p.returncode == 0, params, test.resultsdir)
+
         if p.poll():
             try:
                 p.kill()
@@ -149,6 +175,11 @@ def run(test, params, env):
         vm.destroy()
 
     # Check test result
+    if (not_converged and
+            params.get("migration_fail_not_converged", "no") == "yes"):
+        raise error.TestFail("Migration with compression cache %s did not "
+                             "converge: %s" %
+                             (size, "; ".join(not_converged[0]["reasons"])))
     if expect_succeed:
         if result.exit_status != 0:
             raise error.TestFail(
@@ -1,17 +1,26 @@
 import os
+import json
+import time
 import logging
 
 from autotest.client import lv_utils
 from autotest.client.shared import error
 from avocado.core import exceptions
+from avocado.utils import process
 
 from virttest import ssh_key
 from virttest import utils_test
 from virttest import libvirt_vm
 from virttest.utils_test import libvirt as utlv
+from virttest.libvirt_xml import vm_xml
 from virttest import virsh
 from virttest.utils_misc import is_qemu_capability_supported as qemu_test
 from virttest import remote
+from virttest import data_dir
+
+from provider import disk_generator
+from provider import migration_downtime
+from provider import migration_progress
 
 
 def create_destroy_pool_on_remote(action, params):
@@ -131,11 +140,270 @@ def copied_migration(vms, params):
         raise error.TestFail("Check IP failed:%s" % check_ip_failures)
 
 
+def prepare_benchmark_disks(vm, params):
+    """
+    Generate the disks of the benchmark and attach them to vm.
+
+    Each disk is a qcow2 overlay on a base image, so that both full and
+    incremental copy can be measured with the same disks.
+
+    :return: List of dicts of target, base and top image of each disk
+    """
+    disk_dir = params.get("benchmark_disk_dir", data_dir.get_tmp_dir())
+    size = params.get("benchmark_disk_size", "10G")
+    img_format = params.get("benchmark_disk_format", "qcow2")
+    fill_ratio = float(params.get("benchmark_fill_ratio", 0.5))
+    overlay_fill_ratio = float(params.get("benchmark_overlay_fill_ratio",
+                                          0.1))
+    sparse = "yes" == params.get("benchmark_sparse", "yes")
+
+    disks = []
+    for target in params.get("benchmark_disk_targets", "vdb").split():
+        base = os.path.join(disk_dir, "copy_storage_base_%s.%s"
+                            % (target, img_format))
+        top = os.path.join(disk_dir, "copy_storage_top_%s.qcow2" % target)
+        base_info = disk_generator.create_disk(base, size, img_format,
+                                               fill_ratio, sparse)
+        # Data written after the base image was copied to destination
+        top_info = disk_generator.create_disk(top, size, "qcow2",
+                                              overlay_fill_ratio, True,
+                                              backing_file=base,
+                                              backing_format=img_format,
+                                              pattern=0xa5)
+        result = virsh.attach_disk(vm.name, top, target,
+                                   "--driver qemu --subdriver qcow2 "
+                                   "--config", debug=True)
+        if result.exit_status:
+            raise error.TestError("Failed to attach %s: %s"
+                                  % (top, result.stderr.strip()))
+        disks.append({"target": target,
+                      "base": base_info,
+                      "top": top_info})
+    return disks
+
+
+def prepare_benchmark_dest(disks, copy_option, params, dest_dir=None):
+    """
+    Create the destination images of the disks.
+
+    A full copy needs an empty image, an incremental copy needs an
+    overlay on the same base image, which is shared on the same host and
+    copied to the remote host otherwise.
+
+    :param disks: Disks got by prepare_benchmark_disks()
+    :param copy_option: --copy-storage-all or --copy-storage-inc
+    :param params: Test params
+    :param dest_dir: Directory of the destination images on the same
+                     host, None means the same paths on the remote host
+    :return: Dict of {source top image: destination top image}
+    """
+    dest_paths = {}
+    commands = []
+    for disk in disks:
+        top = disk["top"]["path"]
+        base = disk["base"]["path"]
+        if dest_dir:
+            dest_paths[top] = os.path.join(dest_dir, os.path.basename(top))
+        else:
+            dest_paths[top] = top
+        cmd = "qemu-img create -f qcow2"
+        if copy_option == "--copy-storage-inc":
+            cmd += (" -o backing_file=%s,backing_fmt=%s"
+                    % (base, disk["base"]["format"]))
+        commands.append("%s %s %s" % (cmd, dest_paths[top],
+                                      disk["top"]["size"]))
+
+    if dest_dir:
+        for cmd in commands:
+            process.run(cmd, shell=True)
+        return dest_paths
+
+    remote_ip = params.get("migrate_dest_host")
+    remote_user = params.get("migrate_dest_user", "root")
+    remote_pwd = params.get("migrate_dest_pwd")
+    if copy_option == "--copy-storage-inc":
+        for disk in disks:
+            base = disk["base"]["path"]
+            remote.copy_files_to(remote_ip, "scp", remote_user, remote_pwd,
+                                 22, base, base)
+    session = remote.wait_for_login("ssh", remote_ip, 22, remote_user,
+                                    remote_pwd, r"[\#\$]\s*$")
+    try:
+        for cmd in commands:
+            status, output = session.cmd_status_output(cmd)
+            if status:
+                raise error.TestError("Run '%s' on remote host '%s' failed:"
+                                      " %s" % (cmd, remote_ip, output))
+    finally:
+        session.close()
+    return dest_paths
+
+
+def cleanup_benchmark_dest(vm_name, dest_uri, dest_paths, params,
+                           dest_dir=None):
+    """
+    Destroy the migrated vm and remove the destination images.
+    """
+    virsh.destroy(vm_name, uri=dest_uri, ignore_status=True)
+    virsh.undefine(vm_name, uri=dest_uri, ignore_status=True)
+    paths = " ".join(dest_paths.values())
+    if dest_dir:
+        process.run("rm -f %s" % paths, shell=True, ignore_status=True)
+        return
+    remote_ip = params.get("migrate_dest_host")
+    session = remote.wait_for_login("ssh", remote_ip, 22,
+                                    params.get("migrate_dest_user", "root"),
+                                    params.get("migrate_dest_pwd"),
+                                    r"[\#\$]\s*$")
+    try:
+        session.cmd_status("rm -f %s" % paths)
+    finally:
+        session.close()
+
+
+def get_mirror_time(samples):
+    """
+    Get the seconds the disks took to be synchronized, that is when
+    domjobinfo first reported no disk data remaining. domjobinfo reports
+    the disks as "File processed/remaining/total".
+
+    :param samples: Samples of MigrationProgressSampler
+    :return: Tuple of (seconds, disk bytes processed), or (None, None)
+    """
+    for sample in samples:
+        if (sample.get("file_total") and
+                sample.get("file_remaining") == 0):
+            return sample["time"], sample.get("file_processed")
+    return None, None
+
+
+def benchmark_copy_storage(vm, params, result_dir):
+    """
+    Measure the disk mirror throughput and switchover time of migration
+    with storage copied, for full and incremental copy.
+
+    With benchmark_dest_dir set, the destination is a second libvirtd on
+    the same host, such as qemu+unix:///system?socket=<its socket>, and
+    the disks are copied into benchmark_dest_dir by changing their
+    source in the migration XML.
+    """
+    dest_uri = params.get("migrate_dest_uri")
+    dest_dir = params.get("benchmark_dest_dir")
+    copy_options = params.get("benchmark_copy_options",
+                              "--copy-storage-all --copy-storage-inc")
+    interval = float(params.get("benchmark_sample_interval", 0.2))
+    if not dest_dir:
+        ssh_key.setup_ssh_key(params.get("migrate_dest_host"),
+                              params.get("migrate_dest_user", "root"),
+                              params.get("migrate_dest_pwd"), port=22)
+
+    if vm.is_alive():
+        vm.destroy()
+    vmxml_backup = vm_xml.VMXML.new_from_inactive_dumpxml(vm.name)
+    disks = []
+    results = {}
+    try:
+        disks = prepare_benchmark_disks(vm, params)
+        targets = ",".join([disk["target"] for disk in disks])
+        for copy_option in copy_options.split():
+            if vm.is_dead():
+                vm.start()
+            vm.wait_for_login().close()
+            dest_paths = prepare_benchmark_dest(disks, copy_option, params,
+                                                dest_dir)
+            extra = ""
+            if dest_dir:
+                # Move the disks to dest_dir in the migration XML
+                xml = virsh.dumpxml(vm.name, extra="--migratable").stdout
+                for top, dest_top in dest_paths.items():
+                    xml = xml.replace("'%s'" % top, "'%s'" % dest_top)
+                xml_file = os.path.join(data_dir.get_tmp_dir(),
+                                        "%s_migrate.xml" % vm.name)
+                xml_fd = open(xml_file, "w")
+                try:
+                    xml_fd.write(xml)
+                finally:
+                    xml_fd.close()
+                extra = "--xml %s" % xml_file
+            options = ("--live --verbose %s --migrate-disks %s"
+                       % (copy_option, targets))
+
+            sampler = migration_progress.MigrationProgressSampler(
+                vm.name, interval=interval)
+            sampler.start()
+            start_time = time.time()
+            try:
+                result = virsh.migrate(vm.name, dest_uri, options, extra,
+                                       ignore_status=True, debug=True)
+                total_time = time.time() - start_time
+            finally:
+                sampler.stop()
+            try:
+                if result.exit_status:
+                    check_output(result.stderr, params)
+                    raise error.TestFail("Migration with %s failed: %s"
+                                         % (copy_option,
+                                            result.stderr.strip()))
+                mirror_time, mirror_bytes = get_mirror_time(sampler.samples)
+                results[copy_option] = {
+                    "total_time": total_time,
+                    "mirror_time": mirror_time,
+                    "mirror_bytes": mirror_bytes,
+                    "mirror_bytes_per_second": (
+                        mirror_time and mirror_bytes and
+                        mirror_bytes / mirror_time or None),
+                    "switchover_time": (mirror_time is not None and
+                                        total_time - mirror_time or None),
+                    "downtime": migration_downtime.get_libvirt_downtime(
+                        vm.name, dest_uri),
+                    "samples": sampler.samples}
+            finally:
+                cleanup_benchmark_dest(vm.name, dest_uri, dest_paths,
+                                       params, dest_dir)
+    finally:
+        if vm.is_alive():
+            vm.destroy(gracefully=False)
+        vmxml_backup.sync()
+        for disk in disks:
+            for image in (disk["top"], disk["base"]):
+                if os.path.exists(image["path"]):
+                    os.remove(image["path"])
+
+    not_sampled = []
+    for copy_option, result in sorted(results.items()):
+        if result["mirror_time"] is None:
+            logging.warning("%s: migration took %.2fs, disk mirror not "
+                            "sampled", copy_option, result["total_time"])
+            not_sampled.append(copy_option)
+            continue
+        logging.info("%s: mirrored %d bytes in %.2fs (%.2f MiB/s), "
+                     "%.2fs from disks synchronized to switchover, "
+                     "migration took %.2fs", copy_option,
+                     result["mirror_bytes"] or 0, result["mirror_time"],
+                     (result["mirror_bytes_per_second"] or 0) / 1048576,
+                     result["switchover_time"], result["total_time"])
+    result_path = os.path.join(result_dir, "copy_storage_benchmark.json")
+    result_file = open(result_path, "w")
+    try:
+        json.dump({"disks": disks, "results": results}, result_file,
+                  indent=4, sort_keys=True)
+    finally:
+        result_file.close()
+    logging.info("Benchmark results saved to %s", result_path)
+    if not_sampled:
+        raise error.TestFail("No disk mirror progress was sampled during "
+                             "migration with %s" % ", ".join(not_sampled))
+
+
 def run(test, params, env):
     """
     Test migration with option --copy-storage-all or --copy-storage-inc.
     """
     vm = env.get_vm(params.get("migrate_main_vm"))
+    if params.get("copy_storage_benchmark", "no") == "yes":
+        benchmark_copy_storage(vm, params, test.resultsdir)
+        return
+
     disk_type = params.get("copy_storage_type", "file")
     if disk_type == "file":
         params['added_disk_type'] = "file"
@@ -1,3 +1,6 @@
+import os
+import json
+import Queue
 import logging
 import threading
 import time
@@ -6,12 +9,14 @@ from avocado.core import exceptions
 
 from virttest import libvirt_vm
 from virttest import virsh
-from virttest import remote
 from virttest import utils_test
 from virttest import nfs
 from virttest import ssh_key
 from virttest.libvirt_xml import vm_xml
 
+from provider import migration_downtime
+from provider import migration_results
+
 
 # To get result in thread, using global parameters
 # Result of virsh migrate command
@@ -69,32 +74,56 @@ def make_migration_options(method, optionstr="", timeout=60):
     return options + migrate_exec
 
 
-def thread_func_ping(lrunner, rrunner, vm_ip, tolerable=5):
+def check_downtime(probe, dest_uri, tolerable=5):
     """
-    Check connectivity during migration: Ping vm every second, check whether
-    the paused state is intolerable.
+    Check the downtime of each vm measured by probe, and cross-check it
+    with the downtime reported by libvirt.
+
+    :param probe: Stopped DowntimeProbe instance
+    :param dest_uri: URI of the destination host
+    :param tolerable: Tolerable downtime in seconds
     """
-    cmd = "ping -c 1 %s" % vm_ip
-    time1 = None    # Flag the time local vm is down
-    time2 = None    # Flag the time remote vm is up
-    timeout = 360   # In case thread is not killed at the end of test
     global ret_downtime_tolerable
-    while timeout:
-        ls = lrunner.run(cmd, ignore_status=True).exit_status
-        rs = rrunner.run(cmd, ignore_status=True).exit_status
-        if ls and time1 is None:   # The first time local vm is not connective
-            time1 = int(time.time())
-        if not rs and time2 is None:  # The first time remote vm is connective
-            time2 = int(time.time())
-        if time1 is None or time2 is None:
-            time.sleep(1)
-            timeout -= 1
-        else:
-            if int(time2 - time1) > int(tolerable):
-                logging.debug("The time local vm is down: %s", time1)
-                logging.debug("The time remote vm is up: %s", time2)
-                ret_downtime_tolerable = False
-            break   # Got enough information, leaving thread anyway
+    for vm_name, info in sorted(probe.get_downtime().items()):
+        libvirt_downtime = migration_downtime.get_libvirt_downtime(vm_name,
+                                                                   dest_uri)
+        logging.info("Downtime of %s: %.3fs measured (%d/%d probes "
+                     "answered), %s reported by libvirt", vm_name,
+                     info["downtime"], info["received"], info["sent"],
+                     libvirt_downtime is None and "not" or
+                     "%.3fs" % libvirt_downtime)
+        if not info["recovered"]:
+            logging.error("%s did not answer after migration", vm_name)
+            ret_downtime_tolerable = False
+        elif info["downtime"] > float(tolerable):
+            logging.error("Downtime of %s is %.3fs, more than %ss",
+                          vm_name, info["downtime"], tolerable)
+            ret_downtime_tolerable = False
+
+
+def record_results(params, guest_sizes, src_uri, dest_uri, options,
+                   durations, probe, **extra):
+    """
+    Save the result of each migrated vm to the migration results database.
+
+    :param params: Test params
+    :param guest_sizes: Dict of {vm_name: (memory, vcpus)}
+    :param src_uri: URI of the source host
+    :param dest_uri: URI of the destination host
+    :param options: options passed in migration command
+    :param durations: Dict of {vm_name: migration seconds}, the vms
+                      missing in it failed to migrate
+    :param probe: Stopped DowntimeProbe instance
+    :param extra: Other info of the migrations
+    """
+    downtime = probe.get_downtime()
+    for vm_name, guest_size in sorted(guest_sizes.items()):
+        migrated = vm_name in durations
+        migration_results.record_migration(
+            params, "virsh_migrate_multi_vms", vm_name, migrated,
+            durations.get(vm_name), options, src_uri, guest_size,
+            migrated and downtime[vm_name]["downtime"] or None,
+            dest_uri=dest_uri, **extra)
 
 
 def thread_func_jobabort(vm):
@@ -105,7 +134,8 @@ def thread_func_jobabort(vm):
 
 def multi_migration(vm, src_uri, dest_uri, options, migrate_type,
                     migrate_thread_timeout, jobabort=False,
-                    lrunner=None, rrunner=None):
+                    probe_interval=0.05, tolerable_downtime=5, params=None,
+                    recovery_timeout=360):
     """
     Migrate multiple vms simultaneously or not.
 
@@ -118,11 +148,23 @@ def multi_migration(vm, src_uri, dest_uri, options, migrate_type,
     :jobabort: If jobabort is True, run "virsh domjobabort vm_name"
                during migration.
     :param timeout: thread's timeout
-    :lrunner: local session instance
-    :rrunner: remote session instance
+    :probe_interval: seconds between two downtime probes to each vm
+    :tolerable_downtime: tolerable downtime of each vm in seconds
+    :params: Test params, to save the results if given
+    :recovery_timeout: seconds to wait for the network of each vm to
+                       come back after migration
     """
 
     obj_migration = utils_test.libvirt.MigrationTest()
+    guest_sizes = dict((each_vm.name,
+                        migration_results.get_guest_size(each_vm.name,
+                                                         src_uri))
+                       for each_vm in vm)
+    # Probe all the vms during migration to measure their downtime.
+    probe = migration_downtime.DowntimeProbe(
+        dict((each_vm.name, each_vm.get_address()) for each_vm in vm),
+        probe_interval)
+    probe.start()
     if migrate_type.lower() == "simultaneous":
         logging.info("Migrate vms simultaneously.")
         try:
@@ -133,6 +175,7 @@ def multi_migration(vm, src_uri, dest_uri, options, migrate_type,
                                        thread_timeout=migrate_thread_timeout,
                                        ignore_status=False)
             if jobabort:
+                probe.stop()
                 # To ensure Migration has been started.
                 time.sleep(5)
                 logging.info("Aborting job during migration.")
@@ -145,10 +188,19 @@ def multi_migration(vm, src_uri, dest_uri, options, migrate_type,
                     jobabort_thread.start()
                 for jobabort_thread in jobabort_threads:
                     jobabort_thread.join(migrate_thread_timeout)
+            else:
+                probe.stop(recovery_timeout)
+                check_downtime(probe, dest_uri, tolerable_downtime)
+                if params:
+                    record_results(params, guest_sizes, src_uri, dest_uri,
+                                   options, obj_migration.mig_time, probe,
+                                   migration_type=migrate_type)
             ret_migration = True
 
         except Exception, info:
             raise exceptions.TestFail(info)
+        finally:
+            probe.stop()
 
     elif migrate_type.lower() == "orderly":
         logging.info("Migrate vms orderly.")
@@ -159,14 +211,17 @@ def multi_migration(vm, src_uri, dest_uri, options, migrate_type,
                                        options=options,
                                        thread_timeout=migrate_thread_timeout,
                                        ignore_status=False)
-            for each_vm in vm:
-                ping_thread = threading.Thread(target=thread_func_ping,
-                                               args=(lrunner, rrunner,
-                                                     each_vm.get_address()))
-                ping_thread.start()
+            probe.stop(recovery_timeout)
+            check_downtime(probe, dest_uri, tolerable_downtime)
+            if params:
+                record_results(params, guest_sizes, src_uri, dest_uri,
+                               options, obj_migration.mig_time, probe,
+                               migration_type=migrate_type)
 
         except Exception, info:
             raise exceptions.TestFail(info)
+        finally:
+            probe.stop()
 
     if obj_migration.RET_MIGRATION:
         ret_migration = True
@@ -174,6 +229,156 @@ def multi_migration(vm, src_uri, dest_uri, options, migrate_type,
         ret_migration = False
 
 
+def get_sweep_levels(vm_count, levels=""):
+    """
+    Get concurrency levels of sweep migration.
+
+    :param vm_count: Count of migrated vms
+    :param levels: Levels split by space, default is 1, 2, 4 ... vm_count
+    :return: Sorted list of levels
+    """
+    if levels:
+        return sorted(set([int(level) for level in levels.split()]))
+    result = []
+    level = 1
+    while level < vm_count:
+        result.append(level)
+        level *= 2
+    result.append(vm_count)
+    return result
+
+
+def migrate_in_pool(vm_names, src_uri, dest_uri, options, concurrency,
+                    migrate_thread_timeout):
+    """
+    Migrate vms by a bounded pool, at most concurrency vms are migrating
+    at the same time.
+
+    :param vm_names: Names of vms to migrate
+    :param src_uri: URI of the host the vms are on
+    :param dest_uri: URI of the host to migrate the vms to
+    :param options: options to be passed in migration command
+    :param concurrency: Count of migrating threads
+    :param migrate_thread_timeout: thread timeout for migrating vms
+    :return: Tuple of (dict of {vm_name: migration seconds}, errors)
+    """
+    vm_queue = Queue.Queue()
+    for vm_name in vm_names:
+        vm_queue.put(vm_name)
+    migration_times = {}
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                vm_name = vm_queue.get_nowait()
+            except Queue.Empty:
+                return
+            start_time = time.time()
+            result = virsh.migrate(vm_name, dest_uri, options, uri=src_uri,
+                                   ignore_status=True, debug=True)
+            lock.acquire()
+            try:
+                if result.exit_status:
+                    errors.append("Failed to migrate %s to %s: %s" %
+                                  (vm_name, dest_uri, result.stderr.strip()))
+                else:
+                    migration_times[vm_name] = time.time() - start_time
+            finally:
+                lock.release()
+
+    workers = []
+    for _ in range(max(1, min(concurrency, len(vm_names)))):
+        worker_thread = threading.Thread(target=worker)
+        worker_thread.start()
+        workers.append(worker_thread)
+    for worker_thread in workers:
+        worker_thread.join(migrate_thread_timeout)
+    return migration_times, errors
+
+
+def sweep_migration(vm, src_uri, dest_uri, options, levels,
+                    migrate_thread_timeout, probe_interval=0.05,
+                    tolerable_downtime=5, params=None, recovery_timeout=360):
+    """
+    Migrate all the vms at each concurrency level and migrate them back,
+    measure the evacuation time and the downtime of each vm.
+
+    :param vm: list of all vm instances
+    :param src_uri: source ip address for migration
+    :param dest_uri: destination ipaddress for migration
+    :param options: options to be passed in migration command
+    :param levels: list of concurrency levels
+    :param migrate_thread_timeout: thread timeout for migrating vms
+    :param probe_interval: seconds between two downtime probes to each vm
+    :param tolerable_downtime: tolerable downtime of each vm in seconds
+    :param params: Test params, to save the results if given
+    :param recovery_timeout: seconds to wait for the network of each vm
+                             to come back after migration
+    :return: list of the results of each level
+    """
+    global ret_migration
+    vm_names = [each_vm.name for each_vm in vm]
+    guest_sizes = dict((each_vm.name,
+                        migration_results.get_guest_size(each_vm.name,
+                                                         src_uri))
+                       for each_vm in vm)
+    addresses = dict((each_vm.name, each_vm.get_address())
+                     for each_vm in vm)
+    results = []
+    for level in levels:
+        logging.info("Migrate %d vms with concurrency %d.", len(vm_names),
+                     level)
+        probe = migration_downtime.DowntimeProbe(addresses, probe_interval)
+        probe.start()
+        start_time = time.time()
+        try:
+            migration_times, errors = migrate_in_pool(vm_names, src_uri,
+                                                      dest_uri, options,
+                                                      level,
+                                                      migrate_thread_timeout)
+            evacuation_time = time.time() - start_time
+            probe.stop(recovery_timeout)
+        finally:
+            probe.stop()
+        check_downtime(probe, dest_uri, tolerable_downtime)
+        if params:
+            record_results(params, guest_sizes, src_uri, dest_uri,
+                           options, migration_times, probe,
+                           migration_type="sweep",
+                           concurrency=level,
+                           evacuation_time=evacuation_time)
+        downtime = dict((vm_name, info["downtime"]) for vm_name, info in
+                        probe.get_downtime().items())
+        results.append({"concurrency": level,
+                        "evacuation_time": evacuation_time,
+                        "migration_times": migration_times,
+                        "downtime": downtime,
+                        "errors": errors})
+        logging.info("Evacuated %d vms with concurrency %d in %.2fs, max "
+                     "downtime %.3fs", len(migration_times), level,
+                     evacuation_time, max(downtime.values() or [0]))
+
+        # Migrate the vms back for the next level
+        migrated = sorted(migration_times.keys())
+        _, back_errors = migrate_in_pool(migrated, dest_uri, src_uri,
+                                         options, len(migrated),
+                                         migrate_thread_timeout)
+        if errors or back_errors:
+            for error_msg in errors + back_errors:
+                logging.error(error_msg)
+            ret_migration = False
+            break
+
+    for result in results:
+        logging.info("Concurrency %d: evacuation time %.2fs, downtime %s",
+                     result["concurrency"], result["evacuation_time"],
+                     ", ".join(["%s %.3fs" % item for item in
+                                sorted(result["downtime"].items())]))
+    return results
+
+
 def run(test, params, env):
     """
     Test migration of multi vms.
@@ -195,6 +400,14 @@ def run(test, params, env):
     migration_type = params.get("virsh_migration_type", "simultaneous")
     migrate_timeout = int(params.get("virsh_migrate_thread_timeout", 900))
     migration_time = int(params.get("virsh_migrate_timeout", 60))
+    # Interval(seconds) of downtime probes and tolerable downtime(seconds)
+    probe_interval = float(params.get("downtime_probe_interval", "0.05"))
+    tolerable_downtime = float(params.get("downtime_tolerable", "5"))
+    # Seconds to wait for the network of the vms to come back
+    recovery_timeout = float(params.get("downtime_recovery_timeout", "360"))
+    # Concurrency levels of sweep migration, such as "1 2 4"
+    sweep_levels = params.get("virsh_migrate_sweep_levels", "")
+    parallel_connections = params.get("virsh_migrate_parallel_connections")
 
     # Params for NFS and SSH setup
     params["server_ip"] = params.get("migrate_dest_host")
@@ -219,11 +432,6 @@ def run(test, params, env):
     # Config ssh autologin for remote host
     ssh_key.setup_ssh_key(remote_host, host_user, host_passwd, port=22)
 
-    # Prepare local session and remote session
-    localrunner = remote.RemoteRunner(host=remote_host, username=host_user,
-                                      password=host_passwd)
-    remoterunner = remote.RemoteRunner(host=remote_host, username=host_user,
-                                       password=host_passwd)
     # Configure NFS in remote host
     if nfs_shared_disk:
         nfs_client = nfs.NFSClient(params)
@@ -237,6 +445,9 @@ def run(test, params, env):
 
     try:
         option = make_migration_options(method, options, migration_time)
+        if parallel_connections:
+            option += (" --parallel --parallel-connections %s"
+                       % parallel_connections)
 
         # make sure cache=none
         if "unsafe" not in options:
@@ -274,9 +485,31 @@ def run(test, params, env):
             if vm.is_dead():
                 vm.start()
                 vm.wait_for_login()
-        multi_migration(vms, srcuri, desturi, option, migration_type,
-                        migrate_timeout, jobabort, lrunner=localrunner,
-                        rrunner=remoterunner)
+        if migration_type == "sweep":
+            levels = get_sweep_levels(len(vms), sweep_levels)
+            results = sweep_migration(vms, srcuri, desturi, option, levels,
+                                      migrate_timeout,
+                                      probe_interval=probe_interval,
+                                      tolerable_downtime=tolerable_downtime,
+                                      params=params,
+                                      recovery_timeout=recovery_timeout)
+            result_path = os.path.join(test.resultsdir,
+                                       "migration_concurrency_sweep.json")
+            result_file = open(result_path, "w")
+            try:
+                json.dump(results, result_file, indent=4, sort_keys=True)
+            finally:
+                result_file.close()
+            logging.info("Sweep results saved to %s", result_path)
+            if not ret_migration:
+                raise exceptions.TestFail("Sweep migration failed")
+        else:
+            multi_migration(vms, srcuri, desturi, option, migration_type,
+                            migrate_timeout, jobabort,
+                            probe_interval=probe_interval,
+                            tolerable_downtime=tolerable_downtime,
+                            params=params,
+                            recovery_timeout=recovery_timeout)
     except Exception, info:
         logging.error("Test failed: %s" % info)
         flag_migration = False
@@ -286,9 +519,6 @@ def run(test, params, env):
         logging.info("NFS cleanup")
         nfs_client.cleanup(ssh_auto_recover=False)
 
-    localrunner.session.close()
-    remoterunner.session.close()
-
     if not (ret_migration or flag_migration):
         if not status_error:
             raise exceptions.TestFail("Migration test failed")
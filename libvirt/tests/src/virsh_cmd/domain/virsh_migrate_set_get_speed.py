@@ -1,3 +1,5 @@
+import os
+import json
 import logging
 
 from autotest.client.shared import error
@@ -9,6 +11,9 @@ from virttest import utils_test
 from virttest.utils_test import libvirt as utlv
 
 from provider import libvirt_version
+from provider import migration_results
+from provider import migration_progress
+from provider import guest_dirty_pages
 
 UINT32_MAX = (1 << 32) - 1
 INT64_MAX = (1 << 63) - 1
@@ -27,6 +32,46 @@ UINT64_MiB = UINT64_MAX / (1024 * 1024)
 DEFAULT = INT64_MiB
 
 
+def check_migration_uris(params):
+    """
+    Check the uris for migration are set.
+
+    :return: Tuple of (src_uri, dest_uri)
+    """
+    src_uri = params.get("migrate_src_uri", "qemu+ssh://EXAMPLE/system")
+    dest_uri = params.get("migrate_dest_uri", "qemu+ssh://EXAMPLE/system")
+
+    if src_uri.count('///') or src_uri.count('EXAMPLE'):
+        raise error.TestNAError("The src_uri '%s' is invalid" % src_uri)
+
+    if dest_uri.count('///') or dest_uri.count('EXAMPLE'):
+        raise error.TestNAError("The dest_uri '%s' is invalid" % dest_uri)
+    return src_uri, dest_uri
+
+
+def prepare_migration(params):
+    """
+    Check the migration uris and config ssh autologin for remote host.
+
+    :return: Tuple of (src_uri, dest_uri)
+    """
+    src_uri, dest_uri = check_migration_uris(params)
+    remote_host = params.get("migrate_dest_host")
+    username = params.get("migrate_dest_user", "root")
+    password = params.get("migrate_dest_pwd")
+    # Config ssh autologin for remote host
+    ssh_key.setup_ssh_key(remote_host, username, password, port=22)
+    return src_uri, dest_uri
+
+
+def check_migrate_vms(vms):
+    """
+    Check there are vms to migrate.
+    """
+    if not len(vms) or None in vms:
+        raise error.TestNAError("Please provide migrate_vms for test.")
+
+
 def run(test, params, env):
     """
     Test command: virsh migrate-setspeed <domain> <bandwidth>
@@ -35,8 +80,10 @@ def run(test, params, env):
     1) Prepare test environment.
     2) Try to set the maximum migration bandwidth (in MiB/s)
        for a domain through valid and invalid command.
-    3) Recover test environment.
-    4) Check result.
+    3) Migrate the domain under each bandwidth cap and compare the
+       transfer rate with the cap if bandwidth_accuracy is yes.
+    4) Recover test environment.
+    5) Check result.
     """
 
     # MAIN TEST CODE ###
@@ -48,17 +95,10 @@ def run(test, params, env):
     virsh_dargs = {'debug': True}
     # Checking uris for migration
     twice_migration = "yes" == params.get("twice_migration", "no")
-    if twice_migration:
-        src_uri = params.get("migrate_src_uri",
-                             "qemu+ssh://EXAMPLE/system")
-        dest_uri = params.get("migrate_dest_uri",
-                              "qemu+ssh://EXAMPLE/system")
-        if src_uri.count('///') or src_uri.count('EXAMPLE'):
-            raise error.TestNAError("The src_uri '%s' is invalid"
-                                    % src_uri)
-        if dest_uri.count('///') or dest_uri.count('EXAMPLE'):
-            raise error.TestNAError("The dest_uri '%s' is invalid"
-                                    % dest_uri)
+    # Migrate under each cap of bandwidth_caps and check the real rate
+    bandwidth_accuracy = "yes" == params.get("bandwidth_accuracy", "no")
+    if twice_migration or bandwidth_accuracy:
+        src_uri, dest_uri = check_migration_uris(params)
 
     bz1083483 = False
     if bandwidth == "zero":
@@ -132,23 +172,8 @@ def run(test, params, env):
         Check if migration speed is effective with twice migration.
         """
         vms = env.get_all_vms()
-        src_uri = params.get("migrate_src_uri", "qemu+ssh://EXAMPLE/system")
-        dest_uri = params.get("migrate_dest_uri", "qemu+ssh://EXAMPLE/system")
-
-        if not len(vms):
-            raise error.TestNAError("Please provide migrate_vms for test.")
-
-        if src_uri.count('///') or src_uri.count('EXAMPLE'):
-            raise error.TestNAError("The src_uri '%s' is invalid" % src_uri)
-
-        if dest_uri.count('///') or dest_uri.count('EXAMPLE'):
-            raise error.TestNAError("The dest_uri '%s' is invalid" % dest_uri)
-
-        remote_host = params.get("migrate_dest_host")
-        username = params.get("migrate_dest_user", "root")
-        password = params.get("migrate_dest_pwd")
-        # Config ssh autologin for remote host
-        ssh_key.setup_ssh_key(remote_host, username, password, port=22)
+        check_migrate_vms(vms)
+        src_uri, dest_uri = prepare_migration(params)
 
         # Check migrated vms' state
         for vm in vms:
@@ -171,15 +196,32 @@ def run(test, params, env):
         virsh_migrate_timeout = int(params.get("virsh_migrate_timeout", "60"))
         # virsh migrate options
         virsh_migrate_options = "--live --unsafe --timeout %s" % virsh_migrate_timeout
+
+        def record_results(vms, migration_test, speed, guest_sizes):
+            """
+            Save the result of each vm to the migration results database.
+            """
+            for vm in vms:
+                migration_results.record_migration(
+                    params, "virsh_migrate_set_get_speed", vm.name,
+                    migration_test.RET_MIGRATION,
+                    migration_test.mig_time.get(vm.name),
+                    virsh_migrate_options, src_uri, guest_sizes[vm.name],
+                    dest_uri=dest_uri, migration_type=migration_type,
+                    speed=speed)
         # Migrate vms to remote host
         mig_first = utlv.MigrationTest()
         virsh_dargs = {"debug": True}
+        guest_sizes = {}
         for vm in vms:
             set_get_speed(vm.name, bandwidth, virsh_dargs=virsh_dargs)
             vm.wait_for_login()
+            guest_sizes[vm.name] = migration_results.get_guest_size(vm.name,
+                                                                    src_uri)
         utils_test.load_stress(stress_type, vms, params)
         mig_first.do_migration(vms, src_uri, dest_uri, migration_type,
                                options=virsh_migrate_options, thread_timeout=thread_timeout)
+        record_results(vms, mig_first, bandwidth, guest_sizes)
         for vm in vms:
             mig_first.cleanup_dest_vm(vm, None, dest_uri)
             # Keep it clean for second migration
@@ -208,6 +250,7 @@ def run(test, params, env):
         mig_second = utlv.MigrationTest()
         mig_second.do_migration(vms, src_uri, dest_uri, migration_type,
                                 options=virsh_migrate_options, thread_timeout=thread_timeout)
+        record_results(vms, mig_second, second_bandwidth, guest_sizes)
         for vm in vms:
             mig_second.cleanup_dest_vm(vm, None, dest_uri)
 
@@ -232,19 +275,131 @@ def run(test, params, env):
         if len(fail_info):
             raise error.TestFail(fail_info)
 
+    def verify_bandwidth_accuracy(test, params, env):
+        """
+        Migrate the vm under each bandwidth cap and compare the transfer
+        rate got from domjobinfo with the cap.
+        """
+        vm = env.get_vm(vm_name)
+        check_migrate_vms([vm])
+        src_uri, dest_uri = prepare_migration(params)
+        caps = [int(cap) for cap in params.get("bandwidth_caps",
+                                               "16 32 64").split()]
+        max_deviation = float(params.get("bandwidth_max_deviation", "10"))
+        interval = float(params.get("migration_progress_interval", "0.5"))
+        stress_type = params.get("stress_type")
+        virsh_migrate_options = params.get("virsh_migrate_options",
+                                           "--live --unsafe")
+
+        results = []
+        fail_info = []
+        for cap in caps:
+            if vm.is_dead():
+                vm.start()
+            vm.wait_for_login().close()
+            set_get_speed(vm_name, cap, **virsh_dargs)
+            workloads = {}
+            if stress_type == "dirty_pages_in_vms":
+                workloads = guest_dirty_pages.start_workloads([vm], params)
+            elif stress_type:
+                utils_test.load_stress(stress_type, [vm], params)
+            guest_size = migration_results.get_guest_size(vm_name, src_uri)
+
+            sampler = migration_progress.MigrationProgressSampler(
+                vm_name, src_uri, interval)
+            sampler.start()
+            try:
+                result = virsh.migrate(vm_name, dest_uri,
+                                       virsh_migrate_options, uri=src_uri,
+                                       ignore_status=True, debug=True)
+            finally:
+                sampler.stop()
+                guest_dirty_pages.stop_workloads([vm], workloads)
+            status = result.exit_status == 0
+
+            cap_bytes = cap * 1048576.0
+            rates = migration_progress.get_transfer_rates(sampler.samples)
+            series = [{"time": rate["time"],
+                       "rate": rate["rate"] / 1048576,
+                       "deviation": (rate["rate"] - cap_bytes) * 100 /
+                       cap_bytes} for rate in rates]
+            cap_result = {"cap": cap,
+                          "completed": status,
+                          "samples": series,
+                          "mean_rate": None,
+                          "mean_deviation": None,
+                          "max_deviation": None}
+            # Mean rate over the whole job, not the mean of the intervals
+            measured = [sample for sample in sampler.samples
+                        if "data_processed" in sample and
+                        "time_elapsed" in sample]
+            if len(measured) > 1:
+                elapsed = (measured[-1]["time_elapsed"] -
+                           measured[0]["time_elapsed"])
+                processed = (measured[-1]["data_processed"] -
+                             measured[0]["data_processed"])
+                if elapsed > 0:
+                    mean_rate = processed * 1000.0 / elapsed
+                    cap_result["mean_rate"] = mean_rate / 1048576
+                    cap_result["mean_deviation"] = ((mean_rate - cap_bytes) *
+                                                    100 / cap_bytes)
+            if series:
+                cap_result["max_deviation"] = max(
+                    [sample["deviation"] for sample in series], key=abs)
+            results.append(cap_result)
+
+            migration_results.record_migration(
+                params, "virsh_migrate_set_get_speed", vm_name, status,
+                result.duration, virsh_migrate_options, src_uri, guest_size,
+                dest_uri=dest_uri, speed=cap, mean_deviation=cap_result["mean_deviation"])
+            utlv.MigrationTest().cleanup_dest_vm(vm, None, dest_uri)
+            if vm.is_alive():
+                vm.destroy(gracefully=False)
+
+            if not status:
+                fail_info.append("Migration under %s MiB/s failed: %s"
+                                 % (cap, result.stderr.strip()))
+            elif cap_result["mean_deviation"] is None:
+                fail_info.append("Migration under %s MiB/s was too short "
+                                 "to measure its rate" % cap)
+            else:
+                logging.info("Cap %s MiB/s: mean rate %.2f MiB/s, mean "
+                             "deviation %+.2f%%, max deviation %+.2f%% in "
+                             "%d intervals", cap, cap_result["mean_rate"],
+                             cap_result["mean_deviation"],
+                             cap_result["max_deviation"] or 0, len(series))
+                if abs(cap_result["mean_deviation"]) > max_deviation:
+                    fail_info.append("Mean rate under %s MiB/s deviates "
+                                     "%+.2f%%, more than %s%%"
+                                     % (cap, cap_result["mean_deviation"],
+                                        max_deviation))
+
+        result_path = os.path.join(test.resultsdir, "bandwidth_accuracy.json")
+        result_file = open(result_path, "w")
+        try:
+            json.dump(results, result_file, indent=4, sort_keys=True)
+        finally:
+            result_file.close()
+        logging.info("Bandwidth accuracy results saved to %s", result_path)
+
+        if len(fail_info):
+            raise error.TestFail(fail_info)
+
     # Run test case
     try:
         set_get_speed(vm_name, expected_value, status_error,
                       options_extra, **virsh_dargs)
         if twice_migration:
             verify_migration_speed(test, params, env)
+        elif bandwidth_accuracy:
+            verify_bandwidth_accuracy(test, params, env)
         else:
             set_get_speed(vm_name, expected_value, status_error,
                           options_extra, **virsh_dargs)
     finally:
         #restore bandwidth to default
         virsh.migrate_setspeed(vm_name, orig_value)
-        if twice_migration:
+        if twice_migration or bandwidth_accuracy:
             for vm in env.get_all_vms():
                 utlv.MigrationTest().cleanup_dest_vm(vm, src_uri, dest_uri)
                 if vm.is_alive():
@@ -11,6 +11,9 @@ from virttest import data_dir
 from virttest.utils_test import libvirt as utlv
 from virttest.libvirt_xml import vm_xml
 
+from provider import guest_dirty_pages
+from provider import migration_progress
+
 
 def set_cpu_memory(vm_name, cpu, memory):
     """
@@ -27,13 +30,21 @@ def set_cpu_memory(vm_name, cpu, memory):
 
 
 def do_stress_migration(vms, srcuri, desturi, stress_type,
-                        migration_type, params, thread_timeout=60):
+                        migration_type, params, thread_timeout=60,
+                        result_dir=None):
     """
     Migrate vms with stress.
 
     :param vms: migrated vms.
+    :param result_dir: Directory to save the migration progress samples
     """
-    fail_info = utils_test.load_stress(stress_type, vms, params)
+    workloads = {}
+    if stress_type == "dirty_pages_in_vms":
+        # Dirty guest memory at a controlled rate
+        workloads = guest_dirty_pages.start_workloads(vms, params)
+        fail_info = []
+    else:
+        fail_info = utils_test.load_stress(stress_type, vms, params)
 
     migtest = utlv.MigrationTest()
     options = ''
@@ -43,7 +54,12 @@ def do_stress_migration(vms, srcuri, desturi, stress_type,
         shared_dir = os.path.dirname(data_dir.get_data_dir())
         src_file = os.path.join(shared_dir, "scripts", "duplicate_pages.py")
         dest_dir = "/tmp"
-        for vm in vms:
+        # The dirty pages workload already controls the page content
+        if stress_type == "dirty_pages_in_vms":
+            vms_to_duplicate = []
+        else:
+            vms_to_duplicate = vms
+        for vm in vms_to_duplicate:
             session = vm.wait_for_login()
             vm.copy_files_to(src_file, dest_dir)
             status = session.cmd_status("cd /tmp;python duplicate_pages.py")
@@ -56,8 +72,16 @@ def do_stress_migration(vms, srcuri, desturi, stress_type,
     logging.debug("Starting migration...")
     migrate_options = ("--live --unsafe %s --timeout %s"
                        % (options, params.get("virsh_migrate_timeout", 60)))
-    migtest.do_migration(vms, srcuri, desturi, migration_type, options=migrate_options,
-                         thread_timeout=thread_timeout)
+    samplers = migration_progress.create_samplers([vm.name for vm in vms],
+                                                  params, srcuri)
+    try:
+        migtest.do_migration(vms, srcuri, desturi, migration_type,
+                             options=migrate_options,
+                             thread_timeout=thread_timeout)
+    finally:
+        not_converged = migration_progress.report_samplers(
+            samplers, migtest.RET_MIGRATION, params, result_dir)
+        guest_dirty_pages.stop_workloads(vms, workloads)
 
     # vms will be shutdown, so no need to do this cleanup
     # And migrated vms may be not login if the network is local lan
@@ -66,6 +90,11 @@ def do_stress_migration(vms, srcuri, desturi, stress_type,
 
     if not migtest.RET_MIGRATION:
         raise error.TestFail()
+    if (not_converged and
+            params.get("migration_fail_not_converged", "no") == "yes"):
+        raise error.TestFail("Migration of %s did not converge."
+                             % ", ".join([report["vm"] for report in
+                                          not_converged]))
 
 
 def run(test, params, env):
@@ -139,7 +168,8 @@ def run(test, params, env):
         ssh_key.setup_ssh_key(remote_host, username, password, port=22)
 
         do_stress_migration(vms, src_uri, dest_uri, stress_type,
-                            migration_type, params, thread_timeout)
+                            migration_type, params, thread_timeout,
+                            test.resultsdir)
         # Check network of vms on destination
         if start_migration_vms and migration_type != "cross":
             for vm in vms:
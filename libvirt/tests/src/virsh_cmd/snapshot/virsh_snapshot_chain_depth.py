@@ -0,0 +1,204 @@
+import os
+import time
+import logging
+
+from avocado.core import exceptions
+
+from virttest import virsh
+from virttest.libvirt_xml import vm_xml
+from virttest.libvirt_xml.devices.disk import Disk
+from virttest.utils_test import libvirt
+
+from provider import disk_generator
+from provider import guest_fio
+
+# Serial of the chain disk, to find it in guest
+DISK_SERIAL = "chaindepth"
+
+TABLE_COLUMNS = (("depth", "depth", "%s"),
+                 ("snapshot_create_time", "create(s)", "%.3f"),
+                 ("snapshot_list_time", "list(s)", "%.3f"),
+                 ("start_time", "start(s)", "%.2f"),
+                 ("iops", "IOPS", "%.0f"),
+                 ("lat_mean_us", "mean(us)", "%.1f"),
+                 ("lat_p50_us", "p50(us)", "%.1f"),
+                 ("lat_p99_us", "p99(us)", "%.1f"),
+                 ("commit_time", "commit(s)", "%.2f"))
+
+
+def set_chain_disk(vmxml, image, target):
+    """
+    Add the disk to build the chain on to the vm xml.
+
+    :param vmxml: VMXML of the vm, not synced
+    :param image: Path of the qcow2 base image
+    :param target: Target dev of the disk
+    """
+    disk_xml = Disk(type_name="file")
+    disk_xml.device = "disk"
+    disk_xml.source = disk_xml.new_disk_source(**{"attrs": {"file": image}})
+    disk_xml.target = {"dev": target, "bus": "virtio"}
+    # Bypass the host page cache, so reads walk through the chain
+    disk_xml.driver = {"name": "qemu", "type": "qcow2", "cache": "none"}
+    disk_xml.serial = DISK_SERIAL
+    vmxml.add_device(disk_xml)
+
+
+def delete_snapshots(vm_name):
+    """
+    Delete the metadata of all snapshots of a vm, the overlays are left.
+    """
+    for snapshot in virsh.snapshot_list(vm_name):
+        virsh.snapshot_delete(vm_name, snapshot, "--metadata",
+                              ignore_status=True)
+
+
+def run(test, params, env):
+    """
+    Test how a vm scales with the depth of the backing chain of a disk.
+
+    For each depth N:
+    1) Add a qcow2 disk filled with data to the vm and start it.
+    2) Create N external disk only snapshots of it, write a chunk to the
+       disk in guest before each one, so every overlay has data.
+    3) Take the time of virsh snapshot-list.
+    4) Restart the vm and take the time of virsh start.
+    5) Run a fio read job on the disk in guest for the read latency.
+    6) Flatten the chain by virsh blockcommit --active --pivot and take
+       the time.
+    Save the results of all depths to one table.
+    """
+    vm_name = params.get("main_vm")
+    vm = env.get_vm(vm_name)
+    depths = sorted([int(depth) for depth in
+                     params.get("chain_depths", "1 10 50 100 200").split()])
+    target = params.get("chain_disk_target", "vdb")
+    disk_size = params.get("chain_disk_size", "1G")
+    fill_ratio = float(params.get("chain_fill_ratio", 0.5))
+    image_dir = params.get("chain_image_dir", test.tmpdir)
+    # Size of the chunk written in guest before each snapshot, in KiB
+    chunk_size = int(params.get("chain_chunk_size", 64))
+    list_repeat = int(params.get("chain_list_repeat", 5))
+    job = params.get("chain_read_job", "randread:4k:1")
+    runtime = int(params.get("chain_read_runtime", 20))
+    fio = params.get("chain_fio", "fio")
+    commit_timeout = int(params.get("chain_commit_timeout", 1800))
+    guest_fio.parse_job(job)
+    # Spread the chunks over the disk, one for each overlay
+    stride = disk_generator.parse_size(disk_size) // 1024 // chunk_size
+    stride //= max(depths)
+    if not stride:
+        raise exceptions.TestError("Disk %s is too small for %d chunks of "
+                                   "%sK" % (disk_size, max(depths),
+                                            chunk_size))
+
+    vmxml_backup = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+    base_image = os.path.join(image_dir, "chaindepth.base.qcow2")
+    overlays = []
+    rows = []
+    try:
+        for depth in depths:
+            if vm.is_alive():
+                vm.destroy(gracefully=False)
+            vmxml_backup.sync()
+            disk_generator.create_disk(base_image, disk_size, "qcow2",
+                                       fill_ratio)
+            vmxml = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+            set_chain_disk(vmxml, base_image, target)
+            vmxml.sync()
+            vm.start()
+            session = vm.wait_for_login()
+            try:
+                guest_fio.check_fio(session, fio)
+                device = guest_fio.get_disk_by_serial(session, DISK_SERIAL)
+                if not device:
+                    raise exceptions.TestFail("No disk with serial %s in "
+                                              "guest" % DISK_SERIAL)
+                create_time = 0.0
+                for index in range(depth):
+                    cmd = ("dd if=/dev/urandom of=%s bs=%sk count=1 seek=%d "
+                           "oflag=direct" % (device, chunk_size,
+                                             index * stride))
+                    status, output = session.cmd_status_output(cmd)
+                    if status:
+                        raise exceptions.TestFail("Failed to write %s in "
+                                                  "guest: %s" %
+                                                  (device, output))
+                    overlay = os.path.join(image_dir, "chaindepth.%d.qcow2"
+                                           % (index + 1))
+                    overlays.append(overlay)
+                    options = ("chain%d --disk-only --atomic --diskspec "
+                               "vda,snapshot=no --diskspec %s,snapshot="
+                               "external,file=%s" % (index + 1, target,
+                                                     overlay))
+                    start_time = time.time()
+                    ret = virsh.snapshot_create_as(vm_name, options,
+                                                   ignore_status=True)
+                    create_time += time.time() - start_time
+                    libvirt.check_exit_status(ret)
+                session.cmd("sync")
+            finally:
+                session.close()
+
+            start_time = time.time()
+            for _ in range(list_repeat):
+                snapshots = virsh.snapshot_list(vm_name)
+            list_time = (time.time() - start_time) / list_repeat
+            if len(snapshots) != depth:
+                raise exceptions.TestFail("Expect %d snapshots, got %s" %
+                                          (depth, snapshots))
+
+            vm.destroy(gracefully=False)
+            start_time = time.time()
+            ret = virsh.start(vm_name, ignore_status=True, debug=True)
+            vm_start_time = time.time() - start_time
+            libvirt.check_exit_status(ret)
+
+            session = vm.wait_for_login()
+            try:
+                device = guest_fio.get_disk_by_serial(session, DISK_SERIAL)
+                fio_result = guest_fio.run_fio(session, [device], job,
+                                               runtime, fio=fio,
+                                               extra="--readonly")
+            finally:
+                session.close()
+
+            start_time = time.time()
+            ret = virsh.blockcommit(vm_name, target,
+                                    "--active --pivot --wait --verbose "
+                                    "--timeout %s" % commit_timeout,
+                                    ignore_status=True, debug=True)
+            commit_time = time.time() - start_time
+            libvirt.check_exit_status(ret)
+
+            row = {"depth": depth,
+                   "snapshot_create_time": create_time / depth,
+                   "snapshot_list_time": list_time,
+                   "start_time": vm_start_time,
+                   "commit_time": commit_time}
+            row.update(fio_result.get("read", {}))
+            rows.append(row)
+            logging.info("Chain depth %d: start %.2fs, snapshot-list %.3fs, "
+                         "read p99 %s us, commit %.2fs", depth, vm_start_time,
+                         list_time, row.get("lat_p99_us"), commit_time)
+
+            vm.destroy(gracefully=False)
+            delete_snapshots(vm_name)
+            for overlay in overlays:
+                if os.path.exists(overlay):
+                    os.remove(overlay)
+            overlays = []
+    finally:
+        if vm.is_alive():
+            vm.destroy(gracefully=False)
+        delete_snapshots(vm_name)
+        vmxml_backup.sync()
+        for image in overlays + [base_image]:
+            if os.path.exists(image):
+                os.remove(image)
+
+        if rows:
+            table = guest_fio.save_table(rows, TABLE_COLUMNS,
+                                         test.resultsdir, "chain_depth",
+                                         {"job": job})
+            logging.info("Backing chain depth results:\n%s", table)
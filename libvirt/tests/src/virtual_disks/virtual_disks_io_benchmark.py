@@ -0,0 +1,224 @@
+import os
+import logging
+
+from avocado.core import exceptions
+
+from virttest import virsh
+from virttest.libvirt_xml import vm_xml
+from virttest.libvirt_xml.devices.disk import Disk
+from virttest.libvirt_xml.devices.controller import Controller
+from virttest.staging.backports import itertools
+
+from provider import disk_generator
+from provider import guest_fio
+
+# Serial of the benchmark disk, to find it in guest
+DISK_SERIAL = "iobench"
+
+TARGET_DEVS = {"virtio": "vdb",
+               "scsi": "sdb",
+               "sata": "sdb"}
+
+TABLE_COLUMNS = (("bus", "bus", "%s"),
+                 ("cache", "cache", "%s"),
+                 ("io", "io", "%s"),
+                 ("iothreads", "iothreads", "%s"),
+                 ("format", "format", "%s"),
+                 ("job", "job", "%s"),
+                 ("direction", "dir", "%s"),
+                 ("iops", "IOPS", "%.0f"),
+                 ("bw_mib", "MiB/s", "%.2f"),
+                 ("lat_mean_us", "mean(us)", "%.1f"),
+                 ("lat_p50_us", "p50(us)", "%.1f"),
+                 ("lat_p99_us", "p99(us)", "%.1f"),
+                 ("lat_p99.9_us", "p99.9(us)", "%.1f"))
+
+
+def get_points(params):
+    """
+    Get the disk configurations to benchmark from params.
+
+    io=native needs the host page cache bypassed, so it is only combined
+    with cache none and directsync. Iothreads are only combined with
+    virtio disks and the virtio-scsi controller of scsi disks.
+
+    :return: List of dicts of bus, cache, io, iothreads and format
+    """
+    points = []
+    for bus, cache, io_mode, iothreads, img_format in itertools.product(
+            params.get("io_bench_buses", "virtio scsi sata").split(),
+            params.get("io_bench_caches", "none writeback").split(),
+            params.get("io_bench_io_modes", "native threads").split(),
+            params.get("io_bench_iothreads", "0 1").split(),
+            params.get("io_bench_formats", "raw qcow2").split()):
+        if io_mode == "native" and cache not in ("none", "directsync"):
+            continue
+        if int(iothreads) and bus == "sata":
+            continue
+        points.append({"bus": bus,
+                       "cache": cache,
+                       "io": io_mode,
+                       "iothreads": int(iothreads),
+                       "format": img_format})
+    return points
+
+
+def is_skippable(point, skippable):
+    """
+    Check whether a point is allowed to fail to start.
+
+    :param point: Dict got by get_points()
+    :param skippable: List of "key=value", a point matching any of them
+                      is allowed to fail to start, such as "bus=sata"
+    """
+    for item in skippable:
+        key, value = item.split("=", 1)
+        if str(point.get(key)) == value:
+            return True
+    return False
+
+
+def set_disk(vmxml, point, image):
+    """
+    Add the benchmark disk of a point to the vm xml.
+
+    :param vmxml: VMXML of the vm, not synced
+    :param point: Dict got by get_points()
+    :param image: Path of the disk image
+    """
+    driver = {"name": "qemu",
+              "type": point["format"],
+              "cache": point["cache"],
+              "io": point["io"]}
+    if point["iothreads"]:
+        del vmxml.cputune
+        del vmxml.iothreadids
+        vmxml.iothreads = point["iothreads"]
+        if point["bus"] == "virtio":
+            driver["iothread"] = "1"
+    if point["bus"] == "scsi":
+        scsi_controller = Controller("controller")
+        scsi_controller.type = "scsi"
+        scsi_controller.index = "0"
+        scsi_controller.model = "virtio-scsi"
+        if point["iothreads"]:
+            scsi_controller.driver = {"iothread": "1"}
+        vmxml.del_controller("scsi")
+        vmxml.add_device(scsi_controller)
+
+    disk_xml = Disk(type_name="file")
+    disk_xml.device = "disk"
+    disk_xml.source = disk_xml.new_disk_source(**{"attrs": {"file": image}})
+    disk_xml.target = {"dev": TARGET_DEVS[point["bus"]], "bus": point["bus"]}
+    disk_xml.driver = driver
+    disk_xml.serial = DISK_SERIAL
+    logging.debug("Benchmark disk xml: %s", disk_xml)
+    vmxml.add_device(disk_xml)
+
+
+def run(test, params, env):
+    """
+    Benchmark disk I/O of disk configurations.
+
+    1) Get the disk configurations from the buses, caches, io modes,
+       iothreads and formats in params.
+    2) For each of them, add a disk to the vm and start it.
+    3) Run each fio job on the disk in guest.
+    4) Save the IOPS, bandwidth and latency percentiles of all of them
+       to one table, with the configurations the vm failed to start with.
+    5) Fail if no configuration was measured, or one not matching
+       io_bench_skippable failed to start.
+    """
+    vm_name = params.get("main_vm")
+    vm = env.get_vm(vm_name)
+    jobs = params.get("io_bench_jobs", "randread:4k:32 randwrite:4k:32").split()
+    runtime = int(params.get("io_bench_runtime", 30))
+    numjobs = int(params.get("io_bench_numjobs", 1))
+    fio = params.get("io_bench_fio", "fio")
+    disk_size = params.get("io_bench_disk_size", "2G")
+    fill_ratio = float(params.get("io_bench_fill_ratio", 1.0))
+    image_dir = params.get("io_bench_image_dir", test.tmpdir)
+    skippable = params.get("io_bench_skippable", "").split()
+
+    for job in jobs:
+        guest_fio.parse_job(job)
+    points = get_points(params)
+    if not points:
+        raise exceptions.TestSkipError("No disk configuration to benchmark")
+    logging.info("Benchmark %d disk configurations with jobs %s",
+                 len(points), jobs)
+
+    vmxml_backup = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+    rows = []
+    skipped = []
+    image = None
+    try:
+        for point in points:
+            if vm.is_alive():
+                vm.destroy(gracefully=False)
+            vmxml_backup.sync()
+            image = os.path.join(image_dir, "iobench.%s" % point["format"])
+            # Allocate the whole image, so that writes do not measure
+            # the allocation of the image
+            disk_generator.create_disk(image, disk_size, point["format"],
+                                       fill_ratio, sparse=False)
+            vmxml = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+            set_disk(vmxml, point, image)
+            vmxml.sync()
+            result = virsh.start(vm_name, ignore_status=True, debug=True)
+            if result.exit_status:
+                logging.warning("Skip %s, vm failed to start: %s", point,
+                                result.stderr.strip())
+                skipped.append({"point": point,
+                                "reason": result.stderr.strip()})
+                os.remove(image)
+                continue
+
+            session = vm.wait_for_login()
+            try:
+                guest_fio.check_fio(session, fio)
+                device = guest_fio.get_disk_by_serial(session, DISK_SERIAL)
+                if not device:
+                    raise exceptions.TestFail("No disk with serial %s in "
+                                              "guest for %s" %
+                                              (DISK_SERIAL, point))
+                for job in jobs:
+                    fio_result = guest_fio.run_fio(session, [device], job,
+                                                   runtime, numjobs, fio)
+                    for direction, stats in sorted(fio_result.items()):
+                        row = dict(point)
+                        row.update(stats)
+                        row["job"] = job
+                        row["direction"] = direction
+                        row["bw_mib"] = stats["bw"] / 1048576.0
+                        rows.append(row)
+                        logging.info("%s %s %s: %.0f IOPS, %.2f MiB/s, p99 "
+                                     "%s us", point, job, direction,
+                                     stats["iops"], row["bw_mib"],
+                                     stats["lat_p99_us"])
+            finally:
+                session.close()
+            vm.destroy(gracefully=False)
+            os.remove(image)
+    finally:
+        if vm.is_alive():
+            vm.destroy(gracefully=False)
+        vmxml_backup.sync()
+        if image and os.path.exists(image):
+            os.remove(image)
+
+        if rows or skipped:
+            table = guest_fio.save_table(rows, TABLE_COLUMNS,
+                                         test.resultsdir, "io_benchmark",
+                                         {"skipped": skipped})
+            logging.info("Disk I/O benchmark results:\n%s", table)
+
+    if not rows:
+        raise exceptions.TestFail("No disk configuration was measured, "
+                                  "the vm failed to start with all of them")
+    unexpected = [item["point"] for item in skipped
+                  if not is_skippable(item["point"], skippable)]
+    if unexpected:
+        raise exceptions.TestFail("The vm failed to start with %d disk "
+                                  "configurations: %s" %
+                                  (len(unexpected), unexpected))
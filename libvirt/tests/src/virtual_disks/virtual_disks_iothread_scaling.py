@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import logging
+
+from avocado.core import exceptions
+
+from virttest import virsh
+from virttest import utils_misc
+from virttest.libvirt_xml import vm_xml
+from virttest.libvirt_xml.devices.disk import Disk
+from virttest.utils_test import libvirt
+
+from provider import disk_generator
+from provider import guest_fio
+
+# Serial prefix of the benchmark disks, to find them in guest
+DISK_SERIAL = "iothscale"
+
+TABLE_COLUMNS = (("iothreads", "iothreads", "%s"),
+                 ("disks", "disks", "%s"),
+                 ("direction", "dir", "%s"),
+                 ("iops", "IOPS", "%.0f"),
+                 ("bw_mib", "MiB/s", "%.2f"),
+                 ("lat_p99_us", "p99(us)", "%.1f"),
+                 ("iothread_cpu", "iothread CPU%", "%.1f"),
+                 ("max_iothread_cpu", "max/iothread CPU%", "%.1f"),
+                 ("qemu_cpu", "qemu CPU%", "%.1f"),
+                 ("iops_per_cpu", "IOPS/CPU%", "%.0f"))
+
+
+def get_cpu_ticks(pid, tid=None):
+    """
+    Get the user and system CPU time of a process or one of its threads.
+
+    :param pid: Process id
+    :param tid: Thread id, None means the whole process
+    :return: CPU time in clock ticks
+    """
+    if tid is None:
+        stat_path = "/proc/%s/stat" % pid
+    else:
+        stat_path = "/proc/%s/task/%s/stat" % (pid, tid)
+    stat_file = open(stat_path)
+    try:
+        stat = stat_file.read()
+    finally:
+        stat_file.close()
+    # The command name may contain spaces, the fields after it are fixed
+    fields = stat[stat.rindex(")") + 2:].split()
+    return int(fields[11]) + int(fields[12])
+
+
+def get_iothread_tids(vm_name):
+    """
+    Get the host thread ids of the iothreads of a vm.
+
+    :return: Dict of {iothread_id: thread_id}, like {"1": 12345}
+    """
+    ret = virsh.qemu_monitor_command(vm_name,
+                                     '{"execute": "query-iothreads"}',
+                                     "--pretty")
+    libvirt.check_exit_status(ret)
+    tids = {}
+    for iothread in json.loads(ret.stdout)["return"]:
+        tids[iothread["id"].replace("iothread", "")] = iothread["thread-id"]
+    return tids
+
+
+def set_disks(vmxml, images, iothreads, driver):
+    """
+    Add the benchmark disks to the vm xml, spread over the iothreads.
+
+    :param vmxml: VMXML of the vm, not synced
+    :param images: List of paths of the disk images
+    :param iothreads: Count of iothreads, 0 means no iothread
+    :param driver: Dict of the driver attributes of the disks
+    """
+    del vmxml.cputune
+    del vmxml.iothreadids
+    if iothreads:
+        vmxml.iothreads = iothreads
+    else:
+        del vmxml.iothreads
+    for index, image in enumerate(images):
+        disk_xml = Disk(type_name="file")
+        disk_xml.device = "disk"
+        disk_xml.source = disk_xml.new_disk_source(
+            **{"attrs": {"file": image}})
+        # Leave vda to the system disk
+        disk_xml.target = {"dev": "vd%s" % chr(ord("b") + index),
+                           "bus": "virtio"}
+        disk_driver = dict(driver)
+        if iothreads:
+            disk_driver["iothread"] = str(index % iothreads + 1)
+        disk_xml.driver = disk_driver
+        disk_xml.serial = "%s%d" % (DISK_SERIAL, index)
+        vmxml.add_device(disk_xml)
+
+
+def run(test, params, env):
+    """
+    Benchmark how disk I/O scales with the count of iothreads.
+
+    1) Create N disk images.
+    2) For each count of iothreads M, add the N disks to the vm spread
+       over M iothreads and start it.
+    3) Pin each iothread to a host CPU by virsh iothreadpin.
+    4) Run a fio job on all the disks in guest, take the CPU time of each
+       iothread and of qemu on host meanwhile.
+    5) Save the aggregate IOPS and host CPU usage of each count, and the
+       fewest iothreads reaching the best IOPS within the tolerance.
+    """
+    vm_name = params.get("main_vm")
+    vm = env.get_vm(vm_name)
+    disk_count = int(params.get("iothread_scaling_disks", 8))
+    if disk_count > 24:
+        raise exceptions.TestError("At most 24 disks are supported, got %s"
+                                   % disk_count)
+    counts = [int(count) for count in
+              params.get("iothread_scaling_counts", "1 2 4 8").split()]
+    job = params.get("iothread_scaling_job", "randread:4k:32")
+    runtime = int(params.get("iothread_scaling_runtime", 30))
+    numjobs = int(params.get("iothread_scaling_numjobs", 1))
+    fio = params.get("iothread_scaling_fio", "fio")
+    disk_size = params.get("iothread_scaling_disk_size", "1G")
+    img_format = params.get("iothread_scaling_format", "raw")
+    image_dir = params.get("iothread_scaling_image_dir", test.tmpdir)
+    host_cpus = params.get("iothread_scaling_host_cpus", "").split()
+    if not host_cpus:
+        host_cpus = utils_misc.get_cpu_processors()
+    # Fewer iothreads are good enough if their IOPS is within it
+    tolerance = float(params.get("iothread_scaling_tolerance", 5))
+    driver = {"name": "qemu",
+              "type": img_format,
+              "cache": params.get("iothread_scaling_cache", "none"),
+              "io": params.get("iothread_scaling_io", "native")}
+    guest_fio.parse_job(job)
+    clock_ticks = float(os.sysconf("SC_CLK_TCK"))
+
+    vmxml_backup = vm_xml.VMXML.new_from_inactive_dumpxml(vm_name)
+    images = []
+    rows = []
+    try:
+        for index in range(disk_count):
+            image = os.path.join(image_dir, "iothscale%d.%s" %
+                                 (index, img_format))
+            disk_generator.create_disk(image, disk_size, img_format, 1.0,
+                                       sparse=False)
+            images.append(image)
+
+        for iothreads in counts:
+            if vm.is_alive():
+                vm.destroy(gracefully=False)
+            vmxml = vmxml_backup.copy()
+            set_disks(vmxml, images, iothreads, driver)
+            vmxml.sync()
+            vm.start()
+            session = vm.wait_for_login()
+            try:
+                guest_fio.check_fio(session, fio)
+                devices = []
+                for index in range(disk_count):
+                    device = guest_fio.get_disk_by_serial(
+                        session, "%s%d" % (DISK_SERIAL, index))
+                    if not device:
+                        raise exceptions.TestFail("Disk %d is not found in "
+                                                  "guest" % index)
+                    devices.append(device)
+
+                tids = get_iothread_tids(vm_name)
+                if len(tids) != iothreads:
+                    raise exceptions.TestFail("Expect %d iothreads, got %s"
+                                              % (iothreads, tids))
+                for iothread_id in sorted(tids):
+                    cpu = host_cpus[(int(iothread_id) - 1) % len(host_cpus)]
+                    ret = virsh.iothreadpin(vm_name, iothread_id, cpu,
+                                            "--live", debug=True,
+                                            ignore_status=True)
+                    libvirt.check_exit_status(ret)
+
+                pid = vm.get_pid()
+                start_ticks = dict([(iothread_id, get_cpu_ticks(pid, tid))
+                                    for iothread_id, tid in tids.items()])
+                start_qemu_ticks = get_cpu_ticks(pid)
+                start_time = time.time()
+                fio_result = guest_fio.run_fio(session, devices, job,
+                                               runtime, numjobs, fio)
+                elapsed = time.time() - start_time
+                qemu_cpu = ((get_cpu_ticks(pid) - start_qemu_ticks) /
+                            clock_ticks / elapsed * 100)
+                iothread_cpus = dict([(iothread_id,
+                                       (get_cpu_ticks(pid, tid) -
+                                        start_ticks[iothread_id]) /
+                                       clock_ticks / elapsed * 100)
+                                      for iothread_id, tid in tids.items()])
+            finally:
+                session.close()
+            logging.info("%d iothreads, CPU usage of each: %s, qemu: %.1f%%",
+                         iothreads, iothread_cpus, qemu_cpu)
+
+            for direction, stats in sorted(fio_result.items()):
+                row = dict(stats)
+                row["iothreads"] = iothreads
+                row["disks"] = disk_count
+                row["direction"] = direction
+                row["bw_mib"] = stats["bw"] / 1048576.0
+                row["qemu_cpu"] = qemu_cpu
+                row["iothread_cpus"] = iothread_cpus
+                row["iothread_cpu"] = sum(iothread_cpus.values())
+                row["max_iothread_cpu"] = (iothread_cpus and
+                                           max(iothread_cpus.values()) or
+                                           None)
+                # Without iothreads the I/O runs in the main loop of qemu
+                cpu = iothreads and row["iothread_cpu"] or qemu_cpu
+                row["iops_per_cpu"] = cpu and stats["iops"] / cpu or None
+                rows.append(row)
+            vm.destroy(gracefully=False)
+    finally:
+        if vm.is_alive():
+            vm.destroy(gracefully=False)
+        vmxml_backup.sync()
+        for image in images:
+            if os.path.exists(image):
+                os.remove(image)
+
+    # Fewest iothreads within the tolerance of the best IOPS
+    summary = {}
+    for direction in sorted(set([result["direction"] for result in rows])):
+        direction_rows = [result for result in rows
+                          if result["direction"] == direction]
+        best_iops = max([result["iops"] for result in direction_rows])
+        enough = [result["iothreads"] for result in direction_rows
+                  if result["iops"] >= best_iops * (1 - tolerance / 100.0)]
+        summary[direction] = {"best_iops": best_iops,
+                              "recommended_iothreads": min(enough)}
+        logging.info("%s: best %.0f IOPS, %d iothreads are enough for %d "
+                     "disks", direction, best_iops, min(enough), disk_count)
+
+    table = guest_fio.save_table(rows, TABLE_COLUMNS, test.resultsdir,
+                                 "iothread_scaling",
+                                 {"job": job, "summary": summary})
+    logging.info("Iothread scaling results of job %s:\n%s", job, table)
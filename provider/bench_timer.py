@@ -0,0 +1,165 @@
+"""
+Shared code for benchmark tests that need to record operation latencies
+"""
+
+import os
+import csv
+import json
+import math
+import time
+import logging
+import threading
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    """
+    Get the nearest-rank percentile of values.
+
+    :param values: List of numbers
+    :param percent: Percentile to get, from 0 to 100
+    :return: The percentile value, or None if values is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class LatencyRecorder(object):
+
+    """
+    Record wall-clock latency of operations, it is safe to share an
+    instance between threads.
+    """
+
+    def __init__(self, name="latency"):
+        """
+        :param name: Name of the recorder, used as prefix of result files
+        """
+        self.name = name
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, latency):
+        """
+        Add a latency sample of operation.
+
+        :param operation: Name of the operation, such as "start"
+        :param latency: Latency in seconds
+        """
+        self.lock.acquire()
+        try:
+            self.samples.setdefault(operation, []).append(latency)
+        finally:
+            self.lock.release()
+
+    def timed(self, operation, func, *args, **kwargs):
+        """
+        Call func with args and record the time it took as operation.
+
+        The latency is recorded even if func raises an exception.
+
+        :param operation: Name of the operation
+        :param func: Function to call
+        :return: Return value of func
+        """
+        start_time = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(operation, time.time() - start_time)
+
+    def wrap(self, operation, func):
+        """
+        Get a function which calls func and records its latency.
+
+        :param operation: Name of the operation
+        :param func: Function to wrap
+        :return: The wrapper function
+        """
+        def wrapper(*args, **kwargs):
+            return self.timed(operation, func, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+    def get(self, operation):
+        """
+        Get a copy of the samples of operation.
+        """
+        self.lock.acquire()
+        try:
+            return list(self.samples.get(operation, []))
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        """
+        Get statistics of each operation.
+
+        :return: Dict like {operation: {"count": 3, "min": 0.1,
+                 "avg": 0.2, "p50": 0.2, "p90": 0.3, "p99": 0.3,
+                 "max": 0.3}}
+        """
+        self.lock.acquire()
+        try:
+            samples = dict((key, list(value))
+                           for key, value in self.samples.items())
+        finally:
+            self.lock.release()
+        result = {}
+        for operation, values in samples.items():
+            if not values:
+                continue
+            stats = {"count": len(values),
+                     "min": min(values),
+                     "avg": sum(values) / len(values),
+                     "max": max(values)}
+            for percent in PERCENTILES:
+                stats["p%d" % percent] = percentile(values, percent)
+            result[operation] = stats
+        return result
+
+    def log_summary(self):
+        """
+        Log statistics of each operation.
+        """
+        for operation, stats in sorted(self.summary().items()):
+            logging.info("%s: %d samples, p50 %.3fs p90 %.3fs p99 %.3fs "
+                         "max %.3fs", operation, stats["count"],
+                         stats["p50"], stats["p90"], stats["p99"],
+                         stats["max"])
+
+    def save(self, result_dir):
+        """
+        Save statistics to <name>.json and <name>.csv in result_dir.
+
+        :param result_dir: Directory to save the result files
+        :return: Tuple of the json and csv file paths
+        """
+        summary = self.summary()
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+        json_path = os.path.join(result_dir, "%s.json" % self.name)
+        csv_path = os.path.join(result_dir, "%s.csv" % self.name)
+        json_file = open(json_path, "w")
+        try:
+            json.dump(summary, json_file, indent=4, sort_keys=True)
+        finally:
+            json_file.close()
+        fields = (["operation", "count", "min", "avg"] +
+                  ["p%d" % percent for percent in PERCENTILES] + ["max"])
+        csv_file = open(csv_path, "w")
+        try:
+            writer = csv.writer(csv_file)
+            writer.writerow(fields)
+            for operation, stats in sorted(summary.items()):
+                writer.writerow([operation] +
+                                [stats[field] for field in fields[1:]])
+        finally:
+            csv_file.close()
+        logging.info("Latency results saved to %s and %s",
+                     json_path, csv_path)
+        return json_path, csv_path
@@ -0,0 +1,397 @@
+"""
+Shared code for block job tests that need to follow the progress of a
+blockcopy, blockcommit or blockpull job.
+
+BlockJobMonitor polls "virsh blockjob --info --raw" in a background
+thread at sub-second intervals, get_report() gives the achieved rate
+against the bandwidth limit, the time to get ready and how well the ETA
+could be predicted while the job ran.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from avocado.core import exceptions
+
+from virttest import virsh
+from virttest import utils_misc
+
+
+def parse_blockjob_raw(output):
+    """
+    Parse the output of virsh blockjob --info --raw.
+
+    :param output: Output like " type=Block Copy\n bandwidth=0\n cur=12\n
+                   end=34"
+    :return: Dict of type, bandwidth, cur and end, empty if no job
+    """
+    info = {}
+    for line in output.splitlines():
+        if "=" not in line:
+            continue
+        key, value = line.strip().split("=", 1)
+        if key in ("bandwidth", "cur", "end"):
+            info[key] = int(value)
+        else:
+            info[key] = value
+    if "cur" not in info or "end" not in info:
+        return {}
+    return info
+
+
+class BlockJobMonitor(object):
+
+    """
+    Poll the block job of a disk at a fixed interval and keep the samples.
+    """
+
+    def __init__(self, vm_name, target, interval=0.2, uri=None):
+        """
+        :param vm_name: Name of the vm
+        :param target: Target dev of the disk, such as vda
+        :param interval: Seconds between two samples
+        :param uri: URI of the host, None means the default one
+        """
+        self.vm_name = vm_name
+        self.target = target
+        self.interval = interval
+        self.uri = uri
+        self.samples = []
+        self.start_time = None
+        self.ready_time = None
+        self.end_time = None
+        self.ready_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get_info(self):
+        """
+        Get the current info of the block job.
+
+        :return: Dict got by parse_blockjob_raw()
+        """
+        result = virsh.blockjob(self.vm_name, self.target, "--info --raw",
+                                uri=self.uri, ignore_status=True)
+        if result.exit_status:
+            return {}
+        return parse_blockjob_raw(result.stdout)
+
+    def _sample_loop(self):
+        while not self.stop_event.is_set():
+            sample_time = time.time()
+            info = self.get_info()
+            if info:
+                info["time"] = sample_time - self.start_time
+                self.samples.append(info)
+                if (self.ready_time is None and info["end"] and
+                        info["cur"] == info["end"]):
+                    self.ready_time = info["time"]
+                    self.ready_event.set()
+            elif self.samples and self.end_time is None:
+                # The job was seen before, so it is gone now
+                self.end_time = sample_time - self.start_time
+                self.ready_event.set()
+            self.stop_event.wait(max(0, sample_time + self.interval -
+                                     time.time()))
+
+    def start(self):
+        """
+        Start sampling in a background thread, call it before starting
+        the job to get its whole progress.
+        """
+        self.start_time = time.time()
+        self.stop_event.clear()
+        self.ready_event.clear()
+        self.thread = threading.Thread(target=self._sample_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        logging.debug("Took %d block job samples of %s %s",
+                      len(self.samples), self.vm_name, self.target)
+
+    def wait_ready(self, timeout):
+        """
+        Wait until the job is ready, that is all the data is copied, or
+        until the job is gone.
+
+        :param timeout: Seconds to wait
+        :return: True if the job got ready, False otherwise
+        """
+        self.ready_event.wait(timeout)
+        return self.ready_time is not None
+
+    def pivot(self, timeout=60):
+        """
+        Pivot to the destination of a ready job and take the time until
+        the job is gone.
+
+        :param timeout: Seconds to wait for the job to be gone
+        :return: Seconds the pivot took
+        :raise: TestFail if the pivot failed
+        """
+        start_time = time.time()
+        result = virsh.blockjob(self.vm_name, self.target, "--pivot",
+                                uri=self.uri, ignore_status=True, debug=True)
+        if result.exit_status:
+            raise exceptions.TestFail("Failed to pivot %s of %s: %s" %
+                                      (self.target, self.vm_name,
+                                       result.stderr.strip()))
+        if not utils_misc.wait_for(lambda: not self.get_info(), timeout,
+                                   step=0.05):
+            raise exceptions.TestFail("Block job of %s is still there %ss "
+                                      "after pivot" % (self.target, timeout))
+        return time.time() - start_time
+
+    def get_report(self, limit=None):
+        """
+        Analyse the samples of the job.
+
+        :param limit: Bandwidth limit of the job in bytes/s, None if there
+                      is no limit
+        :return: Dict of the report
+        """
+        samples = self.samples
+        report = {"vm": self.vm_name,
+                  "target": self.target,
+                  "samples": len(samples),
+                  "limit": limit,
+                  "time_to_ready": self.ready_time,
+                  "end_time": self.end_time}
+        if not samples:
+            return report
+        first = samples[0]
+        report["type"] = first.get("type")
+        report["first_sample_time"] = first["time"]
+        report["total_bytes"] = samples[-1]["end"]
+
+        # Samples until ready, after it only new writes are mirrored
+        copying = [sample for sample in samples
+                   if self.ready_time is None or
+                   sample["time"] <= self.ready_time]
+        last = copying[-1]
+        elapsed = last["time"] - first["time"]
+        rates = []
+        for before, after in zip(copying, copying[1:]):
+            interval = after["time"] - before["time"]
+            if interval > 0:
+                rates.append({"time": after["time"],
+                              "rate": (after["cur"] - before["cur"]) /
+                              interval})
+        report["rates"] = rates
+        report["mean_rate"] = (elapsed > 0 and
+                               (last["cur"] - first["cur"]) / elapsed or None)
+        if limit and report["mean_rate"] is not None:
+            report["mean_deviation"] = ((report["mean_rate"] - limit) *
+                                        100.0 / limit)
+            report["max_rate"] = max([rate["rate"] for rate in rates])
+            report["max_deviation"] = ((report["max_rate"] - limit) *
+                                       100.0 / limit)
+
+        # ETA predicted at each sample by the mean rate so far
+        if self.ready_time is not None:
+            eta_errors = []
+            for sample in copying[1:]:
+                done = sample["cur"] - first["cur"]
+                spent = sample["time"] - first["time"]
+                if done <= 0 or spent <= 0:
+                    continue
+                eta = sample["time"] + (sample["end"] - sample["cur"]) * \
+                    spent / done
+                eta_errors.append(eta - self.ready_time)
+            if eta_errors:
+                report["mean_eta_error"] = (sum([abs(error) for error in
+                                                 eta_errors]) /
+                                            len(eta_errors))
+                report["max_eta_error"] = max(eta_errors, key=abs)
+        return report
+
+    def save(self, report, result_dir, name=None):
+        """
+        Save the samples and report to <name>.json in result_dir.
+
+        :param report: Report got by get_report()
+        :param result_dir: Directory to save the result file
+        :param name: Name of the result file, default is
+                     blockjob_<vm_name>_<target>
+        :return: Path of the result file
+        """
+        if name is None:
+            name = "blockjob_%s_%s" % (self.vm_name, self.target)
+        result_path = os.path.join(result_dir, "%s.json" % name)
+        result_file = open(result_path, "w")
+        try:
+            json.dump({"report": report, "samples": self.samples},
+                      result_file, indent=4, sort_keys=True)
+        finally:
+            result_file.close()
+        logging.info("Block job progress of %s %s saved to %s", self.vm_name,
+                     self.target, result_path)
+        return result_path
+
+
+def log_report(report):
+    """
+    Log a report got by BlockJobMonitor.get_report().
+    """
+    logging.info("Block job %s of %s %s: %d samples, %s bytes, ready after "
+                 "%s s, mean rate %.2f MiB/s", report.get("type"),
+                 report["vm"], report["target"], report["samples"],
+                 report.get("total_bytes"), report["time_to_ready"],
+                 (report.get("mean_rate") or 0) / 1048576)
+    if "mean_deviation" in report:
+        logging.info("Bandwidth limit %.2f MiB/s, mean deviation %+.2f%%, "
+                     "max deviation %+.2f%%", report["limit"] / 1048576.0,
+                     report["mean_deviation"], report["max_deviation"])
+    if "mean_eta_error" in report:
+        logging.info("ETA error: mean %.2f s, max %+.2f s",
+                     report["mean_eta_error"], report["max_eta_error"])
+    if "pivot_time" in report:
+        logging.info("Pivot took %.3f s", report["pivot_time"])
+
+
+def get_limit(bandwidth, in_bytes=False):
+    """
+    Get the bandwidth limit in bytes/s of a --bandwidth value.
+
+    :param bandwidth: Value of --bandwidth, MiB/s unless in_bytes
+    :param in_bytes: Whether --bytes is used
+    :return: Limit in bytes/s, None if there is no valid limit
+    """
+    if not str(bandwidth).isdigit() or not int(bandwidth):
+        return None
+    if in_bytes:
+        return int(bandwidth)
+    return int(bandwidth) * 1048576
+
+
+class GuestWriteLoad(object):
+
+    """
+    Keep writing a file in a guest, to load a disk during a block job.
+
+    A mirror job only gets ready when it copies faster than the guest
+    dirties the disk, so with a bandwidth limit the size written each
+    time is a ratio of what the job may copy meanwhile.
+    """
+
+    def __init__(self, vm, params, limit=None):
+        """
+        :param vm: VM object
+        :param params: Test params, blockjob_write_load_file,
+                       blockjob_write_load_interval(seconds between two
+                       writes of the file), blockjob_write_load_ratio(of
+                       the limit) and blockjob_write_load_size(MiB, used
+                       without limit) are used
+        :param limit: Bandwidth limit of the job in bytes/s
+        """
+        self.vm = vm
+        self.path = params.get("blockjob_write_load_file",
+                               "/var/tmp/blockjob_load")
+        self.interval = float(params.get("blockjob_write_load_interval", 1))
+        if limit:
+            ratio = float(params.get("blockjob_write_load_ratio", 0.25))
+            self.size = int(limit * ratio * self.interval)
+        else:
+            self.size = int(params.get("blockjob_write_load_size",
+                                       64)) * 1048576
+        # Written by blocks of 64KiB
+        self.count = max(1, self.size // 65536)
+        self.pid = None
+
+    def start(self):
+        """
+        Start writing in background.
+        """
+        cmd = ("nohup sh -c 'while true; do dd if=/dev/urandom of=%s bs=64k "
+               "count=%s conv=notrunc oflag=direct 2>/dev/null; sleep %s; "
+               "done' > /dev/null 2>&1 & echo $!"
+               % (self.path, self.count, self.interval))
+        logging.info("Start writing in %s: %s", self.vm.name, cmd)
+        session = self.vm.wait_for_login()
+        try:
+            self.pid = session.cmd_output(cmd).strip().splitlines()[-1]
+        finally:
+            session.close()
+
+    def stop(self):
+        """
+        Stop writing and remove the file.
+        """
+        if not self.pid:
+            return
+        session = self.vm.wait_for_login()
+        try:
+            session.cmd_status("kill %s; rm -f %s" % (self.pid, self.path))
+        finally:
+            session.close()
+        self.pid = None
+
+
+def create_monitor(vm, target, params, limit=None):
+    """
+    Create and start a monitor of a disk if blockjob_monitor is yes in
+    params, and start a write load in guest if blockjob_write_load is yes.
+
+    :param vm: VM object
+    :param target: Target dev of the disk
+    :param params: Test params, blockjob_monitor and
+                   blockjob_monitor_interval are used
+    :param limit: Bandwidth limit of the job in bytes/s, to keep the write
+                  load below it
+    :return: Tuple of (monitor, write load), None for the disabled ones
+    """
+    if params.get("blockjob_monitor", "no") != "yes":
+        return None, None
+    write_load = None
+    if params.get("blockjob_write_load", "no") == "yes":
+        write_load = GuestWriteLoad(vm, params, limit)
+        write_load.start()
+    interval = float(params.get("blockjob_monitor_interval", 0.2))
+    monitor = BlockJobMonitor(vm.name, target, interval)
+    monitor.start()
+    return monitor, write_load
+
+
+def report_monitor(monitor, write_load, params, result_dir, limit=None,
+                   pivot_time=None):
+    """
+    Stop the monitor and the write load, log and save the report.
+
+    :param monitor: Monitor got by create_monitor()
+    :param write_load: Write load got by create_monitor()
+    :param params: Test params, blockjob_max_deviation is used
+    :param result_dir: Directory to save the result
+    :param limit: Bandwidth limit of the job in bytes/s
+    :param pivot_time: Seconds the pivot took, if pivoted
+    :return: The report
+    :raise: TestFail if the mean rate deviates from the limit more than
+            blockjob_max_deviation percent
+    """
+    monitor.stop()
+    if write_load:
+        write_load.stop()
+    report = monitor.get_report(limit)
+    if pivot_time is not None:
+        report["pivot_time"] = pivot_time
+    report["write_load"] = write_load is not None
+    log_report(report)
+    monitor.save(report, result_dir)
+    max_deviation = params.get("blockjob_max_deviation")
+    if (max_deviation and "mean_deviation" in report and
+            abs(report["mean_deviation"]) > float(max_deviation)):
+        raise exceptions.TestFail("Mean rate of the block job deviates "
+                                  "%+.2f%% from the limit, more than %s%%"
+                                  % (report["mean_deviation"], max_deviation))
+    return report
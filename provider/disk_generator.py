@@ -0,0 +1,121 @@
+"""
+Shared code for storage tests that need disk images of a given size,
+fill ratio and sparseness, so that benchmarks are reproducible.
+"""
+
+import os
+import re
+import logging
+
+from avocado.core import exceptions
+from avocado.utils import process
+
+SIZE_UNITS = {"": 1,
+              "B": 1,
+              "K": 1024,
+              "M": 1024 ** 2,
+              "G": 1024 ** 3,
+              "T": 1024 ** 4}
+
+# Count of qemu-io commands run by one qemu-io process
+QEMU_IO_BATCH = 256
+
+
+def parse_size(size):
+    """
+    Convert a size like "10G" or "512M" to bytes.
+
+    :param size: Size string, K/M/G/T are 1024 based
+    :return: Size in bytes
+    """
+    match = re.match(r"^\s*(\d+)\s*([KMGTB]?)I?B?\s*$", str(size).upper())
+    if not match:
+        raise exceptions.TestError("Invalid size: %s" % size)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def get_filled_chunks(chunk_count, fill_ratio):
+    """
+    Get the indexes of chunks to fill, spread evenly over the disk.
+
+    :param chunk_count: Count of chunks of the disk
+    :param fill_ratio: Ratio of chunks to fill, from 0 to 1
+    :return: List of chunk indexes
+    """
+    return [index for index in range(chunk_count)
+            if int((index + 1) * fill_ratio) > int(index * fill_ratio)]
+
+
+def write_chunks(path, img_format, offsets, chunk_size, pattern=0x5a):
+    """
+    Write chunks of a pattern into an image by qemu-io.
+
+    :param path: Path of the image
+    :param img_format: Format of the image
+    :param offsets: List of offsets of the chunks
+    :param chunk_size: Size of each chunk in bytes
+    :param pattern: Byte written to the chunks
+    """
+    for start in range(0, len(offsets), QEMU_IO_BATCH):
+        commands = " ".join(["-c 'write -P %s %s %s'" %
+                             (pattern, offset, chunk_size)
+                             for offset in offsets[start:start +
+                                                   QEMU_IO_BATCH]])
+        process.run("qemu-io -f %s %s %s" % (img_format, commands, path),
+                    shell=True)
+
+
+def get_allocated_size(path):
+    """
+    Get the bytes a file really uses on disk.
+    """
+    return os.stat(path).st_blocks * 512
+
+
+def create_disk(path, size, img_format="qcow2", fill_ratio=0.0,
+                sparse=True, backing_file=None, backing_format=None,
+                chunk_size=1048576, pattern=0x5a):
+    """
+    Create an image and fill part of it with data.
+
+    The filled chunks are spread evenly over the image. A sparse image
+    leaves the rest unallocated, otherwise the whole image is allocated
+    when it is created.
+
+    :param path: Path of the image
+    :param size: Size of the image, in bytes or like "10G"
+    :param img_format: Format of the image, such as raw or qcow2
+    :param fill_ratio: Ratio of the image filled with data, from 0 to 1
+    :param sparse: Leave the rest of the image unallocated or not
+    :param backing_file: Backing file of a qcow2 image
+    :param backing_format: Format of the backing file
+    :param chunk_size: Size of each filled chunk in bytes
+    :param pattern: Byte written to the filled chunks, use different ones
+                    to tell the data of an overlay from its backing file
+    :return: Dict of path, format, size, filled bytes and allocated bytes
+    """
+    size = parse_size(size)
+    cmd = "qemu-img create -f %s" % img_format
+    options = []
+    if not sparse:
+        options.append("preallocation=falloc")
+    if backing_file:
+        options.append("backing_file=%s" % backing_file)
+        if backing_format:
+            options.append("backing_fmt=%s" % backing_format)
+    if options:
+        cmd += " -o %s" % ",".join(options)
+    process.run("%s %s %s" % (cmd, path, size), shell=True)
+
+    chunks = get_filled_chunks(size // chunk_size, fill_ratio)
+    if chunks:
+        write_chunks(path, img_format,
+                     [index * chunk_size for index in chunks], chunk_size,
+                     pattern)
+    info = {"path": path,
+            "format": img_format,
+            "size": size,
+            "filled": len(chunks) * chunk_size,
+            "allocated": get_allocated_size(path)}
+    logging.debug("Created disk: %s", info)
+    return info
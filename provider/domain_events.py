@@ -0,0 +1,172 @@
+"""
+Shared code for tests that need to wait for domain lifecycle events
+instead of polling the domain state.
+"""
+
+import re
+import time
+import logging
+import threading
+
+import aexpect
+
+from virttest import virsh
+
+# Lifecycle event expected after each virsh command succeeded.
+EXPECTED_EVENTS = {"start": "Started",
+                   "shutdown": "Stopped",
+                   "destroy": "Stopped",
+                   "suspend": "Suspended",
+                   "resume": "Resumed",
+                   "reboot": "Started"}
+
+EVENT_PATTERN = re.compile(r"event '([^']+)' for domain '?([^:\s']+)'?:?"
+                           r"(?:\s+(\S+))?(?:\s+(\S+))?")
+
+# Metadata set on a domain to get an event once virsh event registered.
+HANDSHAKE_URI = "http://libvirt.org/schemas/tp-libvirt/event-handshake"
+HANDSHAKE_KEY = "handshake"
+
+
+class DomainEventWatcher(object):
+
+    """
+    Watch domain events by a long-running "virsh event --all --loop",
+    every received event is stamped with the time it arrived.
+    """
+
+    def __init__(self, uri=None, max_events=10000):
+        """
+        :param uri: Libvirt URI to connect, None means the default one
+        :param max_events: Number of events to keep, the oldest ones are
+                           dropped beyond it
+        """
+        self.uri = uri
+        self.max_events = max_events
+        self.events = []
+        self.condition = threading.Condition()
+        self.tail = None
+
+    def _parse_line(self, line):
+        """
+        Record the event in line of virsh output, such as:
+        event 'lifecycle' for domain avocado-vt-vm1: Started Booted
+        """
+        match = EVENT_PATTERN.search(line)
+        if not match:
+            return
+        event_type, domain, event, detail = match.groups()
+        self.condition.acquire()
+        try:
+            self.events.append({"time": time.time(),
+                                "type": event_type,
+                                "domain": domain,
+                                "event": event,
+                                "detail": detail})
+            if len(self.events) > self.max_events:
+                del self.events[:len(self.events) - self.max_events]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def start(self, domain=None, timeout=30):
+        """
+        Start virsh event in background.
+
+        virsh event prints nothing once it registered, so the metadata of
+        domain is set until the metadata-change event arrives. Events of
+        earlier commands would be missed otherwise.
+
+        :param domain: Domain to get the handshake event of, None means
+                       not to wait for virsh event to register
+        :param timeout: Timeout in seconds to wait for the handshake event
+        :return: True if virsh event is known to be registered
+        """
+        command = virsh.VIRSH_EXEC
+        if self.uri:
+            command += " -c '%s'" % self.uri
+        command += " event --all --loop"
+        logging.debug("Watching domain events by '%s'", command)
+        self.tail = aexpect.Tail(command, output_func=self._parse_line)
+        if domain is None:
+            return False
+        return self._handshake(domain, timeout)
+
+    def _handshake(self, domain, timeout):
+        """
+        Set metadata of domain until virsh event reports the change.
+        """
+        end_time = time.time() + timeout
+        ready = False
+        try:
+            while not ready and time.time() < end_time:
+                since = time.time()
+                result = virsh.command("metadata %s --uri %s --key %s "
+                                       "--set '<%s/>'" %
+                                       (domain, HANDSHAKE_URI, HANDSHAKE_KEY,
+                                        HANDSHAKE_KEY),
+                                       uri=self.uri, ignore_status=True)
+                if result.exit_status:
+                    logging.warning("Failed to set metadata of %s for the "
+                                    "handshake with virsh event: %s",
+                                    domain, result.stderr.strip())
+                    return False
+                ready = self.wait_for_event(
+                    domain, None, since=since, timeout=1,
+                    event_type="metadata-change") is not None
+        finally:
+            virsh.command("metadata %s --uri %s --remove" %
+                          (domain, HANDSHAKE_URI), uri=self.uri,
+                          ignore_status=True)
+        if not ready:
+            logging.warning("No metadata-change event of %s from virsh "
+                            "event in %ss", domain, timeout)
+        return ready
+
+    def stop(self):
+        """
+        Stop virsh event.
+        """
+        if self.tail is not None:
+            self.tail.close()
+            self.tail = None
+
+    def _find_event(self, domain, event, since, event_type):
+        """
+        Get the time of the first matching event, the caller must hold
+        the condition. event None matches any event of event_type.
+        """
+        for item in self.events:
+            if (item["time"] >= since and item["domain"] == domain and
+                    item["type"] == event_type and
+                    event in (None, item["event"])):
+                return item["time"]
+        return None
+
+    def wait_for_event(self, domain, event, since=0, timeout=240,
+                       event_type="lifecycle"):
+        """
+        Wait until an event of domain received after since arrives.
+
+        :param domain: Domain name
+        :param event: Event name, such as "Started" or "Stopped", None
+                      means any event of event_type
+        :param since: Only events received after this timestamp count
+        :param timeout: Timeout in seconds
+        :param event_type: Event type, such as "lifecycle"
+        :return: The time the event arrived, or None on timeout
+        """
+        end_time = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while True:
+                event_time = self._find_event(domain, event, since,
+                                              event_type)
+                if event_time is not None:
+                    return event_time
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
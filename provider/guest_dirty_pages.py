@@ -0,0 +1,157 @@
+"""
+Shared code for migration tests that need guests dirtying their memory
+at a controlled rate.
+
+The guest side is libvirt/deps/dirty_pages.py, DirtyPageWorkload copies
+it into a guest, runs it in background and reads its stats.
+"""
+
+import os
+import json
+import logging
+
+from avocado.core import exceptions
+
+from virttest import remote
+from virttest import utils_misc
+
+GUEST_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "libvirt", "deps", "dirty_pages.py")
+
+
+def get_workload_args(params):
+    """
+    Get the arguments of dirty_pages.py from params.
+
+    :param params: Test params, dirty_pages_size(MiB), dirty_pages_rate
+                   (MiB/s), dirty_pages_content, dirty_pages_pattern,
+                   dirty_pages_hot_ratio and dirty_pages_duration are used,
+                   duration 0 means to run until stop_workloads()
+    :return: Argument string of dirty_pages.py
+    """
+    return ("--size %s --rate %s --content %s --pattern %s "
+            "--hot-ratio %s --duration %s"
+            % (params.get("dirty_pages_size", "256"),
+               params.get("dirty_pages_rate", "0"),
+               params.get("dirty_pages_content", "random"),
+               params.get("dirty_pages_pattern", "sequential"),
+               params.get("dirty_pages_hot_ratio", "0.1"),
+               params.get("dirty_pages_duration", "0")))
+
+
+class DirtyPageWorkload(object):
+
+    """
+    Run dirty_pages.py in a guest.
+    """
+
+    def __init__(self, vm, params, guest_dir="/tmp"):
+        """
+        :param vm: VM object
+        :param params: Test params, see get_workload_args(), and
+                       dirty_pages_python for the python of the guest
+        :param guest_dir: Directory in guest to put the script and stats
+        """
+        self.vm = vm
+        self.args = get_workload_args(params)
+        self.python = params.get("dirty_pages_python", "python")
+        self.script = os.path.join(guest_dir, "dirty_pages.py")
+        self.stats_file = os.path.join(guest_dir, "dirty_pages.stats")
+        self.pid = None
+
+    def start(self, session, timeout=120):
+        """
+        Copy the script into the guest, start it in background and wait
+        until the working set is allocated and dirtying began.
+
+        :param session: Shell session of the guest
+        :param timeout: Timeout of the first stats line
+        :raise: TestError if the workload did not start
+        """
+        self.vm.copy_files_to(GUEST_SCRIPT, self.script)
+        cmd = ("nohup %s %s %s --stats-file %s > /dev/null 2>&1 & echo $!"
+               % (self.python, self.script, self.args, self.stats_file))
+        logging.info("Start dirtying memory of %s: %s", self.vm.name, cmd)
+        session.cmd("rm -f %s" % self.stats_file)
+        self.pid = session.cmd_output(cmd).strip().splitlines()[-1]
+        text = "Wait for dirty pages workload in %s" % self.vm.name
+        if not utils_misc.wait_for(lambda: self.get_stats(session), timeout,
+                                   text=text):
+            raise exceptions.TestError("Dirty pages workload did not start "
+                                       "in %s" % self.vm.name)
+
+    def get_stats(self, session):
+        """
+        Get the latest stats of the workload.
+
+        :param session: Shell session of the guest
+        :return: Dict like {"mib_per_second": 100.0, "pages": 25600,
+                 "total_pages": 256000, "time": 1502112226.4}, or None
+                 if there is no stats yet
+        """
+        cmd = "tail -n 1 %s" % self.stats_file
+        status, output = session.cmd_status_output(cmd)
+        if status or not output.strip():
+            return None
+        try:
+            return json.loads(output.strip().splitlines()[-1])
+        except ValueError:
+            return None
+
+    def stop(self, session):
+        """
+        Stop the workload.
+
+        :param session: Shell session of the guest
+        """
+        if self.pid:
+            session.cmd_status("kill %s" % self.pid)
+            self.pid = None
+
+
+def start_workloads(vms, params):
+    """
+    Start a dirty pages workload in each vm.
+
+    :param vms: List of vm
+    :param params: Test params
+    :return: Dict of {vm_name: DirtyPageWorkload}
+    """
+    workloads = {}
+    for vm in vms:
+        session = vm.wait_for_login()
+        try:
+            workload = DirtyPageWorkload(vm, params)
+            workload.start(session)
+            stats = workload.get_stats(session)
+            logging.info("%s is dirtying %.2f MiB/s", vm.name,
+                         stats["mib_per_second"])
+            workloads[vm.name] = workload
+        finally:
+            session.close()
+    return workloads
+
+
+def stop_workloads(vms, workloads, timeout=60):
+    """
+    Stop the workloads started by start_workloads(). The dead vms and the
+    vms failed to login are skipped.
+
+    :param vms: List of vm
+    :param workloads: Dict got by start_workloads()
+    :param timeout: Timeout to login each vm
+    """
+    for vm in vms:
+        workload = workloads.get(vm.name)
+        if workload is None or not vm.is_alive():
+            continue
+        try:
+            session = vm.wait_for_login(timeout=timeout)
+        except remote.LoginError, detail:
+            logging.warning("Failed to stop dirty pages workload in %s: %s",
+                            vm.name, detail)
+            continue
+        try:
+            workload.stop(session)
+        finally:
+            session.close()
@@ -0,0 +1,124 @@
+"""
+Shared code for tests that need to dump guests and measure the dump
+throughput.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from avocado.core import exceptions
+
+from virttest import virsh
+
+
+def get_dump_options(params):
+    """
+    Get the options of virsh dump from params.
+
+    :param params: Test params, LB_dump_live, LB_dump_memory_only,
+                   LB_dump_bypass_cache and LB_dump_format are used
+    :return: Option string of virsh dump
+    """
+    options = []
+    if params.get("LB_dump_live", "no") == "yes":
+        options.append("--live")
+    if params.get("LB_dump_memory_only", "no") == "yes":
+        options.append("--memory-only")
+        # The format is only supported with --memory-only.
+        dump_format = params.get("LB_dump_format", "")
+        if dump_format:
+            options.append("--format %s" % dump_format)
+    if params.get("LB_dump_bypass_cache", "no") == "yes":
+        options.append("--bypass-cache")
+    return " ".join(options)
+
+
+def dump_vms(vms, dump_dir, options="", parallel=False, keep_files=False):
+    """
+    Dump each vm into its own file in dump_dir and measure the throughput.
+
+    :param vms: List of vm
+    :param dump_dir: Directory to save the dump files
+    :param options: Options of virsh dump
+    :param parallel: Dump all the vms at the same time or one by one
+    :param keep_files: Keep the dump files or remove them once measured
+    :return: Dict like {"dumps": {vm_name: {"file": path, "bytes": 1024,
+             "seconds": 1.0, "bytes_per_second": 1024.0}},
+             "total_bytes": 1024, "seconds": 1.0,
+             "bytes_per_second": 1024.0}
+    :raise: TestFail if any dump failed
+    """
+    dumps = {}
+    errors = []
+    lock = threading.Lock()
+
+    def _dump(vm):
+        dump_file = os.path.join(dump_dir, "%s.dump" % vm.name)
+        start_time = time.time()
+        result = virsh.dump(vm.name, dump_file, option=options,
+                            ignore_status=True)
+        seconds = time.time() - start_time
+        lock.acquire()
+        try:
+            if result.exit_status:
+                errors.append("Failed to dump %s: %s" %
+                              (vm.name, result.stderr.strip()))
+                return
+            dump_bytes = os.path.getsize(dump_file)
+            dumps[vm.name] = {"file": dump_file,
+                              "bytes": dump_bytes,
+                              "seconds": seconds,
+                              "bytes_per_second": dump_bytes / seconds}
+        finally:
+            lock.release()
+            if not keep_files and os.path.exists(dump_file):
+                os.remove(dump_file)
+
+    start_time = time.time()
+    if parallel:
+        threads = []
+        for vm in vms:
+            thread = threading.Thread(target=_dump, args=(vm,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    else:
+        for vm in vms:
+            _dump(vm)
+    seconds = time.time() - start_time
+    if errors:
+        raise exceptions.TestFail("\n".join(errors))
+
+    total_bytes = sum([dump["bytes"] for dump in dumps.values()])
+    for vm_name, dump in sorted(dumps.items()):
+        logging.info("Dumped %s: %d bytes in %.2fs, %.2f MiB/s", vm_name,
+                     dump["bytes"], dump["seconds"],
+                     dump["bytes_per_second"] / 1048576)
+    logging.info("Dumped %d vms %s with options '%s': %d bytes in %.2fs, "
+                 "aggregate %.2f MiB/s", len(dumps),
+                 "in parallel" if parallel else "one by one", options,
+                 total_bytes, seconds, total_bytes / seconds / 1048576)
+    return {"dumps": dumps,
+            "options": options,
+            "parallel": parallel,
+            "total_bytes": total_bytes,
+            "seconds": seconds,
+            "bytes_per_second": total_bytes / seconds}
+
+
+def save_result(result, result_dir, name="dump_throughput"):
+    """
+    Save the result of dump_vms to <name>.json in result_dir.
+    """
+    result_path = os.path.join(result_dir, "%s.json" % name)
+    result_file = open(result_path, "w")
+    try:
+        json.dump(result, result_file, indent=4, sort_keys=True)
+    finally:
+        result_file.close()
+    logging.info("Dump results saved to %s", result_path)
+    return result_path
@@ -0,0 +1,203 @@
+"""
+Shared code for storage tests that measure disk I/O in a guest by fio.
+
+A job is described by a string like "randread:4k:32", that is the fio
+rw mode, block size and I/O depth. The results of a run are parsed from
+the json output of fio, so both fio 2.x (usec latencies) and 3.x (nsec
+latencies) work.
+"""
+
+import os
+import json
+import logging
+
+from avocado.core import exceptions
+
+# Percentiles of the completion latency to report
+PERCENTILES = ("50", "99", "99.9")
+
+
+def parse_job(job):
+    """
+    Parse a job string like "randread:4k:32".
+
+    :return: Dict of rw, bs and iodepth
+    :raise: TestError if the job string is invalid
+    """
+    items = job.split(":")
+    if len(items) != 3 or not items[2].isdigit():
+        raise exceptions.TestError("Invalid fio job '%s', it should be "
+                                   "<rw>:<bs>:<iodepth>" % job)
+    return {"rw": items[0], "bs": items[1], "iodepth": int(items[2])}
+
+
+def get_fio_cmd(filenames, job, runtime=30, numjobs=1, fio="fio",
+                extra=""):
+    """
+    Get the fio command line of a job on some disks.
+
+    Each disk gets its own fio job, --group_reporting sums them up, so
+    the result is the aggregate of all the disks.
+
+    :param filenames: List of device paths in guest
+    :param job: Job string like "randread:4k:32"
+    :param runtime: Seconds to run
+    :param numjobs: Count of fio jobs of each disk
+    :param fio: Path of fio in guest
+    :param extra: Extra global options of fio
+    :return: Command line of fio
+    """
+    job = parse_job(job)
+    cmd = ("%s --direct=1 --ioengine=libaio --rw=%s --bs=%s --iodepth=%s "
+           "--numjobs=%s --runtime=%s --time_based --group_reporting "
+           "--percentile_list=%s --output-format=json"
+           % (fio, job["rw"], job["bs"], job["iodepth"], numjobs, runtime,
+              ":".join(PERCENTILES)))
+    if extra:
+        cmd += " %s" % extra
+    for index, filename in enumerate(filenames):
+        cmd += " --name=disk%d --filename=%s" % (index, filename)
+    return cmd
+
+
+def get_percentile(percentiles, percent):
+    """
+    Get a percentile from the percentile dict of fio, whose keys are like
+    "99.900000".
+    """
+    for key, value in percentiles.items():
+        if abs(float(key) - float(percent)) < 0.0001:
+            return value
+    return None
+
+
+def parse_fio_json(output):
+    """
+    Parse the json output of fio run with --group_reporting.
+
+    :param output: Output of fio, text before the json is skipped
+    :return: Dict of {"read": {...}, "write": {...}}, each one has iops,
+             bw(bytes/s), lat_mean_us and lat_p<percent>_us, only the
+             directions with I/O are included
+    :raise: TestError if there is no fio json in the output
+    """
+    try:
+        fio_result = json.loads(output[output.index("{"):])
+    except ValueError:
+        raise exceptions.TestError("Invalid fio output:\n%s" % output)
+    job = fio_result["jobs"][0]
+    result = {}
+    for direction in ("read", "write"):
+        stats = job.get(direction)
+        if not stats or not stats.get("io_bytes", stats.get("io_kbytes")):
+            continue
+        # fio 3.x reports latencies in nsec, 2.x in usec
+        if "clat_ns" in stats:
+            clat = stats["clat_ns"]
+            scale = 1000.0
+        else:
+            clat = stats["clat"]
+            scale = 1.0
+        direction_result = {"iops": stats["iops"],
+                            "bw": stats["bw"] * 1024,
+                            "lat_mean_us": clat["mean"] / scale}
+        percentiles = clat.get("percentile", {})
+        for percent in PERCENTILES:
+            value = get_percentile(percentiles, percent)
+            direction_result["lat_p%s_us" % percent] = (
+                value is not None and value / scale or None)
+        result[direction] = direction_result
+    return result
+
+
+def run_fio(session, filenames, job, runtime=30, numjobs=1, fio="fio",
+            extra=""):
+    """
+    Run a fio job on some disks in guest.
+
+    :param session: Shell session of the guest
+    :return: Dict got by parse_fio_json()
+    :raise: TestFail if fio failed
+    """
+    cmd = get_fio_cmd(filenames, job, runtime, numjobs, fio, extra)
+    logging.info("Run fio in guest: %s", cmd)
+    status, output = session.cmd_status_output(cmd, timeout=runtime + 120)
+    if status:
+        raise exceptions.TestFail("fio failed in guest: %s" % output)
+    return parse_fio_json(output)
+
+
+def check_fio(session, fio="fio"):
+    """
+    Check whether fio is installed in guest.
+
+    :raise: TestSkipError if there is no fio in guest
+    """
+    if session.cmd_status("which %s" % fio):
+        raise exceptions.TestSkipError("fio is not installed in guest")
+
+
+def get_disk_by_serial(session, serial):
+    """
+    Get the device path of a disk in guest by its serial.
+
+    :param session: Shell session of the guest
+    :param serial: Serial of the disk set in the domain xml
+    :return: Device path like /dev/vdb, or None if not found
+    """
+    cmd = "readlink -f /dev/disk/by-id/*%s 2>/dev/null | head -n 1" % serial
+    path = session.cmd_output(cmd).strip()
+    return path.startswith("/dev/") and path or None
+
+
+def format_table(rows, columns):
+    """
+    Format rows of results into a text table.
+
+    :param rows: List of dicts
+    :param columns: List of (key, title, format) of the columns, format
+                    is like "%.2f"
+    :return: Text of the table
+    """
+    cells = [[title for key, title, fmt in columns]]
+    for row in rows:
+        row_cells = []
+        for key, title, fmt in columns:
+            value = row.get(key)
+            row_cells.append(value is None and "-" or fmt % value)
+        cells.append(row_cells)
+    widths = [max([len(cell_line[index]) for cell_line in cells])
+              for index in range(len(columns))]
+    return "\n".join(["  ".join([cell.rjust(width)
+                                 for cell, width in zip(line, widths)])
+                      for line in cells])
+
+
+def save_table(rows, columns, result_dir, name, extra=None):
+    """
+    Save rows of results to <name>.json and their table to <name>.txt
+    in result_dir.
+
+    :param rows: List of dicts, saved as "results" of the json file
+    :param columns: Columns of the table, see format_table()
+    :param result_dir: Directory to save the result files
+    :param name: Name of the result files
+    :param extra: Dict of other items to save in the json file
+    :return: Text of the table
+    """
+    results = dict(extra or {})
+    results["results"] = rows
+    result_path = os.path.join(result_dir, "%s.json" % name)
+    result_file = open(result_path, "w")
+    try:
+        json.dump(results, result_file, indent=4, sort_keys=True)
+    finally:
+        result_file.close()
+    table = format_table(rows, columns)
+    table_file = open(os.path.join(result_dir, "%s.txt" % name), "w")
+    try:
+        table_file.write(table + "\n")
+    finally:
+        table_file.close()
+    logging.info("Results saved to %s", result_path)
+    return table
@@ -0,0 +1,138 @@
+"""
+Shared code for migration tests that need the latency of guest memory
+accesses, such as the page faults of post-copy migration.
+
+The guest side is libvirt/deps/memory_latency.py, MemoryLatencyProbe
+copies it into a guest, runs it in background and reads its stats.
+"""
+
+import os
+import json
+import time
+import logging
+
+from avocado.core import exceptions
+
+from virttest import utils_misc
+
+GUEST_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "libvirt", "deps", "memory_latency.py")
+
+
+class MemoryLatencyProbe(object):
+
+    """
+    Run memory_latency.py in a guest.
+    """
+
+    def __init__(self, vm, params, guest_dir="/tmp"):
+        """
+        :param vm: VM object
+        :param params: Test params, memory_latency_size(MiB),
+                       memory_latency_write, memory_latency_report and
+                       memory_latency_python are used
+        :param guest_dir: Directory in guest to put the script and stats
+        """
+        self.vm = vm
+        self.args = "--size %s --report %s" % (
+            params.get("memory_latency_size", "256"),
+            params.get("memory_latency_report", "0.5"))
+        if params.get("memory_latency_write", "no") == "yes":
+            self.args += " --write"
+        self.python = params.get("memory_latency_python", "python")
+        self.script = os.path.join(guest_dir, "memory_latency.py")
+        self.stats_file = os.path.join(guest_dir, "memory_latency.stats")
+        self.pid = None
+        # Seconds to add to the guest time to get the host time
+        self.clock_offset = 0.0
+
+    def start(self, session, timeout=120):
+        """
+        Copy the script into the guest, start it in background and wait
+        until the working set is faulted in and the first stats came.
+
+        :param session: Shell session of the guest
+        :param timeout: Timeout of the first stats line
+        :raise: TestError if the probe did not start
+        """
+        self.vm.copy_files_to(GUEST_SCRIPT, self.script)
+        cmd = ("nohup %s %s %s --stats-file %s > /dev/null 2>&1 & echo $!"
+               % (self.python, self.script, self.args, self.stats_file))
+        logging.info("Start memory latency probe in %s: %s", self.vm.name,
+                     cmd)
+        session.cmd("rm -f %s" % self.stats_file)
+        self.pid = session.cmd_output(cmd).strip().splitlines()[-1]
+        host_time = time.time()
+        guest_time = float(session.cmd_output("date +%s.%N").strip())
+        self.clock_offset = host_time - guest_time
+        text = "Wait for memory latency probe in %s" % self.vm.name
+        if not utils_misc.wait_for(lambda: self.get_stats(session), timeout,
+                                   text=text):
+            raise exceptions.TestError("Memory latency probe did not start "
+                                       "in %s" % self.vm.name)
+
+    def get_stats(self, session):
+        """
+        Get all the stats of the probe so far.
+
+        :param session: Shell session of the guest
+        :return: List of dicts like {"time": 1502112226.4, "count": 812345,
+                 "mean_us": 0.31, "p50_us": 0.24, "p99_us": 0.95,
+                 "max_us": 2345.6}, time is converted to the host clock
+        """
+        status, output = session.cmd_status_output("cat %s" % self.stats_file)
+        if status:
+            return []
+        stats = []
+        for line in output.splitlines():
+            try:
+                interval = json.loads(line)
+            except ValueError:
+                continue
+            interval["time"] += self.clock_offset
+            stats.append(interval)
+        return stats
+
+    def stop(self, session):
+        """
+        Stop the probe.
+
+        :param session: Shell session of the guest
+        """
+        if self.pid:
+            session.cmd_status("kill %s" % self.pid)
+            self.pid = None
+
+
+def get_phase_latency(stats, phases):
+    """
+    Summarize the latency stats of each phase of a migration.
+
+    :param stats: Stats got by MemoryLatencyProbe.get_stats()
+    :param phases: List of (name, start_time, end_time) in host time,
+                   None end_time means until the last stats
+    :return: Dict of {name: {"intervals": 4, "accesses": 3249380,
+             "mean_us": 0.3, "p99_us": 1.2, "max_us": 2345.6}}, p99_us
+             is the worst p99 of the intervals of the phase
+    """
+    summary = {}
+    for name, start_time, end_time in phases:
+        intervals = [interval for interval in stats
+                     if interval["time"] > start_time and
+                     (end_time is None or interval["time"] <= end_time)]
+        phase = {"intervals": len(intervals),
+                 "accesses": sum([interval["count"]
+                                  for interval in intervals]),
+                 "mean_us": None,
+                 "p99_us": None,
+                 "max_us": None}
+        if intervals:
+            phase["mean_us"] = (sum([interval["mean_us"] * interval["count"]
+                                     for interval in intervals]) /
+                                max(phase["accesses"], 1))
+            phase["p99_us"] = max([interval["p99_us"]
+                                   for interval in intervals])
+            phase["max_us"] = max([interval["max_us"]
+                                   for interval in intervals])
+        summary[name] = phase
+    return summary
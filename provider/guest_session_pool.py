@@ -0,0 +1,115 @@
+"""
+Shared code for tests that need to run commands in guests repeatedly,
+such as polling whether a benchmark is running.
+"""
+
+import logging
+import threading
+
+
+class GuestSessionPool(object):
+
+    """
+    Keep one live shell session for each vm.
+
+    A session is reused as long as it is alive, the qemu process of the vm
+    did not change and, if health_check is enabled, it can still run a
+    command. Otherwise the pool logs in again.
+    """
+
+    def __init__(self, timeout=240, health_check=True,
+                 health_check_timeout=10):
+        """
+        :param timeout: Timeout of logging in a vm
+        :param health_check: Run a command to check a session before
+                             handing it out
+        :param health_check_timeout: Timeout of the health check command
+        """
+        self.timeout = timeout
+        self.health_check = health_check
+        self.health_check_timeout = health_check_timeout
+        # vm name -> (session, qemu pid)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        # Logging in a vm should not block the other vms.
+        self.vm_locks = {}
+        self.login_count = 0
+
+    def _get_vm_lock(self, vm):
+        self.lock.acquire()
+        try:
+            return self.vm_locks.setdefault(vm.name, threading.Lock())
+        finally:
+            self.lock.release()
+
+    def _is_healthy(self, vm, session, pid):
+        """
+        Check whether session of vm is still usable.
+        """
+        if not session.is_alive():
+            return False
+        if vm.get_pid() != pid:
+            logging.debug("Qemu process of %s changed, log in again.",
+                          vm.name)
+            return False
+        if self.health_check:
+            try:
+                status = session.cmd_status(
+                    "true", timeout=self.health_check_timeout)
+            except Exception, detail:
+                logging.debug("Health check of %s session failed: %s",
+                              vm.name, detail)
+                return False
+            return status == 0
+        return True
+
+    def get_session(self, vm):
+        """
+        Get a live session of vm, log in if there is none.
+
+        :param vm: VM object
+        :return: A shell session of vm, do not close it
+        """
+        vm_lock = self._get_vm_lock(vm)
+        vm_lock.acquire()
+        try:
+            session, pid = self.sessions.get(vm.name, (None, None))
+            if session is not None:
+                if self._is_healthy(vm, session, pid):
+                    return session
+                session.close()
+            session = vm.wait_for_login(timeout=self.timeout)
+            self.sessions[vm.name] = (session, vm.get_pid())
+            self.login_count += 1
+            return session
+        finally:
+            vm_lock.release()
+
+    def invalidate(self, vm):
+        """
+        Close the session of vm, such as after rebooting it.
+
+        :param vm: VM object
+        """
+        vm_lock = self._get_vm_lock(vm)
+        vm_lock.acquire()
+        try:
+            session, _ = self.sessions.pop(vm.name, (None, None))
+            if session is not None:
+                session.close()
+        finally:
+            vm_lock.release()
+
+    def close(self):
+        """
+        Close all the sessions.
+        """
+        self.lock.acquire()
+        try:
+            for session, _ in self.sessions.values():
+                session.close()
+            self.sessions = {}
+            logging.debug("Guest session pool logged in %d times.",
+                          self.login_count)
+        finally:
+            self.lock.release()
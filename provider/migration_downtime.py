@@ -0,0 +1,257 @@
+"""
+Shared code for migration tests that need to measure the downtime of
+guests.
+
+DowntimeProbe pings all the guests from one thread with a raw ICMP
+socket every few milliseconds, and finds the longest window in which a
+guest did not answer. The network of a guest may come back a while after
+the migration command returns, so stop() can keep probing until every
+guest answers again. get_libvirt_downtime() reads the downtime libvirt
+measured, so the two can be cross-checked.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+import threading
+
+from virttest import virsh
+
+from provider import migration_progress
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+def icmp_checksum(data):
+    """
+    Get the internet checksum of data.
+    """
+    if len(data) % 2:
+        data += "\0"
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class DowntimeProbe(object):
+
+    """
+    Ping guests by ICMP echo at a fixed interval and record which probes
+    were answered.
+    """
+
+    def __init__(self, targets, interval=0.05):
+        """
+        :param targets: Dict of {vm_name: ip_address}
+        :param interval: Seconds between two probes to the same guest
+        """
+        self.targets = dict(targets)
+        self.interval = interval
+        self.ident = os.getpid() & 0xffff
+        self.lock = threading.Lock()
+        # vm_name -> {seq: send time}
+        self.sent = dict((name, {}) for name in self.targets)
+        # vm_name -> {seq: receive time}
+        self.received = dict((name, {}) for name in self.targets)
+        # vm_name -> send time of the latest answered probe
+        self.last_answered = dict((name, 0) for name in self.targets)
+        self.ip_to_name = dict((ip, name) for name, ip in
+                               self.targets.items())
+        self.sock = None
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def _send_loop(self):
+        seq = 0
+        next_time = time.time()
+        while not self.stop_event.is_set():
+            seq = (seq + 1) & 0xffff
+            for name, ip in self.targets.items():
+                send_time = time.time()
+                header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0,
+                                     self.ident, seq)
+                payload = struct.pack("!d", send_time)
+                checksum = icmp_checksum(header + payload)
+                header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0,
+                                     checksum, self.ident, seq)
+                try:
+                    self.sock.sendto(header + payload, (ip, 0))
+                except socket.error, detail:
+                    # The route may disappear during migration.
+                    if detail.errno not in (errno.EHOSTUNREACH,
+                                            errno.ENETUNREACH):
+                        logging.debug("Failed to probe %s: %s", name,
+                                      detail)
+                self.lock.acquire()
+                try:
+                    self.sent[name][seq] = send_time
+                finally:
+                    self.lock.release()
+            next_time += self.interval
+            self.stop_event.wait(max(0, next_time - time.time()))
+
+    def _receive_loop(self):
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([self.sock], [], [], 0.1)
+            if not readable:
+                continue
+            receive_time = time.time()
+            data, address = self.sock.recvfrom(2048)
+            header_len = (struct.unpack("!B", data[:1])[0] & 0x0f) * 4
+            icmp_type, _, _, ident, seq = struct.unpack(
+                "!BBHHH", data[header_len:header_len + 8])
+            name = self.ip_to_name.get(address[0])
+            if (icmp_type != ICMP_ECHO_REPLY or ident != self.ident or
+                    name is None):
+                continue
+            self.lock.acquire()
+            try:
+                self.received[name].setdefault(seq, receive_time)
+                send_time = self.sent[name].get(seq, 0)
+                if send_time > self.last_answered[name]:
+                    self.last_answered[name] = send_time
+            finally:
+                self.lock.release()
+
+    def start(self):
+        """
+        Start probing in background threads.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                  socket.getprotobyname("icmp"))
+        self.stop_event.clear()
+        for target in (self._receive_loop, self._send_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        logging.debug("Probing %s every %sms", self.targets,
+                      self.interval * 1000)
+
+    def wait_recovered(self, timeout):
+        """
+        Keep probing until every guest answers a probe sent after this
+        call, so the blackout after migration is measured too.
+
+        :param timeout: Seconds to wait
+        :return: List of the guests not answering yet
+        """
+        since = time.time()
+        end_time = since + timeout
+        while True:
+            self.lock.acquire()
+            try:
+                pending = [name for name, send_time in
+                           self.last_answered.items() if send_time < since]
+            finally:
+                self.lock.release()
+            if not pending or time.time() >= end_time:
+                break
+            time.sleep(self.interval)
+        if pending:
+            logging.warning("%s did not answer in %ss", pending, timeout)
+        return pending
+
+    def stop(self, recovery_timeout=0):
+        """
+        Stop probing, wait a moment for the replies in flight.
+
+        :param recovery_timeout: If not 0, keep probing up to so many
+                                 seconds until every guest answers again
+        """
+        if not self.threads:
+            return
+        if recovery_timeout:
+            self.wait_recovered(recovery_timeout)
+        time.sleep(self.interval * 2)
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def get_downtime(self):
+        """
+        Get the longest window each guest did not answer.
+
+        The blackout of a guest starts at the last answered probe before
+        the longest run of lost probes and ends at the first answered one
+        after it, so its accuracy is the probe interval.
+
+        :return: Dict of {vm_name: {"downtime": seconds, "start": time,
+                 "end": time, "sent": count, "received": count,
+                 "recovered": bool}}
+        """
+        result = {}
+        self.lock.acquire()
+        try:
+            for name in self.targets:
+                sent = self.sent[name]
+                answered = sorted([(sent[seq], seq) for seq in
+                                   self.received[name] if seq in sent])
+                info = {"downtime": 0.0, "start": None, "end": None,
+                        "sent": len(sent), "received": len(answered),
+                        "recovered": True}
+                for index in range(1, len(answered)):
+                    last_time, last_seq = answered[index - 1]
+                    first_time, first_seq = answered[index]
+                    if (first_seq - last_seq) & 0xffff <= 1:
+                        # No probe lost in between.
+                        continue
+                    gap = first_time - last_time - self.interval
+                    if gap > info["downtime"]:
+                        info.update({"downtime": gap, "start": last_time,
+                                     "end": first_time})
+                if sent and (not answered or
+                             max(sent.values()) - answered[-1][0] >
+                             2 * self.interval):
+                    # The guest never answered again.
+                    info["recovered"] = False
+                result[name] = info
+        finally:
+            self.lock.release()
+        return result
+
+
+def get_completed_jobinfo(vm_name, uri=None):
+    """
+    Get the info of the last completed job of a vm by
+    "virsh domjobinfo --completed".
+
+    :param vm_name: Name of the migrated vm
+    :param uri: URI of the host to query, usually the destination
+    :return: Dict got by migration_progress.parse_jobinfo(), empty if
+             the job info is not available
+    """
+    result = virsh.domjobinfo(vm_name, extra="--completed", uri=uri,
+                              ignore_status=True)
+    if result.exit_status:
+        logging.debug("Failed to get completed job info of %s: %s",
+                      vm_name, result.stderr.strip())
+        return {}
+    return migration_progress.parse_jobinfo(result.stdout)
+
+
+def get_libvirt_downtime(vm_name, uri=None, jobinfo=None):
+    """
+    Get the downtime of the last migration reported by
+    "virsh domjobinfo --completed".
+
+    :param vm_name: Name of the migrated vm
+    :param uri: URI of the host to query, usually the destination
+    :param jobinfo: Dict got by get_completed_jobinfo(), queried if None
+    :return: Downtime in seconds, or None if it is not reported
+    """
+    if jobinfo is None:
+        jobinfo = get_completed_jobinfo(vm_name, uri)
+    if "total_downtime" not in jobinfo:
+        return None
+    return jobinfo["total_downtime"] / 1000.0
@@ -0,0 +1,310 @@
+"""
+Shared code for migration tests that need to follow the progress of a
+migration job and check whether it converges.
+
+MigrationProgressSampler polls "virsh domjobinfo" in a background thread
+while a migration runs, and get_report() analyses the samples.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from virttest import virsh
+
+# Such as:
+# Data remaining:   1.234 GiB
+# Memory bandwidth: 100.123 MiB/s
+# Dirty rate:       1234         pages/s
+JOBINFO_PATTERN = re.compile(r"^([^:]+):\s+([-\d.]+)\s*(\S*)\s*$")
+
+BYTE_UNITS = {"B": 1,
+              "bytes": 1,
+              "KiB": 1024,
+              "MiB": 1024 ** 2,
+              "GiB": 1024 ** 3,
+              "TiB": 1024 ** 4}
+
+
+def parse_jobinfo(output):
+    """
+    Parse the output of virsh domjobinfo.
+
+    Keys are the lowercase labels joined by "_", sizes are converted to
+    bytes and bandwidths to bytes/s, the other values keep their unit.
+
+    :param output: Output of virsh domjobinfo
+    :return: Dict like {"job_type": "Unbounded", "iteration": 3,
+             "data_remaining": 1325024870.4, "dirty_rate": 1234}
+    """
+    info = {}
+    for line in output.splitlines():
+        if ":" not in line:
+            continue
+        key = line.split(":")[0].strip().lower().replace(" ", "_")
+        match = JOBINFO_PATTERN.search(line.strip())
+        if not match:
+            info[key] = line.split(":", 1)[-1].strip()
+            continue
+        value = float(match.group(2))
+        unit = match.group(3)
+        if unit.endswith("/s") and unit[:-2] in BYTE_UNITS:
+            value *= BYTE_UNITS[unit[:-2]]
+        elif unit in BYTE_UNITS:
+            value *= BYTE_UNITS[unit]
+        elif value == int(value):
+            value = int(value)
+        info[key] = value
+    return info
+
+
+class MigrationProgressSampler(object):
+
+    """
+    Poll virsh domjobinfo of a vm at a fixed interval and keep the samples
+    taken while a job is active.
+    """
+
+    def __init__(self, vm_name, uri=None, interval=0.5):
+        """
+        :param vm_name: Name of the migrating vm
+        :param uri: URI of the source host, None means the default one
+        :param interval: Seconds between two samples
+        """
+        self.vm_name = vm_name
+        self.uri = uri
+        self.interval = interval
+        self.samples = []
+        self.start_time = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _sample_loop(self):
+        while not self.stop_event.is_set():
+            sample_time = time.time()
+            result = virsh.domjobinfo(self.vm_name, uri=self.uri,
+                                      ignore_status=True)
+            if not result.exit_status:
+                info = parse_jobinfo(result.stdout)
+                if info.get("job_type", "None") != "None":
+                    info["time"] = sample_time - self.start_time
+                    self.samples.append(info)
+            self.stop_event.wait(max(0, sample_time + self.interval -
+                                     time.time()))
+
+    def start(self):
+        """
+        Start sampling in a background thread.
+        """
+        self.start_time = time.time()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        logging.debug("Took %d job info samples of %s", len(self.samples),
+                      self.vm_name)
+
+    def get_report(self, completed, stall_iterations=5, max_iterations=30):
+        """
+        Analyse the samples of the migration.
+
+        A migration does not converge if it did not complete, if it
+        needed more than max_iterations iterations, or if the memory
+        remaining at the start of its last stall_iterations iterations
+        never dropped below the lowest value seen before them.
+
+        :param completed: Whether the migration completed
+        :param stall_iterations: Iterations without progress to be stalled
+        :param max_iterations: Most iterations a converging run may need
+        :return: Dict of the report, "converged" and "reasons" tell
+                 whether and why the migration did not converge
+        """
+        samples = self.samples
+        report = {"vm": self.vm_name,
+                  "completed": completed,
+                  "samples": len(samples),
+                  "reasons": []}
+        if not completed:
+            report["reasons"].append("migration did not complete")
+        if samples:
+            last = samples[-1]
+            report["duration"] = last["time"] - samples[0]["time"]
+            report["iterations"] = last.get("iteration", 0)
+            report["last_data_remaining"] = last.get("data_remaining")
+
+            # Memory remaining at the start of each iteration
+            remaining = []
+            iteration = None
+            for sample in samples:
+                if ("iteration" in sample and
+                        sample["iteration"] != iteration and
+                        "memory_remaining" in sample):
+                    iteration = sample["iteration"]
+                    remaining.append(sample["memory_remaining"])
+            report["iteration_memory_remaining"] = remaining
+
+            dirty_rates = [sample["dirty_rate"] * sample["page_size"]
+                           for sample in samples
+                           if "dirty_rate" in sample and "page_size" in sample]
+            bandwidths = [sample["memory_bandwidth"] for sample in samples
+                          if "memory_bandwidth" in sample]
+            if dirty_rates:
+                report["mean_dirty_rate"] = sum(dirty_rates) / len(dirty_rates)
+            if bandwidths:
+                report["mean_bandwidth"] = sum(bandwidths) / len(bandwidths)
+            if dirty_rates and bandwidths and report["mean_bandwidth"]:
+                report["dirty_rate_to_bandwidth"] = (report["mean_dirty_rate"] /
+                                                     report["mean_bandwidth"])
+
+            if "compressed_pages" in last:
+                misses = last.get("compression_cache_misses", 0)
+                total = last["compressed_pages"] + misses
+                report["compression_cache_hit_ratio"] = (
+                    total and float(last["compressed_pages"]) / total or 0.0)
+            if "auto_converge_throttle" in last:
+                report["auto_converge_throttle"] = last["auto_converge_throttle"]
+
+            if report["iterations"] > max_iterations:
+                report["reasons"].append("%d iterations, more than %d" %
+                                         (report["iterations"],
+                                          max_iterations))
+            if (len(remaining) > stall_iterations and
+                    min(remaining[-stall_iterations:]) >=
+                    min(remaining[:-stall_iterations])):
+                report["reasons"].append("memory remaining did not drop "
+                                         "in the last %d iterations" %
+                                         stall_iterations)
+        report["converged"] = not report["reasons"]
+        return report
+
+    def save(self, report, result_dir, name=None):
+        """
+        Save the samples and report to <name>.json in result_dir.
+
+        :param report: Report got by get_report()
+        :param result_dir: Directory to save the result file
+        :param name: Name of the result file, default is
+                     migration_progress_<vm_name>
+        :return: Path of the result file
+        """
+        if name is None:
+            name = "migration_progress_%s" % self.vm_name
+        result_path = os.path.join(result_dir, "%s.json" % name)
+        result_file = open(result_path, "w")
+        try:
+            json.dump({"report": report, "samples": self.samples},
+                      result_file, indent=4, sort_keys=True)
+        finally:
+            result_file.close()
+        logging.info("Migration progress of %s saved to %s", self.vm_name,
+                     result_path)
+        return result_path
+
+
+def get_transfer_rates(samples):
+    """
+    Get the transfer rate between each two samples.
+
+    The rates come from the data processed and the time elapsed that
+    libvirt reports, so the delay of polling virsh does not skew them.
+
+    :param samples: Samples of MigrationProgressSampler
+    :return: List of dicts like {"time": 3.5, "rate": 33554432.0}, rate
+             is in bytes/s, time is the one of the later sample
+    """
+    rates = []
+    last = None
+    for sample in samples:
+        if "data_processed" not in sample or "time_elapsed" not in sample:
+            continue
+        if last is not None and sample["time_elapsed"] > last["time_elapsed"]:
+            processed = sample["data_processed"] - last["data_processed"]
+            elapsed = sample["time_elapsed"] - last["time_elapsed"]
+            rates.append({"time": sample["time"],
+                          "rate": processed * 1000.0 / elapsed})
+        last = sample
+    return rates
+
+
+def log_report(report):
+    """
+    Log a report got by MigrationProgressSampler.get_report().
+    """
+    logging.info("Migration of %s: %d samples, %s iterations in %.2fs, "
+                 "dirty rate %.2f MiB/s, bandwidth %.2f MiB/s",
+                 report["vm"], report["samples"],
+                 report.get("iterations", "unknown"),
+                 report.get("duration", 0),
+                 report.get("mean_dirty_rate", 0) / 1048576,
+                 report.get("mean_bandwidth", 0) / 1048576)
+    if "compression_cache_hit_ratio" in report:
+        logging.info("Compression cache hit ratio of %s: %.2f%%",
+                     report["vm"],
+                     report["compression_cache_hit_ratio"] * 100)
+    if report["converged"]:
+        logging.info("Migration of %s converged", report["vm"])
+    else:
+        logging.warning("Migration of %s did not converge: %s",
+                        report["vm"], "; ".join(report["reasons"]))
+
+
+def create_samplers(vm_names, params, uri=None):
+    """
+    Create and start a sampler for each vm if migration_progress_sampler
+    is yes in params.
+
+    :param vm_names: Names of the migrating vms
+    :param params: Test params, migration_progress_sampler and
+                   migration_progress_interval are used
+    :param uri: URI of the source host
+    :return: List of started samplers, empty if sampling is disabled
+    """
+    if params.get("migration_progress_sampler", "no") != "yes":
+        return []
+    interval = float(params.get("migration_progress_interval", 0.5))
+    samplers = []
+    for vm_name in vm_names:
+        sampler = MigrationProgressSampler(vm_name, uri, interval)
+        sampler.start()
+        samplers.append(sampler)
+    return samplers
+
+
+def report_samplers(samplers, completed, params, result_dir=None):
+    """
+    Stop the samplers, log and save their reports.
+
+    :param samplers: Samplers got by create_samplers()
+    :param completed: Whether the migrations completed
+    :param params: Test params, migration_progress_stall_iterations and
+                   migration_progress_max_iterations are used
+    :param result_dir: Directory to save the results, None to skip saving
+    :return: List of reports of the migrations that did not converge
+    """
+    stall_iterations = int(params.get("migration_progress_stall_iterations",
+                                      5))
+    max_iterations = int(params.get("migration_progress_max_iterations", 30))
+    not_converged = []
+    for sampler in samplers:
+        sampler.stop()
+        report = sampler.get_report(completed, stall_iterations,
+                                    max_iterations)
+        log_report(report)
+        if result_dir:
+            sampler.save(report, result_dir)
+        if not report["converged"]:
+            not_converged.append(report)
+    return not_converged
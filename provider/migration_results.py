@@ -0,0 +1,307 @@
+"""
+Shared code for migration tests that need to keep their results in a
+local SQLite database, so that runs can be compared across versions.
+
+Run this module to show the trends of the saved results, such as:
+python -m provider.migration_results --db <file> --key duration
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import sqlite3
+import optparse
+
+from virttest import virsh
+from virttest import data_dir
+
+from provider import migration_downtime
+
+DEFAULT_DB = os.path.join(data_dir.get_data_dir(), "migration_results.db")
+
+COLUMNS = (("time", "REAL"),
+           ("test", "TEXT"),
+           ("vm", "TEXT"),
+           ("options", "TEXT"),
+           ("memory", "INTEGER"),
+           ("vcpus", "INTEGER"),
+           ("workload", "TEXT"),
+           ("status", "TEXT"),
+           ("duration", "REAL"),
+           ("downtime", "REAL"),
+           ("bandwidth", "REAL"),
+           ("libvirt_version", "TEXT"),
+           ("qemu_version", "TEXT"),
+           ("extra", "TEXT"))
+
+# A bigger value of these keys is worse
+LOWER_IS_BETTER = ("duration", "downtime")
+
+VERSIONS = {}
+
+
+def get_versions():
+    """
+    Get the versions of libvirt and qemu from virsh version.
+
+    :return: Dict of {"libvirt": "3.2.0", "qemu": "2.9.0"}
+    """
+    if not VERSIONS:
+        output = virsh.version(ignore_status=True).stdout
+        for key, pattern in (("libvirt", r"[Uu]sing library:\s*\S+\s+(\S+)"),
+                             ("qemu", r"[Rr]unning hypervisor:\s*\S+\s+(\S+)")):
+            match = re.search(pattern, output)
+            VERSIONS[key] = match and match.group(1) or "unknown"
+    return VERSIONS
+
+
+def get_guest_size(vm_name, uri=None):
+    """
+    Get the max memory(KiB) and vcpus count of a vm from virsh dominfo.
+
+    :return: Tuple of (memory, vcpus), None for the unknown ones
+    """
+    output = virsh.dominfo(vm_name, uri=uri, ignore_status=True).stdout
+    memory = re.search(r"Max memory:\s+(\d+)", output)
+    vcpus = re.search(r"CPU\(s\):\s+(\d+)", output)
+    return (memory and int(memory.group(1)) or None,
+            vcpus and int(vcpus.group(1)) or None)
+
+
+def get_workload(params):
+    """
+    Get a short description of the workload of a test from params.
+    """
+    for key in ("migration_stress_type", "stress_type",
+                "migrate_load_vms"):
+        if params.get(key):
+            workload = params.get(key)
+            if workload == "dirty_pages_in_vms":
+                workload += " %s MiB/s %s %s" % (
+                    params.get("dirty_pages_rate", "0"),
+                    params.get("dirty_pages_content", "random"),
+                    params.get("dirty_pages_pattern", "sequential"))
+            return workload
+    return "none"
+
+
+class MigrationResultsDB(object):
+
+    """
+    A SQLite database of migration results, one row per migrated vm.
+    """
+
+    def __init__(self, path=DEFAULT_DB):
+        """
+        :param path: Path of the database file, created if not exists
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS migrations "
+                          "(id INTEGER PRIMARY KEY, %s)" %
+                          ", ".join(["%s %s" % column
+                                     for column in COLUMNS]))
+        self.conn.commit()
+
+    def add(self, record):
+        """
+        Add a record.
+
+        :param record: Dict with keys of COLUMNS, missing ones are NULL
+        """
+        names = [column[0] for column in COLUMNS]
+        self.conn.execute("INSERT INTO migrations (%s) VALUES (%s)" %
+                          (", ".join(names), ", ".join(["?"] * len(names))),
+                          [record.get(name) for name in names])
+        self.conn.commit()
+
+    def get_records(self, test=None):
+        """
+        Get records ordered by time.
+
+        :param test: Only get the records of this test
+        :return: List of dicts
+        """
+        names = [column[0] for column in COLUMNS]
+        sql = "SELECT %s FROM migrations" % ", ".join(names)
+        args = []
+        if test:
+            sql += " WHERE test = ?"
+            args.append(test)
+        sql += " ORDER BY time"
+        return [dict(zip(names, row))
+                for row in self.conn.execute(sql, args)]
+
+    def close(self):
+        self.conn.close()
+
+
+def record_migration(params, test, vm_name, status, duration, options="",
+                     uri=None, guest_size=None, downtime=None,
+                     bandwidth=None, dest_uri=None, **extra):
+    """
+    Add the result of a migration to the database of the test params.
+
+    Nothing is saved if migration_results_store is no. Errors of the
+    database are logged, they never fail the test.
+
+    :param params: Test params, migration_results_store and
+                   migration_results_db are used
+    :param test: Name of the test
+    :param vm_name: Name of the migrated vm
+    :param status: Whether the migration succeeded
+    :param duration: Seconds the migration took
+    :param options: Options of the migration
+    :param uri: URI of the source host, to get the guest size
+    :param guest_size: Tuple of (memory, vcpus) got before migration
+    :param downtime: Downtime in seconds, from the completed job if None
+    :param bandwidth: Bandwidth in bytes/s, from the completed job if None
+    :param dest_uri: URI of the destination host, to get the completed
+                     job info, the source host is queried if None
+    :param extra: Other info of the migration, saved as JSON
+    """
+    if params.get("migration_results_store", "yes") != "yes":
+        return
+    if guest_size is None:
+        guest_size = get_guest_size(vm_name, uri)
+    if status and (downtime is None or bandwidth is None):
+        jobinfo = migration_downtime.get_completed_jobinfo(
+            vm_name, dest_uri or uri)
+        if downtime is None:
+            downtime = migration_downtime.get_libvirt_downtime(
+                vm_name, jobinfo=jobinfo)
+        if bandwidth is None:
+            bandwidth = jobinfo.get("memory_bandwidth")
+    versions = get_versions()
+    record = {"time": time.time(),
+              "test": test,
+              "vm": vm_name,
+              "options": " ".join(options.split()),
+              "memory": guest_size[0],
+              "vcpus": guest_size[1],
+              "workload": get_workload(params),
+              "status": status and "pass" or "fail",
+              "duration": duration,
+              "downtime": downtime,
+              "bandwidth": bandwidth,
+              "libvirt_version": versions["libvirt"],
+              "qemu_version": versions["qemu"],
+              "extra": json.dumps(extra, sort_keys=True)}
+    db_path = params.get("migration_results_db", DEFAULT_DB)
+    try:
+        results_db = MigrationResultsDB(db_path)
+        try:
+            results_db.add(record)
+        finally:
+            results_db.close()
+    except sqlite3.Error, detail:
+        logging.warning("Failed to save migration result to %s: %s",
+                        db_path, detail)
+        return
+    logging.debug("Migration result saved to %s: %s", db_path, record)
+
+
+def get_trends(records, key="duration", window=5, tolerance=10):
+    """
+    Compare the latest passed run of each kind of migration with the
+    mean of the runs before it.
+
+    Runs of the same test, options, guest size and workload are the same
+    kind of migration.
+
+    :param records: Records got by MigrationResultsDB.get_records()
+    :param key: duration, downtime or bandwidth
+    :param window: Count of previous runs to compare with
+    :param tolerance: Allowed change in percent before a regression
+    :return: List of dicts of each kind of migration
+    """
+    groups = {}
+    for record in records:
+        if record["status"] != "pass" or record[key] is None:
+            continue
+        group = (record["test"], record["options"], record["memory"],
+                 record["vcpus"], record["workload"])
+        groups.setdefault(group, []).append(record)
+
+    trends = []
+    for group, group_records in sorted(groups.items()):
+        latest = group_records[-1]
+        previous = [record[key] for record in group_records[-window - 1:-1]]
+        trend = {"test": group[0],
+                 "options": group[1],
+                 "memory": group[2],
+                 "vcpus": group[3],
+                 "workload": group[4],
+                 "runs": len(group_records),
+                 "latest": latest[key],
+                 "latest_versions": "%s/%s" % (latest["libvirt_version"],
+                                               latest["qemu_version"]),
+                 "previous_mean": None,
+                 "change": None,
+                 "regression": False}
+        if previous:
+            mean = float(sum(previous)) / len(previous)
+            trend["previous_mean"] = mean
+            if mean:
+                change = (latest[key] - mean) * 100.0 / mean
+                trend["change"] = change
+                if key in LOWER_IS_BETTER:
+                    trend["regression"] = change > tolerance
+                else:
+                    trend["regression"] = change < -tolerance
+        trends.append(trend)
+    return trends
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="python -m provider.migration_results [options]")
+    parser.add_option("--db", default=DEFAULT_DB,
+                      help="Database file, default is %default")
+    parser.add_option("--test", help="Only show results of this test")
+    parser.add_option("--key", default="duration",
+                      choices=["duration", "downtime", "bandwidth"],
+                      help="Result to compare, default is %default")
+    parser.add_option("--window", type="int", default=5,
+                      help="Previous runs to compare with, default is "
+                           "%default")
+    parser.add_option("--tolerance", type="float", default=10,
+                      help="Allowed change in percent, default is %default")
+    options = parser.parse_args()[0]
+    if not os.path.exists(options.db):
+        parser.error("No such database: %s" % options.db)
+
+    results_db = MigrationResultsDB(options.db)
+    try:
+        records = results_db.get_records(options.test)
+    finally:
+        results_db.close()
+    trends = get_trends(records, options.key, options.window,
+                        options.tolerance)
+    regressions = 0
+    for trend in trends:
+        if trend["previous_mean"] is None:
+            compare = "no previous run"
+        else:
+            compare = ("previous mean %.3f, change %+.2f%%"
+                       % (trend["previous_mean"], trend["change"] or 0))
+        flag = ""
+        if trend["regression"]:
+            flag = " REGRESSION"
+            regressions += 1
+        print("%s [%s] %s KiB %s vcpus, workload %s: %d runs, latest %s "
+              "%.3f with %s, %s%s" %
+              (trend["test"], trend["options"], trend["memory"],
+               trend["vcpus"], trend["workload"], trend["runs"],
+               options.key, trend["latest"], trend["latest_versions"],
+               compare, flag))
+    print("%d kinds of migration, %d regressions"
+          % (len(trends), regressions))
+    return regressions and 1 or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+"""
+Shared code for tests that need to collect network throughput samples,
+compare them with a baseline or find the impact of a migration on them.
+"""
+
+import os
+import re
+import json
+import logging
+
+# Such as:
+# ttcp-t: 65536000 bytes in 0.56 real seconds = 114285.71 KB/sec +++
+TTCP_PATTERN = re.compile(r"ttcp-[tr]:\s+(\d+) bytes in ([\d.]+) real seconds")
+
+# Such as:
+# Interim result: 9387.39 10^6bits/s over 1.000 seconds ending at 1502112226.465
+NETPERF_INTERIM_PATTERN = re.compile(r"Interim result:\s+([\d.]+)\s+(\S+)\s+"
+                                     r"over\s+([\d.]+)\s+seconds\s+"
+                                     r"ending at\s+([\d.]+)")
+
+
+def parse_ttcp_output(output):
+    """
+    Get the throughput from the output of ttcp -v.
+
+    The throughput is computed from the bytes and real seconds, so it does
+    not depend on the -f format option.
+
+    :param output: Output of ttcp
+    :return: Dict like {"bytes": 65536000, "seconds": 0.56,
+             "bytes_per_second": 117028571.4}, or None if not found
+    """
+    match = TTCP_PATTERN.search(output)
+    if not match:
+        return None
+    total_bytes = int(match.group(1))
+    seconds = float(match.group(2))
+    if not seconds:
+        return None
+    return {"bytes": total_bytes,
+            "seconds": seconds,
+            "bytes_per_second": total_bytes / seconds}
+
+
+def parse_netperf_interim(output):
+    """
+    Get the interim results of netperf -D.
+
+    :param output: Output of netperf -D
+    :return: List of dicts like {"time": 1502112226.465,
+             "throughput": 9387.39, "unit": "10^6bits/s", "seconds": 1.0}
+             ordered by time, "time" is when the interval ended
+    """
+    samples = []
+    for match in NETPERF_INTERIM_PATTERN.finditer(output):
+        samples.append({"time": float(match.group(4)),
+                        "throughput": float(match.group(1)),
+                        "unit": match.group(2),
+                        "seconds": float(match.group(3))})
+    return sorted(samples, key=lambda sample: sample["time"])
+
+
+def get_migration_impact(samples, start_time, end_time, recovery_ratio=0.9):
+    """
+    Get the throughput dip caused by a migration and how long the
+    throughput took to recover.
+
+    The baseline is the mean throughput of the intervals ending before
+    the migration started. The throughput recovered at the end of the
+    first interval after the dip that reaches recovery_ratio of the
+    baseline.
+
+    :param samples: Interim results got by parse_netperf_interim()
+    :param start_time: Time the migration started
+    :param end_time: Time the migration finished
+    :param recovery_ratio: Ratio of the baseline counted as recovered
+    :return: Dict of baseline, dip, dip_percent, dip_time and
+             recovery_time, the times are seconds after start_time and
+             recovery_time is None if the throughput never recovered
+    """
+    before = [sample["throughput"] for sample in samples
+              if sample["time"] <= start_time]
+    during = [sample for sample in samples
+              if sample["time"] - sample["seconds"] < end_time and
+              sample["time"] > start_time]
+    impact = {"samples": len(samples),
+              "migration_time": end_time - start_time,
+              "baseline": None,
+              "dip": None,
+              "dip_percent": None,
+              "dip_time": None,
+              "recovery_time": None}
+    if not before or not during:
+        return impact
+    baseline = sum(before) / len(before)
+    dip_sample = min(during, key=lambda sample: sample["throughput"])
+    impact.update({"baseline": baseline,
+                   "dip": dip_sample["throughput"],
+                   "dip_percent": (baseline and
+                                   (baseline - dip_sample["throughput"]) *
+                                   100.0 / baseline or 0.0),
+                   "dip_time": dip_sample["time"] - start_time})
+    for sample in samples:
+        if (sample["time"] > dip_sample["time"] and
+                sample["throughput"] >= baseline * recovery_ratio):
+            impact["recovery_time"] = sample["time"] - start_time
+            break
+    if impact["dip"] >= baseline * recovery_ratio:
+        # The throughput never dropped below the recovery threshold.
+        impact["recovery_time"] = 0.0
+    return impact
+
+
+class ThroughputResults(object):
+
+    """
+    Keep throughput samples of a test, save them and compare them with
+    a baseline.
+    """
+
+    def __init__(self, name="throughput"):
+        """
+        :param name: Name of the results, used as the result file name
+        """
+        self.name = name
+        self.samples = []
+
+    def add(self, bytes_per_second, **info):
+        """
+        Add a sample.
+
+        :param bytes_per_second: Throughput of the sample
+        :param info: Other info of the sample, such as vm and iteration
+        """
+        sample = dict(info)
+        sample["bytes_per_second"] = bytes_per_second
+        self.samples.append(sample)
+
+    def summary(self):
+        """
+        Get count, min, mean and max of the throughput in bytes/second.
+        """
+        values = [sample["bytes_per_second"] for sample in self.samples]
+        if not values:
+            return {"count": 0}
+        return {"count": len(values),
+                "min": min(values),
+                "mean": sum(values) / len(values),
+                "max": max(values)}
+
+    def save(self, result_dir):
+        """
+        Save samples and summary to <name>.json in result_dir.
+
+        :return: Path of the result file
+        """
+        result_path = os.path.join(result_dir, "%s.json" % self.name)
+        result_file = open(result_path, "w")
+        try:
+            json.dump({"summary": self.summary(), "samples": self.samples},
+                      result_file, indent=4, sort_keys=True)
+        finally:
+            result_file.close()
+        logging.info("Throughput results saved to %s", result_path)
+        return result_path
+
+    def save_baseline(self, baseline_file):
+        """
+        Save the summary as baseline of later runs.
+
+        :return: False if there is no sample to save, else True
+        """
+        summary = self.summary()
+        if not summary["count"] or not summary["mean"]:
+            logging.error("No throughput to save as baseline to %s",
+                          baseline_file)
+            return False
+        baseline_fd = open(baseline_file, "w")
+        try:
+            json.dump(summary, baseline_fd, indent=4, sort_keys=True)
+        finally:
+            baseline_fd.close()
+        logging.info("Throughput baseline saved to %s", baseline_file)
+        return True
+
+    def compare_baseline(self, baseline_file, tolerance):
+        """
+        Compare the mean throughput with the baseline.
+
+        :param baseline_file: File saved by save_baseline()
+        :param tolerance: Allowed drop of the mean throughput, in percent
+        :return: Tuple of (passed, message)
+        """
+        baseline_fd = open(baseline_file)
+        try:
+            baseline = json.load(baseline_fd)
+        finally:
+            baseline_fd.close()
+        summary = self.summary()
+        if not summary["count"]:
+            return False, "No throughput sample to compare with baseline."
+        if not baseline.get("mean"):
+            return False, ("Baseline %s has no mean throughput to compare "
+                           "with." % baseline_file)
+        change = (summary["mean"] - baseline["mean"]) * 100.0 / baseline["mean"]
+        message = ("Mean throughput %.2f MiB/s, baseline %.2f MiB/s, "
+                   "change %+.2f%%, tolerance %s%%." %
+                   (summary["mean"] / 1048576, baseline["mean"] / 1048576,
+                    change, tolerance))
+        return change >= -float(tolerance), message
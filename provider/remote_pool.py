@@ -0,0 +1,207 @@
+"""
+Shared code for tests that run many commands on remote hosts.
+
+Logging in to a host for every command makes setup and cleanup of multi
+host tests spend most of their time on ssh handshakes. RemoteSessionPool
+keeps the logged in shell sessions of each host and reuses them, and
+counts the logins, reuses and commands of each host.
+
+Commands run in a reused shell, so they should not rely on the state a
+previous command left, such as the current directory. Commands leaving
+background jobs should run with background=True, so that their session
+is closed instead of reused.
+"""
+
+import time
+import logging
+import threading
+
+import aexpect
+
+from virttest import remote
+
+DEFAULT_PROMPT = r"[\#\$]\s*$"
+
+
+class RemoteSessionPool(object):
+
+    """
+    Keep logged in sessions of remote hosts to run commands by.
+    """
+
+    def __init__(self, max_idle=4):
+        """
+        :param max_idle: Most idle sessions kept for each host, the other
+                         ones are closed when released
+        """
+        self.max_idle = max_idle
+        self.idle = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _get_stats(self, host):
+        if host not in self.stats:
+            self.stats[host] = {"logins": 0,
+                                "reuses": 0,
+                                "commands": 0,
+                                "failures": 0,
+                                "login_time": 0.0,
+                                "command_time": 0.0}
+        return self.stats[host]
+
+    def _count(self, host, key, value=1):
+        self.lock.acquire()
+        try:
+            self._get_stats(host)[key] += value
+        finally:
+            self.lock.release()
+
+    def get_session(self, host, user, password, client="ssh", port="22",
+                    prompt=DEFAULT_PROMPT, timeout=60):
+        """
+        Get an idle session of the host, or log in if there is none.
+
+        The session is not shared until it is released by
+        release_session(), closing it instead is fine.
+
+        :return: Shell session of the host
+        """
+        key = (client, host, str(port), user, prompt)
+        self.lock.acquire()
+        try:
+            sessions = self.idle.get(key, [])
+            while sessions:
+                session = sessions.pop()
+                if session.is_alive():
+                    self._get_stats(host)["reuses"] += 1
+                    session.pool_key = key
+                    return session
+                session.close()
+        finally:
+            self.lock.release()
+
+        start_time = time.time()
+        session = remote.wait_for_login(client, host, port, user, password,
+                                        prompt, timeout=timeout)
+        # No job notices in the output of the next commands
+        session.cmd_status("set +m")
+        self._count(host, "logins")
+        self._count(host, "login_time", time.time() - start_time)
+        session.pool_key = key
+        return session
+
+    def release_session(self, session):
+        """
+        Give a session got by get_session() back to the pool.
+        """
+        key = getattr(session, "pool_key", None)
+        if key is None or not session.is_alive():
+            session.close()
+            return
+        self.lock.acquire()
+        try:
+            sessions = self.idle.setdefault(key, [])
+            if len(sessions) < self.max_idle:
+                sessions.append(session)
+                return
+        finally:
+            self.lock.release()
+        session.close()
+
+    def run_cmd(self, command, host, user, password, timeout=60,
+                client="ssh", port="22", prompt=DEFAULT_PROMPT,
+                background=False):
+        """
+        Run a command on a host by a pooled session.
+
+        A session is closed instead of reused if the command timed out
+        or the shell died, since its output can not be trusted anymore.
+
+        :param background: Whether the command leaves background jobs,
+                           then the session is closed after it
+
+        :return: Tuple of (status, output)
+        :raise: remote.LoginError if it failed to log in,
+                aexpect.ShellError if the command did not finish
+        """
+        session = self.get_session(host, user, password, client, port,
+                                   prompt)
+        start_time = time.time()
+        try:
+            status, output = session.cmd_status_output(command, timeout)
+        except aexpect.ShellError:
+            session.close()
+            self._count(host, "failures")
+            raise
+        finally:
+            self._count(host, "commands")
+            self._count(host, "command_time", time.time() - start_time)
+        if background:
+            session.close()
+        else:
+            self.release_session(session)
+        return status, output
+
+    def close_all(self):
+        """
+        Close all idle sessions.
+        """
+        self.lock.acquire()
+        try:
+            for sessions in self.idle.values():
+                for session in sessions:
+                    session.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+    def log_stats(self):
+        """
+        Log the stats of each host.
+        """
+        for host, stats in sorted(self.stats.items()):
+            logging.info("Remote sessions of %s: %d logins in %.2fs, %d "
+                         "reuses, %d commands in %.2fs, %d failures", host,
+                         stats["logins"], stats["login_time"],
+                         stats["reuses"], stats["commands"],
+                         stats["command_time"], stats["failures"])
+
+
+# The pool shared by the helpers of a test
+POOL = RemoteSessionPool()
+
+
+def run_remote_cmd(command, host, user, password, timeout=60, client="ssh",
+                   port="22", prompt=DEFAULT_PROMPT, background=False):
+    """
+    Run a command on a host by the shared pool.
+
+    :return: Tuple of (status, output)
+    """
+    return POOL.run_cmd(command, host, user, password, timeout, client,
+                        port, prompt, background)
+
+
+def get_session(host, user, password, client="ssh", port="22",
+                prompt=DEFAULT_PROMPT, timeout=60):
+    """
+    Get a session of a host from the shared pool.
+    """
+    return POOL.get_session(host, user, password, client, port, prompt,
+                            timeout)
+
+
+def release_session(session):
+    """
+    Give a session back to the shared pool.
+    """
+    POOL.release_session(session)
+
+
+def cleanup():
+    """
+    Log the stats of the shared pool and close its sessions, call it at
+    the end of a test.
+    """
+    POOL.log_stats()
+    POOL.close_all()
@@ -0,0 +1,314 @@
+"""
+Shared code for benchmark and stress tests that need to run virsh
+commands in hot loops.
+
+Three backends are supported, selected by the "virsh_backend" param:
+
+fork: Call the functions of virsh module, every call forks a virsh
+      process and connects to libvirtd. This is the default.
+persistent: Run commands in a pool of virsh.VirshPersistent sessions,
+            which keep their connections between commands.
+bindings: Call libvirt-python directly on one shared connection.
+
+All backends return results which look like the ones of virsh module,
+with exit_status, stdout and stderr.
+"""
+
+import time
+import Queue
+import logging
+import threading
+
+from avocado.core import exceptions
+from avocado.utils import process
+
+from virttest import virsh
+
+BACKENDS = ("fork", "persistent", "bindings")
+
+# libvirt flags of the virsh options supported by the bindings backend
+DEVICE_FLAGS = {"--current": "VIR_DOMAIN_AFFECT_CURRENT",
+                "--live": "VIR_DOMAIN_AFFECT_LIVE",
+                "--config": "VIR_DOMAIN_AFFECT_CONFIG"}
+DUMPXML_FLAGS = {"--inactive": "VIR_DOMAIN_XML_INACTIVE",
+                 "--security-info": "VIR_DOMAIN_XML_SECURE",
+                 "--update-cpu": "VIR_DOMAIN_XML_UPDATE_CPU",
+                 "--migratable": "VIR_DOMAIN_XML_MIGRATABLE"}
+
+
+def get_backend(params):
+    """
+    Get the virsh backend configured in params.
+
+    :param params: Test params, "virsh_backend" selects the backend and
+                   "connect_uri" the libvirt URI to use
+    :return: A backend object, call close() on it when finished
+    """
+    name = params.get("virsh_backend", "fork")
+    uri = params.get("connect_uri", None)
+    if uri == "default":
+        uri = None
+    if name == "fork":
+        return ForkBackend(uri)
+    if name == "persistent":
+        return PersistentBackend(uri)
+    if name == "bindings":
+        return BindingsBackend(uri)
+    raise exceptions.TestError("Unknown virsh_backend '%s', should be one "
+                               "of %s" % (name, ", ".join(BACKENDS)))
+
+
+class ForkBackend(object):
+
+    """
+    Run every command in a new virsh process.
+    """
+
+    name = "fork"
+
+    def __init__(self, uri=None):
+        self.uri = uri
+
+    def __getattr__(self, command):
+        virsh_func = getattr(virsh, command)
+
+        def run_command(*args, **dargs):
+            if self.uri:
+                dargs.setdefault("uri", self.uri)
+            return virsh_func(*args, **dargs)
+        run_command.__name__ = command
+        return run_command
+
+    def close(self):
+        pass
+
+
+class PersistentBackend(object):
+
+    """
+    Run commands in virsh.VirshPersistent sessions.
+
+    A virsh session can not be shared by two threads at the same time,
+    so every command borrows an idle session, and a new session is only
+    opened when all the existing ones are busy.
+    """
+
+    name = "persistent"
+
+    def __init__(self, uri=None):
+        self.uri = uri
+        self.idle_sessions = Queue.Queue()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def acquire_session(self):
+        """
+        Get an idle virsh session, create it if there is none.
+        """
+        try:
+            return self.idle_sessions.get_nowait()
+        except Queue.Empty:
+            session = virsh.VirshPersistent(uri=self.uri)
+            self.lock.acquire()
+            try:
+                self.sessions.append(session)
+            finally:
+                self.lock.release()
+            return session
+
+    def __getattr__(self, command):
+        def run_command(*args, **dargs):
+            session = self.acquire_session()
+            try:
+                return getattr(session, command)(*args, **dargs)
+            finally:
+                self.idle_sessions.put(session)
+        run_command.__name__ = command
+        return run_command
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for session in self.sessions:
+                try:
+                    session.close_session()
+                except Exception, detail:
+                    logging.warning("Failed to close virsh session: %s",
+                                    detail)
+            self.sessions = []
+            self.idle_sessions = Queue.Queue()
+        finally:
+            self.lock.release()
+
+
+class BindingsBackend(object):
+
+    """
+    Run commands with libvirt-python on one connection.
+
+    Only the commands used by the benchmark and stress tests are
+    implemented, domain arguments are domain names.
+    """
+
+    name = "bindings"
+
+    def __init__(self, uri=None):
+        try:
+            import libvirt
+        except ImportError:
+            raise exceptions.TestSkipError("libvirt-python is required by "
+                                           "virsh_backend=bindings")
+        self.libvirt = libvirt
+        self.uri = uri
+        self.conn = libvirt.open(uri)
+        self.state_names = {
+            libvirt.VIR_DOMAIN_NOSTATE: "no state",
+            libvirt.VIR_DOMAIN_RUNNING: "running",
+            libvirt.VIR_DOMAIN_BLOCKED: "idle",
+            libvirt.VIR_DOMAIN_PAUSED: "paused",
+            libvirt.VIR_DOMAIN_SHUTDOWN: "in shutdown",
+            libvirt.VIR_DOMAIN_SHUTOFF: "shut off",
+            libvirt.VIR_DOMAIN_CRASHED: "crashed",
+            libvirt.VIR_DOMAIN_PMSUSPENDED: "pmsuspended"}
+
+    def _run(self, command, func, *args):
+        """
+        Call func with args and wrap the result into a CmdResult.
+
+        :param command: Virsh command line equivalent, for logging
+        :param func: Function to call, it returns the stdout
+        """
+        start_time = time.time()
+        try:
+            output = func(*args)
+            stdout, stderr, exit_status = str(output), "", 0
+        except self.libvirt.libvirtError, detail:
+            stdout, stderr, exit_status = "", str(detail), 1
+        return process.CmdResult(command, stdout, stderr, exit_status,
+                                 time.time() - start_time)
+
+    def _domain(self, name):
+        return self.conn.lookupByName(name)
+
+    def _domain_call(self, command, name, method, *args):
+        """
+        Call method of domain name which has no output.
+        """
+        def _call():
+            getattr(self._domain(name), method)(*args)
+            return ""
+        return self._run("%s %s" % (command, name), _call)
+
+    def _flags(self, command, options, flag_names):
+        """
+        Get the libvirt flags of virsh options.
+
+        :param command: Virsh command of the options, for the error message
+        :param options: Virsh options string, such as "--live --config"
+        :param flag_names: Dict of option to libvirt flag name
+        :raise: TestError if an option has no libvirt flag
+        """
+        flags = 0
+        for option in options.split():
+            if option not in flag_names:
+                raise exceptions.TestError("Option '%s' of %s is not "
+                                           "supported by virsh_backend="
+                                           "bindings" % (option, command))
+            flags |= getattr(self.libvirt, flag_names[option])
+        return flags
+
+    def _read_xml(self, xml_file):
+        xml_fd = open(xml_file)
+        try:
+            return xml_fd.read()
+        finally:
+            xml_fd.close()
+
+    def start(self, name, **dargs):
+        return self._domain_call("start", name, "create")
+
+    def shutdown(self, name, **dargs):
+        return self._domain_call("shutdown", name, "shutdown")
+
+    def destroy(self, name, **dargs):
+        return self._domain_call("destroy", name, "destroy")
+
+    def suspend(self, name, **dargs):
+        return self._domain_call("suspend", name, "suspend")
+
+    def resume(self, name, **dargs):
+        return self._domain_call("resume", name, "resume")
+
+    def reboot(self, name, **dargs):
+        return self._domain_call("reboot", name, "reboot", 0)
+
+    def domstate(self, name, **dargs):
+        return self._run("domstate %s" % name,
+                         lambda: self.state_names.get(
+                             self._domain(name).state()[0], "unknown"))
+
+    def domid(self, name, **dargs):
+        def _domid():
+            domain_id = self._domain(name).ID()
+            if domain_id < 0:
+                return "-"
+            return domain_id
+        return self._run("domid %s" % name, _domid)
+
+    def domuuid(self, name, **dargs):
+        return self._run("domuuid %s" % name,
+                         lambda: self._domain(name).UUIDString())
+
+    def dominfo(self, name, **dargs):
+        def _dominfo():
+            state, max_mem, mem, vcpus, cpu_time = self._domain(name).info()
+            return ("Name: %s\nState: %s\nCPU(s): %s\nCPU time: %.1fs\n"
+                    "Max memory: %s KiB\nUsed memory: %s KiB" %
+                    (name, self.state_names.get(state, "unknown"), vcpus,
+                     cpu_time / 1e9, max_mem, mem))
+        return self._run("dominfo %s" % name, _dominfo)
+
+    def dumpxml(self, name, extra="", **dargs):
+        flags = self._flags("dumpxml", extra, DUMPXML_FLAGS)
+        return self._run(("dumpxml %s %s" % (name, extra)).strip(),
+                         lambda: self._domain(name).XMLDesc(flags))
+
+    def dom_list(self, options="", **dargs):
+        def _dom_list():
+            names = [domain.name() for domain in
+                     self.conn.listAllDomains(0)
+                     if "--all" in options or domain.isActive()]
+            return "\n".join(names)
+        return self._run("list %s" % options, _dom_list)
+
+    def nodeinfo(self, extra="", **dargs):
+        def _nodeinfo():
+            info = self.conn.getInfo()
+            return ("CPU model: %s\nMemory size: %s MiB\nCPU(s): %s\n"
+                    "CPU frequency: %s MHz" % tuple(info[:4]))
+        return self._run("nodeinfo", _nodeinfo)
+
+    def attach_device(self, name, filearg, flagstr="", **dargs):
+        flags = self._flags("attach-device", flagstr, DEVICE_FLAGS)
+        return self._domain_call("attach-device", name, "attachDeviceFlags",
+                                 self._read_xml(filearg), flags)
+
+    def detach_device(self, name, filearg, flagstr="", **dargs):
+        flags = self._flags("detach-device", flagstr, DEVICE_FLAGS)
+        return self._domain_call("detach-device", name, "detachDeviceFlags",
+                                 self._read_xml(filearg), flags)
+
+    def qemu_monitor_command(self, name, command, options="", **dargs):
+        import libvirt_qemu
+        flags = 0
+        if "--hmp" in options:
+            flags = libvirt_qemu.VIR_DOMAIN_QEMU_MONITOR_COMMAND_HMP
+        return self._run("qemu-monitor-command %s %s" % (name, command),
+                         lambda: libvirt_qemu.qemuMonitorCommand(
+                             self._domain(name), command, flags))
+
+    def close(self):
+        try:
+            self.conn.close()
+        except self.libvirt.libvirtError, detail:
+            logging.warning("Failed to close libvirt connection: %s", detail)